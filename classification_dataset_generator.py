@@ -1,16 +1,23 @@
 import csv
 from argparse import ArgumentParser
-from os import path, mkdir, remove
+from os import path, mkdir, remove, rename
 from string import digits, ascii_letters
 
 from PIL import Image
 from tqdm import tqdm
 
-from dataset_generator.generator import generate_single_from_template
+from dataset_generator.generator import fill_expression_template, build_latex_format, render_expressions_batch, \
+    get_rasterizer, RASTERIZERS
 from segmenter.symbol_segmenter import segment_image
+from utils.dataset_shard import DatasetShardWriter, DATASET_SHARD_FILENAME
 
 
-def generate_dataset(outdir):
+def generate_dataset(outdir, batch_size=32, rasterizer=None, shard=False):
+    """
+    @param batch_size: number of expressions compiled and converted into images together
+    @param rasterizer: name of the program used to convert the PDFs into images, see `get_rasterizer`
+    @param shard: write the images into a dataset shard (see `utils.dataset_shard`) instead of PNG files
+    """
     characters = list(digits + ascii_letters + "=-+()[],.|")
     characters.extend(["\\sum", "\\pi", "\\int"])
 
@@ -25,6 +32,8 @@ def generate_dataset(outdir):
     csv_file = open(path.join(outdir, "metadata.csv"), "w")
     csv_writer = csv.writer(csv_file)
 
+    shard_writer = DatasetShardWriter(path.join(outdir, DATASET_SHARD_FILENAME)) if shard else None
+
     counter = 0
 
     def get_next_filename():
@@ -36,19 +45,50 @@ def generate_dataset(outdir):
     plain_template = "{0}"
     power_template = "{0}^{{{{{0}^{{{{{0}}}}}}}}}"
 
-    for i in tqdm(range(len(characters))):
-        ch = characters[i]
+    # render all the expressions first, as many at once as possible
+    exprs = []
+    tmp_filenames = []
+    for i, ch in enumerate(characters):
+        exprs.append(fill_expression_template(plain_template.format(ch)))
+        tmp_filenames.append(f"tmp_plain_expr_{i}")
+        exprs.append(fill_expression_template(power_template.format(ch)))
+        tmp_filenames.append(f"tmp_power_expr_{i}")
+
+    latex_format = build_latex_format(outdir, batch=True)
+    rasterizer = get_rasterizer(rasterizer)
+    errors = []
+    for start in tqdm(range(0, len(exprs), batch_size)):
+        errors.extend(render_expressions_batch(exprs[start:start + batch_size], outdir,
+                                               tmp_filenames[start:start + batch_size], f"tmp_batch_{start}",
+                                               latex_format=latex_format, rasterizer=rasterizer))
+
+    if latex_format is not None:
+        remove(path.join(outdir, latex_format + ".fmt"))
+
+    for i in range(len(characters)):
+        plain_expr = exprs[i * 2]
+        plain_tmp_filename, power_tmp_filename = tmp_filenames[i * 2], tmp_filenames[i * 2 + 1]
+        plain_error, power_error = errors[i * 2], errors[i * 2 + 1]
+
+        if plain_error is not None or power_error is not None:
+            print(f"[ERROR] element {plain_expr} could not be generated: {plain_error or power_error}, skipping...")
+
+            for tmp_filename in [plain_tmp_filename, power_tmp_filename]:
+                if path.exists(path.join(outdir, tmp_filename + ".png")):
+                    remove(path.join(outdir, tmp_filename + ".png"))
+            continue
 
         plain_filename = get_next_filename()
-        power_filename = 'tmp_power_expr'
-        plain_expr = generate_single_from_template(plain_template.format(ch),
-                                                   outdir, plain_filename)
-        _power_expr = generate_single_from_template(power_template.format(ch),
-                                                    outdir, power_filename)
+        if shard_writer is not None:
+            with Image.open(path.join(outdir, plain_tmp_filename + ".png")) as plain_img:
+                shard_writer.add(plain_filename, plain_expr, plain_img)
+            remove(path.join(outdir, plain_tmp_filename + ".png"))
+        else:
+            rename(path.join(outdir, plain_tmp_filename + ".png"), path.join(outdir, plain_filename + ".png"))
 
         csv_writer.writerow([plain_expr, plain_filename])
 
-        tmpimg = Image.open(path.join(outdir, power_filename + ".png"))
+        tmpimg = Image.open(path.join(outdir, power_tmp_filename + ".png"))
         crops_images = segment_image(tmpimg)
 
         if len(crops_images) != 3:
@@ -56,16 +96,35 @@ def generate_dataset(outdir):
 
         for crop, cropped_img in crops_images:
             filename = get_next_filename()
-            cropped_img.save(path.join(outdir, filename + ".png"))
+            if shard_writer is not None:
+                shard_writer.add(filename, plain_expr, cropped_img)
+            else:
+                cropped_img.save(path.join(outdir, filename + ".png"))
             csv_writer.writerow([plain_expr, filename])
 
-    remove(path.join(outdir, 'tmp_power_expr.png'))
+        remove(path.join(outdir, power_tmp_filename + ".png"))
+
+    if shard_writer is not None:
+        shard_writer.close()
+
+    csv_file.close()
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description='Fyp1 classfication dataset generator')
     parser.add_argument('--outdir', '-o', type=str, required=True, help='run generation in command line')
 
+    parser.add_argument('--batch-size', '-b', type=int, action='store', default=32,
+                        help='number of expressions compiled together (default 32)')
+
+    parser.add_argument('--rasterizer', '-r', type=str, action='store', default=None,
+                        choices=[rasterizer.name for rasterizer in RASTERIZERS],
+                        help='program used to convert the PDFs into images (default convert), the others are faster, '
+                             'but their images are a bit different')
+
+    parser.add_argument('--shard', action='store_true',
+                        help='pack the images into one dataset shard file instead of PNG files')
+
     args = parser.parse_args()
 
-    generate_dataset(args.outdir)
+    generate_dataset(args.outdir, args.batch_size, args.rasterizer, args.shard)
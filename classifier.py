@@ -2,16 +2,21 @@ import pickle
 import time
 from argparse import ArgumentParser
 
-from classifier.trainer import train_svm_model_from_features_dataset, generate_features_dataset
-
-
-def run_training(classification_dataset_dir, augmentation_count=10, pickle_file_out=None):
-    start = time.process_time_ns()
-    dataset = generate_features_dataset(classification_dataset_dir, augmentation_count, progress=True)
-    print('Training model...')
-    model, score = train_svm_model_from_features_dataset(dataset)
+from classifier.trainer import train_svm_model_from_features_dataset, generate_features_dataset, \
+    generate_features_dataset_cached, train_linear_model_streaming
+
+
+def run_training(classification_dataset_dir, augmentation_count=10, pickle_file_out=None, cache_dir=None,
+                 augmentation_seed=None, jobs=None, streaming=False, epochs=5):
+    start = time.perf_counter_ns()
+    if streaming:
+        model, score = train_linear_model_streaming(classification_dataset_dir, augmentation_count, epochs,
+                                                    progress=True, augmentation_seed=augmentation_seed)
+    else:
+        model, score = run_svm_training(classification_dataset_dir, augmentation_count, cache_dir, augmentation_seed,
+                                        jobs)
     print('score:', score)
-    end = time.process_time_ns()
+    end = time.perf_counter_ns()
 
     diff = (end - start) / 1e9
     print(f'took {diff:.05f} seconds')
@@ -23,12 +28,35 @@ def run_training(classification_dataset_dir, augmentation_count=10, pickle_file_
             pickle.dump(model, f)
 
 
+def run_svm_training(classification_dataset_dir, augmentation_count, cache_dir, augmentation_seed, jobs):
+    if cache_dir:
+        dataset = generate_features_dataset_cached(classification_dataset_dir, augmentation_count, cache_dir,
+                                                   progress=True, augmentation_seed=augmentation_seed, jobs=jobs)
+    else:
+        dataset = generate_features_dataset(classification_dataset_dir, augmentation_count, progress=True,
+                                            augmentation_seed=augmentation_seed, jobs=jobs)
+    print('Training model...')
+
+    return train_svm_model_from_features_dataset(dataset)
+
+
 if __name__ == "__main__":
     parser = ArgumentParser(description='Fyp1 classfication trainer, will output a final report for model accuracy')
     parser.add_argument('--dir', '-d', type=str, required=True, help='the dataset directory (input)')
     parser.add_argument('--count', '-c', type=int, help='image augmentation count (dataset increase)')
     parser.add_argument('--out', '-o', type=str, help='pickled output of the model')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='save the extracted features in this directory, and use them again if the dataset and '
+                             'the parameters did not change')
+    parser.add_argument('--seed', type=int, default=None, help='random seed of the image augmentation')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='prepare the images and extract their features using this number of processes')
+    parser.add_argument('--streaming', action='store_true',
+                        help='train a linear model incrementally on features generated when they are needed, the '
+                             'memory used does not depend on the augmentation count (--cache-dir and --jobs are not '
+                             'used)')
+    parser.add_argument('--epochs', type=int, default=5, help='number of passes over the dataset with --streaming')
 
     args = parser.parse_args()
 
-    run_training(args.dir, args.count, args.out)
+    run_training(args.dir, args.count, args.out, args.cache_dir, args.seed, args.jobs, args.streaming, args.epochs)
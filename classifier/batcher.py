@@ -0,0 +1,144 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread, Lock
+from typing import List
+
+import numpy as np
+
+from segmenter.crop_mask import CropMask
+from .classifier import SVMClassifier
+from .utils import extract_crop_masks_hog_features
+
+
+class ClassificationBatcher:
+    """
+    Collects the crops of concurrent requests and classifies them together with one call to the model.
+
+    The features are extracted in the thread of each request, then the request is queued, a single worker thread
+    takes the first request in the queue and waits up to `max_wait_ms` for more requests (or until there are
+    `max_batch_size` crops), predicts all of them at once, and gives every request its own labels back.
+
+    It has the same `predict_crop_masks_labels` as `SVMClassifier`, so it can be used in its place.
+    """
+
+    def __init__(self, svm_model: SVMClassifier, max_wait_ms: float = 2, max_batch_size: int = 256,
+                 metrics_window: int = 1000) -> None:
+        """
+        @param max_wait_ms: the maximum time a request waits for other requests to join its batch, 0 only batches
+                            the requests that are already waiting
+        @param max_batch_size: stop waiting for more requests after this number of crops, a batch can be larger if
+                               the last request has a lot of crops
+        @param metrics_window: the number of latest batches and requests used to compute the metrics
+        """
+        assert max_wait_ms >= 0, "max_wait_ms cannot be negative"
+        assert max_batch_size > 0, "max_batch_size must be positive"
+
+        self.svm_model: SVMClassifier = svm_model
+        self.max_wait_ms: float = max_wait_ms
+        self.max_batch_size: int = max_batch_size
+
+        self.__lock = Lock()
+        self.__queue = None
+        # the worker thread does not exist in forked processes, so it is created again for every process
+        self.__worker_pid = None
+
+        self.batches_count: int = 0
+        self.requests_count: int = 0
+        self.crops_count: int = 0
+        self.__batches_sizes = deque(maxlen=metrics_window)
+        self.__queue_waits = deque(maxlen=metrics_window)
+
+    def predict_crop_masks_labels(self, crop_masks: List[CropMask]) -> List[str]:
+        features = extract_crop_masks_hog_features(crop_masks)
+
+        return self.predict_features_labels(features)
+
+    def predict_features_labels(self, features: np.ndarray) -> List[str]:
+        """
+        Blocks until the batch containing `features` is predicted
+        """
+        if len(features) == 0:
+            return []
+
+        future = Future()
+        self.__get_queue().put((features, time.monotonic(), future))
+
+        return future.result()
+
+    def __get_queue(self) -> Queue:
+        with self.__lock:
+            if self.__worker_pid != os.getpid():
+                self.__queue = Queue()
+                self.__worker_pid = os.getpid()
+                Thread(target=self.__work, args=(self.__queue,), name='ClassificationBatcher', daemon=True).start()
+
+            return self.__queue
+
+    def __work(self, queue: Queue) -> None:
+        while True:
+            batch = [queue.get()]
+            crops_count = len(batch[0][0])
+            deadline = batch[0][1] + self.max_wait_ms / 1000
+
+            while crops_count < self.max_batch_size:
+                try:
+                    timeout = deadline - time.monotonic()
+                    request = queue.get(timeout=timeout) if timeout > 0 else queue.get_nowait()
+                except Empty:
+                    break
+
+                batch.append(request)
+                crops_count += len(request[0])
+
+            self.__predict_batch(batch)
+
+    def __predict_batch(self, batch: list) -> None:
+        start_time = time.monotonic()
+
+        try:
+            labels = self.svm_model.predict_features_labels(np.concatenate([features for features, _, _ in batch]))
+        except Exception as e:
+            for _features, _queued_time, future in batch:
+                future.set_exception(e)
+            return
+
+        start = 0
+        for features, _queued_time, future in batch:
+            future.set_result(list(labels[start:start + len(features)]))
+            start += len(features)
+
+        with self.__lock:
+            self.batches_count += 1
+            self.requests_count += len(batch)
+            self.crops_count += len(labels)
+            self.__batches_sizes.append(len(labels))
+            self.__queue_waits.extend(start_time - queued_time for _features, queued_time, _future in batch)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            batches_sizes = np.asarray(self.__batches_sizes, dtype=np.float64)
+            queue_waits_ms = np.asarray(self.__queue_waits, dtype=np.float64) * 1000
+
+            def summary(values: np.ndarray) -> dict:
+                if len(values) == 0:
+                    return {'mean': 0, 'p50': 0, 'p95': 0, 'max': 0}
+
+                return {
+                    'mean': float(values.mean()),
+                    'p50': float(np.percentile(values, 50)),
+                    'p95': float(np.percentile(values, 95)),
+                    'max': float(values.max()),
+                }
+
+            return {
+                'batches': self.batches_count,
+                'requests': self.requests_count,
+                'crops': self.crops_count,
+                'max_wait_ms': self.max_wait_ms,
+                'max_batch_size': self.max_batch_size,
+                'batch_size': summary(batches_sizes),
+                'queue_wait_ms': summary(queue_waits_ms),
+            }
@@ -1,25 +1,43 @@
 import pickle
+from hashlib import sha256
 from typing import List
 
+import numpy as np
 from PIL import Image
 
+from segmenter.crop_mask import CropMask
+from .linear_svm import LinearSVMPredictor, InconsistentPredictorException
 from .trainer import train_svm_model
-from .utils import extract_hog_features
+from .utils import extract_hog_features, extract_hog_features_batch, extract_crop_masks_hog_features, normalize_image
 
 
 class SVMClassifier:
-    def __init__(self, svm_pickle_filename=None):
+    def __init__(self, svm_pickle_filename=None, use_linear_predictor: bool = False,
+                 check_linear_predictor: bool = True):
+        """
+        @param use_linear_predictor: if True, the model is converted into a `LinearSVMPredictor` and used for all
+                                     predictions, which is much faster than `sklearn`, only works for linear
+                                     models, other models use `sklearn` for predictions
+        @param check_linear_predictor: check that the predictions of the `LinearSVMPredictor` are the same as the
+                                       model, on a sample of its support vectors (or random features)
+        """
+        self.use_linear_predictor = use_linear_predictor
+        self.check_linear_predictor = check_linear_predictor
+        self.model = None
+        self.linear_predictor = None
+        # identifies the loaded model, so that results computed with another model are not used
+        self.fingerprint = None
+
         if svm_pickle_filename:
-            svm_pickle_file = open(svm_pickle_filename, 'rb')
-            self.model = pickle.load(svm_pickle_file)
-        else:
-            self.model = None
+            self.import_from_pickle(svm_pickle_filename)
 
     def import_from_pickle(self, svm_pickle_filename):
         assert svm_pickle_filename, "svm_pickle_filename must not be None"
 
         with open(svm_pickle_filename, 'rb') as svm_pickle_file:
-            self.model = pickle.load(svm_pickle_file)
+            model_data = svm_pickle_file.read()
+
+        self.__set_model(pickle.loads(model_data), sha256(model_data).hexdigest())
 
     def train_new_model(self, classification_dataset_dir, augmentation_count=10):
         model, score = train_svm_model(classification_dataset_dir,
@@ -27,16 +45,57 @@ class SVMClassifier:
 
         print(f'[LOG] trained a new model, with score = {score}')
 
+        self.__set_model(model, sha256(pickle.dumps(model)).hexdigest())
+
+    def __set_model(self, model, fingerprint: str):
         self.model = model
+        self.fingerprint = fingerprint
+
+        self.linear_predictor = None
+
+        if self.use_linear_predictor:
+            try:
+                linear_predictor = LinearSVMPredictor.from_model(model)
+                if self.check_linear_predictor:
+                    linear_predictor.check_consistency(model, max_samples=256)
+            except (ValueError, InconsistentPredictorException) as e:
+                print(f'[WARN] could not use the linear predictor, using the model for predictions: {e}')
+            else:
+                self.linear_predictor = linear_predictor
+
+    def __predict(self, imgs_features):
+        if self.linear_predictor is not None:
+            return self.linear_predictor.predict(imgs_features)
+
+        return self.model.predict(imgs_features)
 
     def predict_label(self, img: Image) -> str:
         if not self.model:
             raise Exception('There is no model, train a new model or import one from pickle')
         features = extract_hog_features(img)
-        return self.model.predict([features])[0]
+        return self.__predict([features])[0]
 
     def predict_labels(self, imgs: List['Image']) -> List[str]:
         if not self.model:
             raise Exception('There is no model, train a new model or import one from pickle')
-        imgs_features = [extract_hog_features(img) for img in imgs]
-        return self.model.predict(imgs_features)
+        normalized_imgs = np.zeros((len(imgs), 128, 128), dtype=np.uint8)
+        for i, img in enumerate(imgs):
+            normalized_imgs[i] = normalize_image(np.asarray(img))
+
+        return self.__predict(extract_hog_features_batch(normalized_imgs))
+
+    def predict_crop_masks_labels(self, crop_masks: List[CropMask]) -> List[str]:
+        """
+        Same as `predict_labels`, but for symbols already isolated by the segmenter, which skips segmenting them again
+        """
+        if not self.model:
+            raise Exception('There is no model, train a new model or import one from pickle')
+        return self.__predict(extract_crop_masks_hog_features(crop_masks))
+
+    def predict_features_labels(self, features: np.ndarray) -> List[str]:
+        """
+        Predicts the labels of already extracted `hog` features, of shape `(N, features_count)`
+        """
+        if not self.model:
+            raise Exception('There is no model, train a new model or import one from pickle')
+        return self.__predict(features)
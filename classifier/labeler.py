@@ -1,13 +1,19 @@
-from typing import List
+from typing import List, Tuple
 
 from PIL import ImageDraw, ImageFont
 
-from segmenter.symbol_segmenter import segment_image
+from segmenter.crop_mask import CropMask
+from segmenter.symbol_segmenter import segment_image_crop_masks
 from segmenter.utils import is_another_in_between
 from utils.types import LabeledCrops, LabelCrop, Box
 from .classifier import SVMClassifier
 
 
+class NoSymbolsException(Exception):
+    def __init__(self):
+        super().__init__("No symbols were found in the image")
+
+
 def draw_labeled_crops(img, labeled_crops):
     labeled_img = img.copy()
     labeled_img = labeled_img.convert('RGB')
@@ -98,10 +104,32 @@ def __fix_frac_symbols(labeled_crops: LabeledCrops) -> LabeledCrops:
 
 
 def get_labeled_crops(img, svm_model: SVMClassifier) -> LabeledCrops:
-    crops_images = segment_image(img)
-    crops, cropped_images = list(zip(*crops_images))
+    crops_masks = segment_image_crop_masks(img)
+
+    return get_labeled_crops_from_crop_masks(crops_masks, svm_model)
+
+
+def get_labeled_crops_from_crop_masks(crops_masks: List[Tuple[Box, CropMask]], svm_model: SVMClassifier) -> \
+        LabeledCrops:
+    """
+    Same as `get_labeled_crops`, but for an image that is already segmented
+    """
+    if not crops_masks:
+        raise NoSymbolsException()
 
-    predicted_labels: List[str] = svm_model.predict_labels(cropped_images)
+    crops, crop_masks = list(zip(*crops_masks))
+
+    predicted_labels: List[str] = svm_model.predict_crop_masks_labels(crop_masks)
+
+    return get_labeled_crops_from_predictions(crops, predicted_labels)
+
+
+def get_labeled_crops_from_predictions(crops: List[Box], predicted_labels: List[str]) -> LabeledCrops:
+    """
+    Builds the labeled crops of an image from the labels predicted for its crops (in the same order)
+    """
+    if not crops:
+        raise NoSymbolsException()
 
     labeled_crops = __sort_labeled_crops(list(zip(predicted_labels, crops)))
 
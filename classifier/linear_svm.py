@@ -0,0 +1,141 @@
+import pickle
+from typing import Optional
+
+import numpy as np
+
+
+class InconsistentPredictorException(Exception):
+    def __init__(self, mismatches_count, samples_count):
+        super().__init__(f"The linear predictor does not match the model predictions in {mismatches_count} out of "
+                         f"{samples_count} samples")
+
+
+class LinearSVMPredictor:
+    """
+    Compact predictor for `sklearn.svm.SVC(kernel='linear')` models, and for one-vs-rest linear models like
+    `sklearn.linear_model.SGDClassifier`.
+
+    The `SVC` model is one-vs-one, it has a binary classifier for every pair of classes, since the kernel is linear,
+    every binary classifier is only a weight vector and a bias, so all of them are computed with one matrix
+    multiplication, then the votes of all pairs are counted together.
+
+    A one-vs-rest model has a weight vector and a bias for every class (or only one for two classes), and the class
+    with the largest decision is predicted.
+    """
+
+    def __init__(self, classes: np.ndarray, coef: np.ndarray, intercept: np.ndarray,
+                 one_vs_rest: bool = False) -> None:
+        n_classes = len(classes)
+
+        if one_vs_rest:
+            n_classifiers = n_classes if n_classes > 2 else 1
+        else:
+            n_classifiers = n_classes * (n_classes - 1) // 2
+
+        assert coef.shape[0] == n_classifiers, f"expected {n_classifiers} binary classifiers, found {coef.shape[0]}"
+        assert intercept.shape == (n_classifiers,)
+
+        self.classes: np.ndarray = classes
+        self.one_vs_rest: bool = one_vs_rest
+        # transposed, so that `features @ weights` gives the decision of all pairs
+        self.weights: np.ndarray = np.ascontiguousarray(coef.T, dtype=np.float64)
+        self.bias: np.ndarray = np.asarray(intercept, dtype=np.float64)
+
+        # the pairs are ordered as (0, 1), (0, 2), ..., (0, n-1), (1, 2), ..., which is the same order `libsvm` uses,
+        # a positive decision votes for the first class of the pair, otherwise for the second (except for two classes,
+        # see `predict`)
+        self.first_classes, self.second_classes = np.triu_indices(n_classes, k=1)
+
+    @classmethod
+    def from_svc(cls, model) -> 'LinearSVMPredictor':
+        if getattr(model, 'kernel', None) != 'linear':
+            raise ValueError(f"only `SVC(kernel='linear')` models can be converted, found {model}")
+
+        return cls(np.asarray(model.classes_), np.asarray(model.coef_), np.asarray(model.intercept_))
+
+    @classmethod
+    def from_model(cls, model) -> 'LinearSVMPredictor':
+        """
+        Converts an `SVC(kernel='linear')` model, or a one-vs-rest linear model (`sklearn` linear classifiers like
+        `SGDClassifier` and `LinearSVC`)
+        """
+        if getattr(model, 'kernel', None) == 'linear':
+            return cls.from_svc(model)
+
+        # the linear classifiers of `sklearn` have no kernel, all of them are one-vs-rest
+        if not hasattr(model, 'kernel') and hasattr(model, 'coef_'):
+            return cls(np.asarray(model.classes_), np.asarray(model.coef_), np.asarray(model.intercept_),
+                       one_vs_rest=True)
+
+        raise ValueError(f"only `SVC(kernel='linear')` and linear models can be converted, found {model}")
+
+    def decision_function(self, features: np.ndarray) -> np.ndarray:
+        return np.asarray(features, dtype=np.float64) @ self.weights + self.bias
+
+    def predict(self, features) -> np.ndarray:
+        features = np.asarray(features, dtype=np.float64)
+
+        if len(features) == 0:
+            return self.classes[:0]
+
+        n_samples = len(features)
+        n_classes = len(self.classes)
+
+        decision = self.decision_function(features)
+
+        # with two classes, both `SVC` and one-vs-rest models have only one classifier, `sklearn` flips its sign for
+        # `SVC`, so for both of them a positive decision is the second class
+        if n_classes == 2:
+            return self.classes[(decision[:, 0] > 0).astype(np.int64)]
+
+        if self.one_vs_rest:
+            return self.classes[np.argmax(decision, axis=1)]
+
+        positive = decision > 0
+        voted_classes = np.where(positive, self.first_classes, self.second_classes)
+
+        # count the votes of all samples at once, by giving each sample its own range of classes
+        voted_classes += (np.arange(n_samples) * n_classes)[:, None]
+        votes = np.bincount(voted_classes.ravel(), minlength=n_samples * n_classes).reshape(n_samples, n_classes)
+
+        # `argmax` picks the first class when there is a tie in votes, which is the same as `libsvm`
+        return self.classes[np.argmax(votes, axis=1)]
+
+    def check_consistency(self, model, features: Optional[np.ndarray] = None,
+                          max_samples: Optional[int] = None) -> None:
+        """
+        Makes sure that this predictor gives the same predictions as `model.predict`, if `features` is not
+        specified, the support vectors of the model are used, or random features for models without support vectors
+
+        @param max_samples: if specified, only this number of samples are checked, spread evenly over `features`
+        """
+        if features is None:
+            if hasattr(model, 'support_vectors_'):
+                features = model.support_vectors_
+            else:
+                features = np.random.RandomState(0).rand(max_samples or 256, self.weights.shape[0])
+
+        if max_samples is not None and len(features) > max_samples:
+            features = features[np.linspace(0, len(features) - 1, max_samples).astype(np.int64)]
+
+        expected = model.predict(features)
+        predicted = self.predict(features)
+
+        mismatches_count = int(np.sum(expected != predicted))
+        if mismatches_count:
+            raise InconsistentPredictorException(mismatches_count, len(features))
+
+
+def load_linear_svm_predictor(svm_pickle_filename: str, check_consistency: bool = True) -> LinearSVMPredictor:
+    """
+    Loads a pickled `SVC(kernel='linear')` or linear model and converts it into a `LinearSVMPredictor`
+    """
+    with open(svm_pickle_filename, 'rb') as svm_pickle_file:
+        model = pickle.load(svm_pickle_file)
+
+    predictor = LinearSVMPredictor.from_model(model)
+
+    if check_consistency:
+        predictor.check_consistency(model)
+
+    return predictor
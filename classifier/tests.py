@@ -1,9 +1,21 @@
+import pickle
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from tempfile import TemporaryDirectory
 
+import numpy as np
 from PIL import Image
+from skimage.feature import hog
+from sklearn.svm import SVC
 
+from utils.dataset_shard import DatasetShard, DatasetShardWriter, DATASET_SHARD_FILENAME
+from .batcher import ClassificationBatcher
 from .classifier import SVMClassifier
 from .labeler import get_labeled_crops
+from .linear_svm import LinearSVMPredictor
+from .trainer import generate_features_dataset, train_linear_model_streaming
+from .utils import extract_hog_features_batch, normalize_image
 
 
 class ClassifierTestCase(unittest.TestCase):
@@ -43,6 +55,53 @@ class ClassifierTestCase(unittest.TestCase):
                              [('\\int', (18, 35, 79, 188)), ('-', (57, 178, 90, 181)), ('-', (88, 38, 121, 41)),
                               ('3', (99, 159, 121, 193)), ('3', (129, 19, 151, 53))])
 
+    def test_linear_predictor(self):
+        """
+        This tests that using the compiled linear predictor gives the same labels as the `sklearn` model
+        """
+        linear_model = SVMClassifier('./model/svm.pkl', use_linear_predictor=True)
+
+        for filename in ['normal_fraction.png', 'only_down_no_frac.png', 'dot_on_frac.png']:
+            img = Image.open(f'./testing_dataset/{filename}')
+
+            self.assertListEqual(get_labeled_crops(img, linear_model), get_labeled_crops(img, self.model))
+
+    def test_classification_batcher(self):
+        """
+        This tests that concurrent requests classified together by the batcher get the same labels as classifying
+        each request alone
+        """
+        batcher = ClassificationBatcher(self.model, max_wait_ms=200)
+        filenames = ['normal_fraction.png', 'only_down_no_frac.png', 'dot_on_frac.png', 'normal_subtract.png']
+        imgs = [Image.open(f'./testing_dataset/{filename}') for filename in filenames]
+
+        with ThreadPoolExecutor(max_workers=len(imgs)) as executor:
+            batched_labeled_crops = list(executor.map(lambda img: get_labeled_crops(img, batcher), imgs))
+
+        for img, labeled_crops in zip(imgs, batched_labeled_crops):
+            self.assertListEqual(labeled_crops, get_labeled_crops(img, self.model))
+
+        stats = batcher.stats()
+        self.assertEqual(stats['requests'], len(imgs))
+        self.assertLess(stats['batches'], len(imgs))
+
+    def test_dataset_shard_labels(self):
+        """
+        This tests that the images of a dataset shard get the same labels as the original images
+        """
+        img = Image.open('./testing_dataset/normal_fraction.png')
+
+        with TemporaryDirectory() as dataset_dir:
+            shard_filename = path.join(dataset_dir, DATASET_SHARD_FILENAME)
+
+            with DatasetShardWriter(shard_filename) as writer:
+                writer.add('normal_fraction.png', '0', img)
+
+            shard = DatasetShard(shard_filename)
+
+            # the labels of all the crops should be the same
+            self.assertListEqual(get_labeled_crops(shard.get_image(0), self.model), get_labeled_crops(img, self.model))
+
     def label_img(self, url):
         img = Image.open(url)
 
@@ -51,5 +110,152 @@ class ClassifierTestCase(unittest.TestCase):
         return labeled_crops
 
 
+class ClassifierFeaturesTestCase(unittest.TestCase):
+    """
+    Tests that do not need the trained model
+    """
+
+    def test_hog_features_batch(self):
+        """
+        This tests that the batched `hog` features are exactly the same as `skimage` features
+        """
+        imgs = [normalize_image(np.asarray(Image.open(f'./testing_dataset/{filename}').convert('L')))
+                for filename in ['normal_fraction.png', 'normal_subtract.png', 'only_down_no_frac.png']]
+        imgs.append(np.random.RandomState(0).randint(0, 256, (128, 128), dtype=np.uint8))
+
+        expected = [hog(img, orientations=8, pixels_per_cell=(16, 16), cells_per_block=(1, 1)) for img in imgs]
+
+        np.testing.assert_array_equal(extract_hog_features_batch(np.stack(imgs)), np.stack(expected))
+
+    def test_dataset_shard(self):
+        """
+        This tests that the images of a dataset shard are the same as the original images
+        """
+        filenames = ['normal_fraction.png', 'only_down_no_frac.png', 'dot_on_frac.png', 'normal_subtract.png']
+        imgs = [Image.open(f'./testing_dataset/{filename}') for filename in filenames]
+
+        with TemporaryDirectory() as dataset_dir:
+            shard_filename = path.join(dataset_dir, DATASET_SHARD_FILENAME)
+
+            with DatasetShardWriter(shard_filename) as writer:
+                for i, img in enumerate(imgs):
+                    writer.add(filenames[i], str(i), img)
+
+            shard = DatasetShard(shard_filename)
+
+            self.assertEqual(len(shard), len(imgs))
+            self.assertListEqual(shard.names, filenames)
+            self.assertListEqual(shard.labels, [str(i) for i in range(len(imgs))])
+
+            for filename, img in zip(filenames, imgs):
+                shard_img = shard.get_image_by_name(filename)
+                self.assertEqual(shard_img.size, img.size)
+                self.assertTrue(np.array_equal(np.asarray(shard_img), np.asarray(img.convert('1'))))
+
+    def test_parallel_features_dataset(self):
+        """
+        This tests that the features of the augmented dataset are the same for any number of jobs
+        """
+        filenames = ['normal_fraction.png', 'only_down_no_frac.png', 'dot_on_frac.png', 'normal_subtract.png']
+
+        with TemporaryDirectory() as dataset_dir:
+            with DatasetShardWriter(path.join(dataset_dir, DATASET_SHARD_FILENAME)) as writer:
+                for i, filename in enumerate(filenames):
+                    writer.add(filename, str(i), Image.open(f'./testing_dataset/{filename}'))
+
+            dataset = generate_features_dataset(dataset_dir, 2, augmentation_seed=1, jobs=1)
+            parallel_dataset = generate_features_dataset(dataset_dir, 2, augmentation_seed=1, jobs=3)
+
+        self.assertEqual(len(dataset), len(filenames) * 3)
+        self.assertListEqual(list(dataset.expr), ['0', '1', '2', '3', '0', '0', '1', '1', '2', '2', '3', '3'])
+        self.assertListEqual(list(parallel_dataset.expr), list(dataset.expr))
+        self.assertTrue(np.array_equal(np.stack(parallel_dataset.hog_feature), np.stack(dataset.hog_feature)))
+
+    def test_streaming_training(self):
+        """
+        This tests that the streaming training gives the same model every time with the same seed
+        """
+        filenames = ['normal_fraction.png', 'only_down_no_frac.png', 'dot_on_frac.png', 'normal_subtract.png',
+                     'normal_fraction.png']
+
+        with TemporaryDirectory() as dataset_dir:
+            with DatasetShardWriter(path.join(dataset_dir, DATASET_SHARD_FILENAME)) as writer:
+                for i, filename in enumerate(filenames):
+                    writer.add(filename, str(i % 2), Image.open(f'./testing_dataset/{filename}'))
+
+            model, score = train_linear_model_streaming(dataset_dir, 2, epochs=2, batch_size=4, augmentation_seed=1)
+            same_model, same_score = train_linear_model_streaming(dataset_dir, 2, epochs=2, batch_size=4,
+                                                                  augmentation_seed=1)
+
+        self.assertListEqual(list(model.classes_), ['0', '1'])
+        self.assertTrue(0 <= score <= 1)
+        self.assertEqual(score, same_score)
+        self.assertTrue(np.array_equal(model.coef_, same_model.coef_))
+
+    def test_streaming_model_linear_predictor(self):
+        """
+        This tests that the model of the streaming training can be loaded with the linear predictor, and gives the
+        same labels as the `sklearn` model
+        """
+        filenames = ['normal_fraction.png', 'only_down_no_frac.png', 'dot_on_frac.png', 'normal_subtract.png',
+                     'normal_fraction.png', 'dot_on_frac.png']
+        imgs = [Image.open(f'./testing_dataset/{filename}') for filename in filenames]
+
+        with TemporaryDirectory() as dataset_dir:
+            with DatasetShardWriter(path.join(dataset_dir, DATASET_SHARD_FILENAME)) as writer:
+                for i, img in enumerate(imgs):
+                    writer.add(filenames[i], str(i % 3), img)
+
+            model, _score = train_linear_model_streaming(dataset_dir, 1, epochs=1, batch_size=4, augmentation_seed=1)
+
+            model_filename = path.join(dataset_dir, 'svm.pkl')
+            with open(model_filename, 'wb') as f:
+                pickle.dump(model, f)
+
+            linear_model = SVMClassifier(model_filename, use_linear_predictor=True)
+
+        self.assertIsNotNone(linear_model.linear_predictor)
+
+        features = extract_hog_features_batch(
+            np.stack([normalize_image(np.asarray(img.convert('L'))) for img in imgs]))
+        self.assertListEqual(list(linear_model.predict_features_labels(features)), list(model.predict(features)))
+
+    def test_linear_predictor_svc(self):
+        """
+        This tests that `LinearSVMPredictor` gives the same labels as `SVC(kernel='linear')` models, including binary
+        models where `sklearn` flips the sign of the decision
+        """
+        random_state = np.random.RandomState(0)
+
+        for n_classes in (2, 3, 10, 30):
+            features = random_state.rand(n_classes * 5, 64)
+            labels = np.array([f'class{i}' for i in range(n_classes)] * 5)
+            test_features = random_state.rand(200, 64)
+
+            model = SVC(kernel='linear').fit(features, labels)
+            predictor = LinearSVMPredictor.from_svc(model)
+
+            self.assertListEqual(list(predictor.predict(features)), list(model.predict(features)))
+            self.assertListEqual(list(predictor.predict(test_features)), list(model.predict(test_features)))
+
+    def test_linear_predictor_fallback(self):
+        """
+        This tests that a model that cannot be converted into a `LinearSVMPredictor` is used for predictions instead
+        """
+        features = np.random.RandomState(0).rand(20, 512)
+        labels = np.array(['a', 'b'] * 10)
+        model = SVC(kernel='rbf').fit(features, labels)
+
+        with TemporaryDirectory() as model_dir:
+            model_filename = path.join(model_dir, 'svm.pkl')
+            with open(model_filename, 'wb') as f:
+                pickle.dump(model, f)
+
+            classifier = SVMClassifier(model_filename, use_linear_predictor=True)
+
+        self.assertIsNone(classifier.linear_predictor)
+        self.assertListEqual(list(classifier.predict_features_labels(features)), list(model.predict(features)))
+
+
 if __name__ == '__main__':
     unittest.main()
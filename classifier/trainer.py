@@ -1,73 +1,268 @@
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from hashlib import sha256
+from multiprocessing.shared_memory import SharedMemory
 from os import path
 
 import albumentations
 import numpy as np
 import pandas as pd
-from PIL import Image, ImageOps
-from skimage.feature import hog
+from PIL import Image
 from sklearn.metrics import accuracy_score
 from sklearn.model_selection import train_test_split
+from sklearn.linear_model import SGDClassifier
 from sklearn.svm import SVC
 from tqdm import tqdm
 
-from segmenter.symbol_segmenter import segment_image
-from utils.image import img_to_binary
+from utils.dataset_shard import DatasetShard, dataset_shard_path
+from .utils import extract_hog_features_batch, normalize_image, HOG_BATCH_SIZE, HOG_ORIENTATIONS, HOG_PIXELS_PER_CELL
 
 
-def generate_image_augmentation(image, count):
+def generate_image_augmentation(image, count, seed=None):
+    """
+    @param seed: if specified, the same images are always generated
+    """
+    if seed is not None:
+        # the transforms of `albumentations` use both
+        random.seed(seed)
+        np.random.seed(seed)
+
     transform = albumentations.Compose([
         albumentations.RandomScale(),
         albumentations.Rotate(limit=(-15, 15)),
         albumentations.Blur(blur_limit=5),
     ])
 
+    # newer versions of `albumentations` have their own random generator
+    if seed is not None and hasattr(transform, 'set_random_seed'):
+        transform.set_random_seed(seed)
+
     return [transform(image=image)['image'] for _ in range(count)]
 
 
-def generate_features_dataset(classification_dataset_dir, augmentation_cont, progress=False):
+# the threshold used to convert the dataset images into binary images before normalizing them, it is higher than the
+# default threshold of `img_to_binary`
+TRAINING_BINARY_MIN_VALUE = 150
+
+
+def __read_dataset_metadata(classification_dataset_dir):
+    """
+    @return: `DataFrame` of the `expr` and `base_filename` of every image, and the filename of the shard of the
+             dataset or None if it is not packed
+    """
+    shard_filename = dataset_shard_path(classification_dataset_dir)
+
+    if shard_filename is not None:
+        # packed dataset, all the images are in one file
+        shard = DatasetShard(shard_filename)
+        return pd.DataFrame({'expr': shard.labels, 'base_filename': shard.names}, dtype=str), shard_filename
+
+    metadata_file = path.join(classification_dataset_dir, 'metadata.csv')
+
+    if not path.isfile(metadata_file):
+        raise FileNotFoundError(metadata_file)
+
+    dataset = pd.read_csv(metadata_file, header=None, dtype=str)
+    dataset.columns = ['expr', 'base_filename']
+
+    return dataset, None
+
+
+def __read_dataset_image(classification_dataset_dir, shard, i, base_filename):
+    """
+    @param shard: the `DatasetShard` of the dataset, or None to read the PNG file of the image
+    @return: the image `i` of the dataset as a gray scale array
+    """
+    if shard is not None:
+        return np.asarray(shard.get_image(i).convert('L'))
+
+    filename = path.join(classification_dataset_dir, f'{base_filename}.png')
+
+    return np.asarray(Image.open(filename).convert('L'))
+
+
+def __derive_seed(*values):
+    """
+    @return: a seed that depends on all the values, and is very different for close values
+    """
+    return int(np.random.SeedSequence(list(values)).generate_state(1)[0])
+
+
+def __normalized_images(classification_dataset_dir, shard, i, base_filename, augmentation_count, seed):
+    """
+    @return: the normalized image `i` of the dataset followed by its `augmentation_count` normalized augmentations,
+             which are seeded from `seed` and `i`
+    """
+    raw_image = __read_dataset_image(classification_dataset_dir, shard, i, base_filename)
+
+    normalized_images = [normalize_image(raw_image, binary_min_value=TRAINING_BINARY_MIN_VALUE)]
+
+    if augmentation_count:
+        augmented_images = generate_image_augmentation(raw_image, augmentation_count, __derive_seed(seed, i))
+        normalized_images.extend(normalize_image(augmented_image, binary_min_value=TRAINING_BINARY_MIN_VALUE)
+                                 for augmented_image in augmented_images)
+
+    return normalized_images
+
+
+# the shards opened in a worker process of `__generate_features_dataset_parallel`, so the names and labels of the
+# shard are not parsed again for every chunk
+__worker_shards = dict()
+
+
+def __extract_features_chunk(classification_dataset_dir, shard_filename, start, base_filenames, augmentation_count,
+                             seed, features_memory_name, features_shape):
+    """
+    Runs in a worker process, computes the features of the images `start` to `start + len(base_filenames)` and of
+    their augmentations, and writes them into their rows of the shared features matrix: the row of image `i` is `i`,
+    and the rows of its augmentations start from `images_count + i * augmentation_count`.
+
+    The augmentation of every image is seeded from `seed` and the index of the image, so the features do not depend
+    on which worker or chunk processed the image.
+    """
+    shard = None
+    if shard_filename is not None:
+        if shard_filename not in __worker_shards:
+            __worker_shards[shard_filename] = DatasetShard(shard_filename)
+        shard = __worker_shards[shard_filename]
+
+    images_count = features_shape[0] // (augmentation_count + 1)
+
+    rows = []
+    normalized_images = []
+    for i, base_filename in enumerate(base_filenames, start):
+        rows.append(i)
+        rows.extend(images_count + i * augmentation_count + j for j in range(augmentation_count))
+        normalized_images.extend(__normalized_images(classification_dataset_dir, shard, i, base_filename,
+                                                     augmentation_count, seed))
+
+    features_memory = SharedMemory(name=features_memory_name)
+    try:
+        features = np.ndarray(features_shape, dtype=np.float64, buffer=features_memory.buf)
+        features[rows] = extract_hog_features_batch(np.stack(normalized_images))
+        del features
+    finally:
+        features_memory.close()
+
+    return len(base_filenames)
+
+
+def __generate_features_dataset_parallel(classification_dataset_dir, dataset, shard_filename, augmentation_count,
+                                         jobs, progress, augmentation_seed):
+    """
+    `generate_features_dataset` using `jobs` processes, every process gets chunks of images indices, and writes the
+    `hog` features of the images (and their augmentations) directly into a features matrix in shared memory, so only
+    the indices and names are sent to the processes and nothing is sent back.
+
+    @return: `DataFrame` of `expr`, `base_filename` and `hog_feature`, without the images
+    """
+    assert jobs > 0, "jobs must be positive"
+
+    images_count = len(dataset)
+
+    # if we don't have a lot of data, then augment
+    if images_count >= 1000 or not augmentation_count:
+        augmentation_count = 0
+
+    if augmentation_seed is None:
+        augmentation_seed = random.getrandbits(64)
+
+    features_count = (128 // HOG_PIXELS_PER_CELL) ** 2 * HOG_ORIENTATIONS
+    features_shape = (images_count * (augmentation_count + 1), features_count)
+
+    # small chunks, so the work is spread evenly even if some images take more time
+    chunk_size = max(1, min(64, images_count // (jobs * 8)))
+    base_filenames = list(dataset.base_filename)
+
+    tqdm_feature_extraction = None
+    if progress:
+        tqdm_feature_extraction = tqdm(total=images_count)
+        tqdm_feature_extraction.set_description(f"Extracting features ({jobs} jobs)")
+
+    features_memory = SharedMemory(create=True, size=max(1, features_shape[0] * features_shape[1] * 8))
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(__extract_features_chunk, classification_dataset_dir, shard_filename, start,
+                                       base_filenames[start:start + chunk_size], augmentation_count,
+                                       augmentation_seed, features_memory.name, features_shape)
+                       for start in range(0, images_count, chunk_size)]
+
+            for future in as_completed(futures):
+                chunk_images_count = future.result()
+                if progress:
+                    tqdm_feature_extraction.update(chunk_images_count)
+
+        features = np.ndarray(features_shape, dtype=np.float64, buffer=features_memory.buf).copy()
+    finally:
+        features_memory.close()
+        features_memory.unlink()
+
+    if progress:
+        tqdm_feature_extraction.close()
+
+    augmented_dataset = pd.DataFrame({'expr': np.repeat(dataset.expr.values, augmentation_count)})
+    dataset = pd.concat([dataset, augmented_dataset], ignore_index=True)
+    dataset['hog_feature'] = list(features)
+
+    return dataset
+
+
+def generate_features_dataset(classification_dataset_dir, augmentation_cont, progress=False, augmentation_seed=None,
+                              jobs=None):
     """
     Parse the dataset in the input directory and extract `hog` features from them, also if the dataset is small
     it will add more elements using augmentation
+
+    The images are read from the shard of the dataset if it has one (see `utils.dataset_shard`), otherwise from the
+    PNG files listed in `metadata.csv`
+
+    @param augmentation_seed: if specified, the augmented images are always the same
+    @param jobs: if specified, the images are processed by this number of processes, and the returned `DataFrame`
+                 only has the `expr`, `base_filename` and `hog_feature` columns. The augmentation of every image is
+                 seeded on its own, so the features are the same for any number of jobs, but not the same as
+                 without `jobs`
     """
     if not path.exists(classification_dataset_dir):
         raise FileNotFoundError(classification_dataset_dir)
     if not path.isdir(classification_dataset_dir):
         raise Exception(f"{classification_dataset_dir} is found but it is a file and not a directory")
 
+    dataset, shard_filename = __read_dataset_metadata(classification_dataset_dir)
+
+    if jobs is not None:
+        return __generate_features_dataset_parallel(classification_dataset_dir, dataset, shard_filename,
+                                                    augmentation_cont, jobs, progress, augmentation_seed)
+
     tqdm_reading_images = None
     tqdm_augmentation = None
     tqdm_preprocessing = None
     tqdm_feature_extraction = None
 
-    metadata_file = path.join(classification_dataset_dir, 'metadata.csv')
-
-    if not path.isfile(metadata_file):
-        raise FileNotFoundError(metadata_file)
-
-    # read the dataset
-    dataset = pd.read_csv(metadata_file, header=None, dtype=str)
-    dataset.columns = ['expr', 'base_filename']
-
     if progress:
         tqdm_reading_images = tqdm(total=len(dataset))
         tqdm_reading_images.set_description("Reading images")
 
-    # helper to get images of all files
-    def get_image(base_filename):
+    shard = DatasetShard(shard_filename) if shard_filename is not None else None
+
+    raw_images = []
+    for i, base_filename in enumerate(dataset.base_filename):
+        raw_images.append(__read_dataset_image(classification_dataset_dir, shard, i, base_filename))
         if progress:
             tqdm_reading_images.update(1)
 
-        filename = path.join(classification_dataset_dir, f'{base_filename}.png')
-
-        return np.asarray(Image.open(filename).convert('L'))
-
-    dataset['raw_image'] = dataset.base_filename.map(get_image)
+    dataset['raw_image'] = raw_images
 
     if progress:
         tqdm_reading_images.close()
 
     # if we don't have a lot of data, then augment
     if len(dataset) < 1000:
+        if augmentation_seed is not None:
+            # the transforms of `albumentations` use both
+            random.seed(augmentation_seed)
+            np.random.seed(augmentation_seed)
+
         if progress:
             tqdm_augmentation = tqdm(total=len(dataset))
             tqdm_augmentation.set_description("Augmenting images")
@@ -98,87 +293,141 @@ def generate_features_dataset(classification_dataset_dir, augmentation_cont, pro
         tqdm_preprocessing = tqdm(total=len(dataset))
         tqdm_preprocessing.set_description("Preprocessing images")
 
-    # convert to a size similar across all images
-    def normalize_image(img_array):
+    def normalize_dataset_image(img_array):
         if progress:
             tqdm_preprocessing.update(1)
-        img = img_to_binary(Image.fromarray(img_array), min_value=150)
 
-        crops_images = segment_image(img)
-        crops, cropped_images = list(zip(*crops_images))
+        return normalize_image(img_array, binary_min_value=TRAINING_BINARY_MIN_VALUE)
 
-        if len(crops) != 1:
-            # FIXME: manual crop, since only one symbol per picture
-            w, h = img.size
+    dataset['normalized_image'] = dataset.raw_image.map(normalize_dataset_image)
+    if progress:
+        tqdm_preprocessing.close()
 
-            img_arr = np.asarray(img)
+    if progress:
+        tqdm_feature_extraction = tqdm(total=len(dataset))
+        tqdm_feature_extraction.set_description("Feature extraction")
 
-            left, top, right, down = 1000, 1000, -1000, -1000
+    # the features of all images are computed together, which is a lot faster than one image at a time
+    normalized_images = np.stack(dataset.normalized_image)
+    hog_features = []
+    for batch_start in range(0, len(normalized_images), HOG_BATCH_SIZE):
+        batch = normalized_images[batch_start:batch_start + HOG_BATCH_SIZE]
+        hog_features.extend(extract_hog_features_batch(batch))
+        if progress:
+            tqdm_feature_extraction.update(len(batch))
 
-            for x in range(w):
-                for y in range(h):
-                    # black
-                    if not img_arr[y, x]:
-                        if y > down:
-                            down = y
-                        if y < top:
-                            top = y
-                        if x > right:
-                            right = x
-                        if x < left:
-                            left = x
+    dataset['hog_feature'] = hog_features
 
-            crop = (left, top, right + 1, down + 1)
-            cropped_images = [img.crop(crop)]
+    if progress:
+        tqdm_feature_extraction.close()
 
-        cropped_img = cropped_images[0]
+    return dataset
 
-        w, h = cropped_img.size
-        resize_ratio = min(128 / w, 128 / h)
 
-        resized_img = cropped_img.resize((int(resize_ratio * w), int(resize_ratio * h)))
+class CachedFeaturesDataset:
+    """
+    Features and labels of a dataset stored in `.npy` files by `generate_features_dataset_cached`, the files are
+    only loaded (memory mapped) when they are used
+    """
 
-        gray_img = resized_img.convert('L')
-        inverted_gray_image = ImageOps.invert(gray_img)
-        w, h = inverted_gray_image.size
+    def __init__(self, features_filename, labels_filename):
+        self.features_filename = features_filename
+        self.labels_filename = labels_filename
+        self.__features = None
+        self.__labels = None
 
-        final_img = Image.new('L', (128, 128))
-        final_img.paste(inverted_gray_image, ((128 - w) // 2, (128 - h) // 2))
+    @property
+    def features(self):
+        if self.__features is None:
+            self.__features = np.load(self.features_filename, mmap_mode='r')
 
-        return np.asarray(final_img)
+        return self.__features
 
-    dataset['normalized_image'] = dataset.raw_image.map(normalize_image)
-    if progress:
-        tqdm_preprocessing.close()
+    @property
+    def labels(self):
+        if self.__labels is None:
+            self.__labels = np.load(self.labels_filename, mmap_mode='r')
 
-    if progress:
-        tqdm_feature_extraction = tqdm(total=len(dataset))
-        tqdm_feature_extraction.set_description("Feature extraction")
+        return self.__labels
 
-    def get_hog_image_and_feature(img):
-        if progress:
-            tqdm_feature_extraction.update(1)
-        fd, hog_image = hog(img, orientations=8, pixels_per_cell=(16, 16),
-                            cells_per_block=(1, 1), visualize=True)
 
-        return hog_image, fd
+# increase when the preprocessing or the features change, so old cached features are not used
+FEATURES_CACHE_VERSION = 1
 
-    dataset[['hog_image', 'hog_feature']] = pd.DataFrame(
-        dataset.normalized_image.map(get_hog_image_and_feature).to_list())
 
-    if progress:
-        tqdm_feature_extraction.close()
+def features_dataset_cache_key(classification_dataset_dir, augmentation_count, augmentation_seed=None, jobs=None):
+    """
+    @return: hash of everything the features of `generate_features_dataset` depend on: the content of the dataset,
+             the augmentation and the `hog` parameters
+    """
+    dataset_hash = sha256()
 
-    return dataset
+    shard_filename = dataset_shard_path(classification_dataset_dir)
+    metadata_filename = path.join(classification_dataset_dir, 'metadata.csv')
+
+    if shard_filename is not None:
+        filenames = [shard_filename]
+    else:
+        dataset = pd.read_csv(metadata_filename, header=None, dtype=str)
+        filenames = [metadata_filename] + [path.join(classification_dataset_dir, f'{base_filename}.png')
+                                           for base_filename in dataset[1]]
+
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                dataset_hash.update(chunk)
+
+    # the augmentation is seeded differently with `jobs`, but it does not depend on the number of jobs
+    parameters = [FEATURES_CACHE_VERSION, augmentation_count, augmentation_seed, jobs is not None, HOG_ORIENTATIONS,
+                  HOG_PIXELS_PER_CELL]
+    dataset_hash.update(repr(parameters).encode())
+
+    return dataset_hash.hexdigest()
+
+
+def generate_features_dataset_cached(classification_dataset_dir, augmentation_count, cache_dir, progress=False,
+                                     augmentation_seed=None, jobs=None):
+    """
+    Same as `generate_features_dataset`, but the features and labels are saved in `cache_dir`, and used again the next
+    time the same dataset is used with the same parameters, instead of preprocessing it again.
+
+    If `augmentation_seed` is None, the augmented images are random, but the cached ones are used again.
+
+    @return: `CachedFeaturesDataset` that can be used with `train_svm_model_from_features_dataset`
+    """
+    key = features_dataset_cache_key(classification_dataset_dir, augmentation_count, augmentation_seed, jobs)
+    features_filename = path.join(cache_dir, f'{key}_features.npy')
+    labels_filename = path.join(cache_dir, f'{key}_labels.npy')
+
+    if not path.isfile(features_filename) or not path.isfile(labels_filename):
+        dataset = generate_features_dataset(classification_dataset_dir, augmentation_count, progress,
+                                            augmentation_seed, jobs)
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # written to temporary files first, so a partially written file is never used
+        for filename, array in [(features_filename, np.stack(dataset.hog_feature)),
+                                (labels_filename, np.asarray(dataset.expr, dtype=str))]:
+            with open(filename + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(filename + '.tmp', filename)
+    elif progress:
+        print(f'Using cached features of {classification_dataset_dir} from {features_filename}')
+
+    return CachedFeaturesDataset(features_filename, labels_filename)
 
 
 def train_svm_model_from_features_dataset(dataset):
     """
     Will create a new svm model trained with the processed and extracted features dataset, which
-    can be generated from the function `generate_features_dataset`
+    can be generated from the function `generate_features_dataset` or `generate_features_dataset_cached`
     """
-    y = np.asarray(dataset.expr)
-    X = np.stack(dataset.hog_feature)
+    if isinstance(dataset, CachedFeaturesDataset):
+        y = np.asarray(dataset.labels, dtype=object)
+        X = dataset.features
+    else:
+        y = np.asarray(dataset.expr)
+        X = np.stack(dataset.hog_feature)
 
     X_train, X_test, y_train, y_test = train_test_split(X, y, random_state=100, test_size=0.2)
 
@@ -191,6 +440,113 @@ def train_svm_model_from_features_dataset(dataset):
     return model, score
 
 
+def __generate_features_batches(classification_dataset_dir, dataset, shard_filename, indices, augmentation_count,
+                                seed, batch_size):
+    """
+    Generates the features of the images `indices` of the dataset and of their augmentations, only about `batch_size`
+    images are in memory at any time.
+
+    @return: iterator of `(features, labels)` batches
+    """
+    shard = DatasetShard(shard_filename) if shard_filename is not None else None
+    expressions = dataset.expr.values
+    base_filenames = dataset.base_filename.values
+
+    normalized_images = []
+    labels = []
+    for i in indices:
+        images = __normalized_images(classification_dataset_dir, shard, i, base_filenames[i], augmentation_count, seed)
+        normalized_images.extend(images)
+        labels.extend([expressions[i]] * len(images))
+
+        if len(normalized_images) >= batch_size:
+            yield extract_hog_features_batch(np.stack(normalized_images)), np.asarray(labels, dtype=object)
+            normalized_images = []
+            labels = []
+
+    if normalized_images:
+        yield extract_hog_features_batch(np.stack(normalized_images)), np.asarray(labels, dtype=object)
+
+
+def train_linear_model_streaming(classification_dataset_dir, augmentation_count=10, epochs=5, batch_size=256,
+                                 progress=False, augmentation_seed=None):
+    """
+    Will create a new linear svm model (`SGDClassifier` with `hinge` loss) trained incrementally on batches of features
+    that are generated when they are needed, so the memory used does not depend on the size of the dataset or on
+    `augmentation_count`.
+
+    20% of the images are held out, the model is trained on the other images and their augmentations, which are new
+    in every epoch, and the score is computed on the held out images and their augmentations.
+
+    Unlike `generate_features_dataset`, the images are augmented even if the dataset is large.
+
+    @param augmentation_seed: if specified, the model is always the same
+    @return: the model and its score
+    """
+    if not path.exists(classification_dataset_dir):
+        raise FileNotFoundError(classification_dataset_dir)
+    if not path.isdir(classification_dataset_dir):
+        raise Exception(f"{classification_dataset_dir} is found but it is a file and not a directory")
+
+    assert epochs > 0, "epochs must be positive"
+    assert batch_size > 0, "batch_size must be positive"
+
+    dataset, shard_filename = __read_dataset_metadata(classification_dataset_dir)
+    augmentation_count = augmentation_count or 0
+
+    if augmentation_seed is None:
+        augmentation_seed = random.getrandbits(64)
+
+    train_indices, test_indices = train_test_split(np.arange(len(dataset)), random_state=100, test_size=0.2)
+    classes = np.unique(np.asarray(dataset.expr, dtype=object))
+    # the order of the samples in every epoch
+    shuffle_generator = np.random.default_rng(__derive_seed(augmentation_seed))
+
+    # the averaged weights are a lot more accurate than the last ones, after only a few epochs
+    model = SGDClassifier(loss='hinge', alpha=1e-5, average=True, random_state=100)
+
+    for epoch in range(epochs):
+        tqdm_training = None
+        if progress:
+            tqdm_training = tqdm(total=len(train_indices) * (augmentation_count + 1))
+            tqdm_training.set_description(f"Training epoch {epoch + 1}/{epochs}")
+
+        epoch_indices = shuffle_generator.permutation(train_indices)
+        for features, labels in __generate_features_batches(classification_dataset_dir, dataset, shard_filename,
+                                                            epoch_indices, augmentation_count,
+                                                            __derive_seed(augmentation_seed, epoch), batch_size):
+            # the augmentations of an image are next to each other
+            order = shuffle_generator.permutation(len(labels))
+            model.partial_fit(features[order], labels[order], classes=classes)
+
+            if progress:
+                tqdm_training.update(len(labels))
+
+        if progress:
+            tqdm_training.close()
+
+    tqdm_evaluation = None
+    if progress:
+        tqdm_evaluation = tqdm(total=len(test_indices) * (augmentation_count + 1))
+        tqdm_evaluation.set_description("Evaluating")
+
+    correct_count = 0
+    samples_count = 0
+    for features, labels in __generate_features_batches(classification_dataset_dir, dataset, shard_filename,
+                                                        test_indices, augmentation_count,
+                                                        __derive_seed(augmentation_seed, epochs), batch_size):
+        correct_count += np.count_nonzero(model.predict(features) == labels)
+        samples_count += len(labels)
+
+        if progress:
+            tqdm_evaluation.update(len(labels))
+
+    if progress:
+        tqdm_evaluation.close()
+
+    return model, correct_count / samples_count
+
+
 def train_svm_model(classification_dataset_dir, augmentation_count=10):
     """
     Will create a new svm model trained with the images data available in classification_dataset_dir
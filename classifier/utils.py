@@ -1,44 +1,46 @@
+from typing import List
+
 import numpy as np
 from PIL import Image, ImageOps
-from skimage.feature import hog
 
+from segmenter.crop_mask import CropMask
 from segmenter.symbol_segmenter import segment_image
 from utils.image import img_to_binary
 
+# parameters of the `hog` features used by the model
+HOG_ORIENTATIONS = 8
+HOG_PIXELS_PER_CELL = 16
+# number of images to compute `hog` features for at once, to limit the memory used
+HOG_BATCH_SIZE = 64
+
 
 # convert to a size similar across all images
-def normalize_image(img_array):
-    img = img_to_binary(Image.fromarray(img_array))
+def normalize_image(img_array, binary_min_value: int = 100):
+    """
+    @param binary_min_value: the pixels darker than or equal to this value are considered black, see `img_to_binary`
+    """
+    img = img_to_binary(Image.fromarray(img_array), min_value=binary_min_value)
 
     crops_images = segment_image(img)
     crops, cropped_images = list(zip(*crops_images))
 
     if len(crops) != 1:
         # FIXME: manual crop, since only one symbol per picture
-        w, h = img.size
-
         img_arr = np.asarray(img)
 
-        left, top, right, down = 1000, 1000, -1000, -1000
-
-        for x in range(w):
-            for y in range(h):
-                # black
-                if not img_arr[y, x]:
-                    if y > down:
-                        down = y
-                    if y < top:
-                        top = y
-                    if x > right:
-                        right = x
-                    if x < left:
-                        left = x
-
-        crop = (left, top, right + 1, down + 1)
+        # black pixels
+        ys, xs = np.nonzero(~img_arr)
+
+        crop = (xs.min(), ys.min(), xs.max() + 1, ys.max() + 1)
         cropped_images = [img.crop(crop)]
 
-    cropped_img = cropped_images[0]
+    return normalize_cropped_image(cropped_images[0])
 
+
+def normalize_cropped_image(cropped_img: Image) -> np.ndarray:
+    """
+    Resize, invert and pad an image that is already cropped to the symbol boundaries.
+    """
     w, h = cropped_img.size
     resize_ratio = min(128 / w, 128 / h)
     new_size = [int(resize_ratio * w), int(resize_ratio * h)]
@@ -61,8 +63,97 @@ def normalize_image(img_array):
     return np.asarray(final_img)
 
 
+def normalize_cropped_images(cropped_imgs: List[Image.Image]) -> np.ndarray:
+    """
+    Normalize all images using `normalize_cropped_image` into one `(N, 128, 128)` array
+    """
+    normalized_imgs = np.zeros((len(cropped_imgs), 128, 128), dtype=np.uint8)
+
+    for i, cropped_img in enumerate(cropped_imgs):
+        normalized_imgs[i] = normalize_cropped_image(cropped_img)
+
+    return normalized_imgs
+
+
+def extract_hog_features_batch(imgs: np.ndarray) -> np.ndarray:
+    """
+    Computes the `hog` features of a stack of images of shape `(N, H, W)`, this gives exactly the same result as
+    `skimage.feature.hog(img, orientations=8, pixels_per_cell=(16, 16), cells_per_block=(1, 1))` for every image.
+
+    @return: array of shape `(N, features_count)`
+    """
+    imgs = np.asarray(imgs)
+    n, s_row, s_col = imgs.shape
+    n_cells_row = s_row // HOG_PIXELS_PER_CELL
+    n_cells_col = s_col // HOG_PIXELS_PER_CELL
+
+    features = np.zeros((n, n_cells_row * n_cells_col * HOG_ORIENTATIONS), dtype=np.float64)
+
+    for batch_start in range(0, n, HOG_BATCH_SIZE):
+        batch = imgs[batch_start:batch_start + HOG_BATCH_SIZE]
+        features[batch_start:batch_start + len(batch)] = __extract_hog_features_batch(batch)
+
+    return features
+
+
+def __extract_hog_features_batch(imgs: np.ndarray) -> np.ndarray:
+    imgs = imgs.astype(np.float64)
+    n, s_row, s_col = imgs.shape
+    cell = HOG_PIXELS_PER_CELL
+    n_cells_row = s_row // cell
+    n_cells_col = s_col // cell
+
+    # 1- gradients
+    g_row = np.zeros_like(imgs)
+    g_row[:, 1:-1, :] = imgs[:, 2:, :] - imgs[:, :-2, :]
+    g_col = np.zeros_like(imgs)
+    g_col[:, :, 1:-1] = imgs[:, :, 2:] - imgs[:, :, :-2]
+
+    magnitude = np.hypot(g_col, g_row)
+    orientation = np.rad2deg(np.arctan2(g_row, g_col)) % 180
+
+    # 2- orientation histograms of the cells, the bins are `[start, end)`, and an orientation of exactly 180
+    # (from rounding) gets the bin `HOG_ORIENTATIONS`, which is not part of the features, the same as `skimage`
+    bins_edges = (180 / HOG_ORIENTATIONS) * np.arange(HOG_ORIENTATIONS + 1)
+    bins = np.searchsorted(bins_edges, orientation, side='right') - 1
+
+    # `skimage` sums the pixels of each cell one by one in a `float` (32 bits), so to get the exact same features, the
+    # sum is done in the same order and precision, but for all cells and images at once.
+    histograms = np.zeros((n, n_cells_row, n_cells_col, HOG_ORIENTATIONS + 1), dtype=np.float32)
+    images_indices, cells_rows, cells_cols = np.indices((n, n_cells_row, n_cells_col), sparse=True)
+    rows_end = n_cells_row * cell
+    cols_end = n_cells_col * cell
+    for cell_row in range(cell):
+        for cell_col in range(cell):
+            cell_bins = bins[:, cell_row:rows_end:cell, cell_col:cols_end:cell]
+            cell_magnitude = magnitude[:, cell_row:rows_end:cell, cell_col:cols_end:cell]
+            index = (images_indices, cells_rows, cells_cols, cell_bins)
+            histograms[index] = histograms[index].astype(np.float64) + cell_magnitude
+    histograms = histograms[..., :HOG_ORIENTATIONS]
+    histograms = (histograms / np.float32(cell * cell)).astype(np.float64)
+
+    # 3- `L2-Hys` normalization, blocks are only one cell
+    eps = 1e-5
+    normalized = histograms / np.sqrt(np.sum(histograms ** 2, axis=-1, keepdims=True) + eps ** 2)
+    normalized = np.minimum(normalized, 0.2)
+    normalized = normalized / np.sqrt(np.sum(normalized ** 2, axis=-1, keepdims=True) + eps ** 2)
+
+    return normalized.reshape((n, -1))
+
+
 def extract_hog_features(img):
     img = normalize_image(np.asarray(img))
-    fd = hog(img, orientations=8, pixels_per_cell=(16, 16), cells_per_block=(1, 1))
 
-    return fd
+    return extract_hog_features_batch(img[None])[0]
+
+
+def extract_crop_masks_hog_features(crop_masks: List[CropMask]) -> np.ndarray:
+    """
+    Extract `hog` features of symbols that are already isolated by the segmenter, so there is no need to segment
+    them again
+
+    @return: array of shape `(N, features_count)`
+    """
+    normalized_imgs = normalize_cropped_images([crop_mask.to_image() for crop_mask in crop_masks])
+
+    return extract_hog_features_batch(normalized_imgs)
@@ -2,10 +2,10 @@ from argparse import ArgumentParser
 
 from tqdm import tqdm
 
-from dataset_generator.generator import generate_pdfs_from_templates
+from dataset_generator.generator import generate_pdfs_from_templates, get_rasterizer, RASTERIZERS
 
 
-def command_line_generation(out_dir, count_for_each):
+def command_line_generation(out_dir, count_for_each, jobs=None, batch_size=1, rasterizer=None, shard=False):
     templates = [
         "{num1} {operator1} {num2}{latin1}",
         "{num1} {operator1} {num2}{latin1} {operator2} {num3}{latin1}^{{{num4}}} = 0",
@@ -32,7 +32,9 @@ def command_line_generation(out_dir, count_for_each):
         progress.display()
         last_progress = a
 
-    generate_pdfs_from_templates(templates, out_dir, updater=updater, count_for_each=count_for_each)
+    generate_pdfs_from_templates(templates, out_dir, updater=updater, count_for_each=count_for_each,
+                                 concurrency=jobs, batch_size=batch_size,
+                                 rasterizer=get_rasterizer(rasterizer), shard=shard)
     progress.close()
 
 
@@ -42,6 +44,20 @@ if __name__ == "__main__":
     parser.add_argument('--count', '-c', type=int, action='store', default=20,
                         help='number of images to generate for each template [only for commandline] (default 20)')
 
+    parser.add_argument('--jobs', '-j', type=int, action='store', default=None,
+                        help='number of expressions generated at the same time (default = number of CPUs)')
+
+    parser.add_argument('--batch-size', '-b', type=int, action='store', default=32,
+                        help='number of expressions compiled together into one document (default 32)')
+
+    parser.add_argument('--rasterizer', '-r', type=str, action='store', default=None,
+                        choices=[rasterizer.name for rasterizer in RASTERIZERS],
+                        help='program used to convert the PDFs into images (default convert), the others are faster, '
+                             'but their images are a bit different')
+
+    parser.add_argument('--shard', action='store_true',
+                        help='pack the images into one dataset shard file instead of PNG files')
+
     args = parser.parse_args()
 
-    command_line_generation(args.outdir, args.count)
+    command_line_generation(args.outdir, args.count, args.jobs, args.batch_size, args.rasterizer, args.shard)
@@ -1,13 +1,19 @@
 import csv
 import os
+import re
+import shutil
 import subprocess
 import sys
 from os import path
 from random import randint, choice
-from string import ascii_letters
+from string import ascii_letters, Formatter
 
-from utils.parallel_executer import ParallelExecutor
-from .template import generate_latex_template, formula_strap
+from PIL import Image
+
+from utils.dataset_shard import DatasetShardWriter, DATASET_SHARD_FILENAME
+from utils.parallel_executer import execute_pipelined
+from .template import generate_latex_template, generate_latex_document, generate_latex_batch_document, \
+    formula_preamble, formula_batch_preamble
 
 # TODO: add operators like power, sub, frac and other stuff that need
 #  special format in LaTeX
@@ -98,16 +104,37 @@ def fill_latex_file_template(expr):
 
 
 def generate_pdfs_from_templates(templates, output_dir, count_for_each=10, naming_format="expr_{num:05}", updater=None,
-                                 image_density=500):
+                                 image_density=500, concurrency=None, batch_size=1, rasterizer=None, shard=False):
+    """
+    Generates `count_for_each` images from every template into `output_dir`, with `metadata.csv` of the expressions.
+
+    Every expression is compiled, converted into an image, and cleaned up on its own, running `concurrency` expressions
+    at the same time (the number of CPUs by default), so the CPUs are busy all the time.
+
+    @param updater: called with `(done, total)` every time an expression finishes
+    @param batch_size: if more than 1, this number of expressions are compiled into one document and converted
+                       together (see `render_expressions_batch`), which saves starting `pdflatex` and `convert` for
+                       every expression
+    @param rasterizer: the `Rasterizer` to convert the PDFs with, `get_rasterizer()` by default
+    @param shard: write the images into a dataset shard (see `utils.dataset_shard`) instead of PNG files
+    """
     assert output_dir, "output_dir must not be empty"
     assert count_for_each >= 0, "count_for_each must be a positive number"
     assert naming_format, "naming_format must not be empty"
     assert updater is None or callable(updater), "updater must be callable or None"
+    assert concurrency is None or concurrency > 0, "concurrency must be positive"
+    assert batch_size > 0, "batch_size must be positive"
 
     def updater_inner(a, b):
         if updater:
             updater(a, b)
 
+    if concurrency is None:
+        concurrency = os.cpu_count()
+
+    if rasterizer is None:
+        rasterizer = get_rasterizer()
+
     if not path.isdir(output_dir):
         # try to create directory
         assert not path.exists(output_dir), \
@@ -116,159 +143,426 @@ def generate_pdfs_from_templates(templates, output_dir, count_for_each=10, namin
 
         os.mkdir(output_dir)
 
-    old_dir = os.getcwd()
-    # Go into the directory, because "pdflatex" outputs into the current working
-    # directory
-    os.chdir(output_dir)
-
-    csv_file = open("metadata.csv", "w")
+    csv_file = open(path.join(output_dir, "metadata.csv"), "w")
     csv_writer = csv.writer(csv_file)
 
     # header
     csv_writer.writerow(["file_basename", "expr"])
 
-    all_size = len(templates) * count_for_each
-    # Because we have 3 stages
-    full_progress = all_size * 2
+    full_progress = len(templates) * count_for_each
     progress_counter = 0
 
-    # Number of expressions so far
-    expr_counter = 0
-
-    # Step 0: put the formula.tex file
-    with open("formula.tex", "w") as f:
-        f.write(formula_strap)
-
-    # Stage 1: creating uncropped PDFs
-    file_names = []
-    executor = ParallelExecutor(20)
-    for template in templates:
-        for _ in range(count_for_each):
-            file_basename = naming_format.format(num=expr_counter)
-            tex_filename = file_basename + ".tex"
-            expr_counter += 1
-
-            progress_counter += 1
-            updater_inner(progress_counter, full_progress)
-
-            if path.exists(tex_filename):
-                print(f"[WARN]: Trying to generate file {tex_filename}, which already exists, skipping...",
-                      file=sys.stderr)
-
-                progress_counter += 2
-                updater_inner(progress_counter, full_progress)
-                continue
-
-            expr = fill_expression_template(template)
-            csv_writer.writerow([file_basename, expr])
-
-            with open(tex_filename, "w") as f:
-                file_content = fill_latex_file_template(expr)
-                f.write(file_content)
-
-            file_names.append(file_basename)
-            executor.execute(["pdflatex", tex_filename], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-
-    # Stage 2: converting pdfs into images
-    remaining_filenames = []
-    old_processes = executor.finish()
-    executor.clear()
-    image_density = str(image_density)
-    for file_basename, process in zip(file_names, old_processes):
-        progress_counter += 1
-        updater_inner(progress_counter, full_progress)
-        ret_code = process.wait()
-        if ret_code != 0:
-            print(f"[ERROR] Cropping {file_basename}.pdf, returned with code={ret_code}, skipping...")
-            progress_counter += 1
-            updater_inner(progress_counter, full_progress)
-            continue
-
-        pdf_filename = file_basename + ".pdf"
-        png_filename = file_basename + ".png"
-
-        remaining_filenames.append(file_basename)
-        executor.execute(["convert", "-density", image_density,
-                          pdf_filename, "-quality", "10", "-colorspace", "Gray",
-                          "-depth", "1", "-alpha", "remove", png_filename],
-                         stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-
-    # Stage 3: finish up
-    file_names = list(remaining_filenames)
-    for file_basename, process in zip(file_names, executor.finish()):
+    latex_format = build_latex_format(output_dir, batch=batch_size > 1)
+
+    shard_writer = DatasetShardWriter(path.join(output_dir, DATASET_SHARD_FILENAME)) if shard else None
+
+    def expressions():
+        nonlocal progress_counter
+
+        # Number of expressions so far
+        expr_counter = 0
+
+        for template in templates:
+            for _ in range(count_for_each):
+                file_basename = naming_format.format(num=expr_counter)
+                tex_filename = file_basename + ".tex"
+                expr_counter += 1
+
+                if path.exists(path.join(output_dir, tex_filename)):
+                    print(f"[WARN]: Trying to generate file {tex_filename}, which already exists, skipping...",
+                          file=sys.stderr)
+
+                    progress_counter += 1
+                    updater_inner(progress_counter, full_progress)
+                    continue
+
+                expr = fill_expression_template(template)
+                csv_writer.writerow([file_basename, expr])
+
+                yield file_basename, expr
+
+    def render(batch):
+        file_basenames, exprs = zip(*batch)
+
+        if batch_size == 1:
+            render_expression(exprs[0], output_dir, file_basenames[0], image_density, latex_format, rasterizer)
+            return [None]
+
+        return render_expressions_batch(list(exprs), output_dir, list(file_basenames),
+                                        f"{file_basenames[0]}_batch", image_density, latex_format, rasterizer)
+
+    for batch, errors, batch_error in execute_pipelined(__batched(expressions(), batch_size), render, concurrency):
+        if batch_error is not None:
+            errors = [batch_error] * len(batch)
+
+        for (file_basename, expr), error in zip(batch, errors):
+            if error is not None:
+                print(f"[ERROR] Generating {file_basename}.png failed, {error}, skipping...")
+            elif shard_writer is not None:
+                png_filename = path.join(output_dir, file_basename + ".png")
+
+                with Image.open(png_filename) as img:
+                    shard_writer.add(file_basename, expr, img)
+                os.remove(png_filename)
+
+        progress_counter += len(batch)
         updater_inner(progress_counter, full_progress)
-        ret_code = process.wait()
-        if ret_code != 0:
-            print(f"[ERROR] Converting {file_basename}.pdf to image failed, returned with code={ret_code}")
 
-        for ext in ["tex", "aux", "pdf", "log"]:
-            os.remove(f"{file_basename}.{ext}")
+    if latex_format is not None:
+        os.remove(path.join(output_dir, latex_format + ".fmt"))
 
-    os.remove("formula.tex")
+    if shard_writer is not None:
+        shard_writer.close()
 
     csv_file.close()
-    os.chdir(old_dir)
 
 
-def generate_single_from_template(template, output_dir, file_basename, image_density=500):
-    assert output_dir, "output_dir must not be empty"
-    assert file_basename, "naming_format must not be empty"
+def __batched(items, batch_size):
+    batch = []
 
-    if not path.isdir(output_dir):
-        # try to create directory
-        assert not path.exists(output_dir), \
-            f"Trying to create a directory with name {output_dir}, but there is a file that already exists with that " \
-            f"name "
+    for item in items:
+        batch.append(item)
 
-        os.mkdir(output_dir)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def compile_latex_expression(expr, working_dir, file_basename, latex_format=None):
+    """
+    Writes the document of `expr` into `{file_basename}.tex` and compiles it into `{file_basename}.pdf`, all the
+    files are in `working_dir` (without changing the current directory of the process)
 
-    old_dir = os.getcwd()
-    # Go into the directory, because "pdflatex" outputs into the current working
-    # directory
-    os.chdir(output_dir)
+    @param latex_format: name of a format built by `build_latex_format` in `working_dir` to compile with, or None to
+                         compile the full document
+    @return: the return code of `pdflatex`
+    """
+    return compile_latex_document(generate_latex_document(expr, include_preamble=latex_format is None), working_dir,
+                                  file_basename, latex_format)
 
-    # Step 0: put the formula.tex file
-    with open("formula.tex", "w") as f:
-        f.write(formula_strap)
 
+def compile_latex_document(document, working_dir, file_basename, latex_format=None):
+    """
+    Same as `compile_latex_expression` for a full `document`
+    """
     tex_filename = file_basename + ".tex"
 
-    if path.exists(tex_filename):
-        print(f"[WARN]: Trying to generate file {tex_filename}, which already exists, skipping...",
-              file=sys.stderr)
+    with open(path.join(working_dir, tex_filename), "w") as f:
+        f.write(document)
+
+    command = ["pdflatex", "-interaction=nonstopmode"]
+    if latex_format is not None:
+        command.append(f"-fmt={latex_format}")
+    command.append(tex_filename)
+
+    return subprocess.Popen(command, cwd=working_dir, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL).wait()
+
+
+class Rasterizer:
+    """
+    Converts all the pages of a PDF into 1-bit PNG images, using a single process for the whole PDF
+    """
+
+    name = None
+    executable = None
+
+    def is_available(self):
+        return shutil.which(self.executable) is not None
+
+    def command(self, pdf_filename, file_basename, image_density, multi_page):
+        """
+        @return: command that writes `{file_basename}.png`, or if `multi_page` writes every page into
+                 `{file_basename}-{page}.png`, where `page` is any increasing number
+        """
+        raise NotImplementedError()
+
+    def rasterize(self, working_dir, file_basename, image_density=500, multi_page=False):
+        """
+        Converts `{file_basename}.pdf` into `{file_basename}.png`, or if `multi_page`, every page into
+        `{file_basename}-{page}.png` (starting from 0), all in `working_dir`
+        """
+        process = subprocess.run(self.command(file_basename + ".pdf", file_basename, image_density, multi_page),
+                                 cwd=working_dir, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE)
+
+        if process.returncode != 0:
+            # the last line is usually the reason, like the security policy of ImageMagick not allowing PDFs
+            error_lines = process.stderr.decode(errors="replace").strip().splitlines()
+            reason = f": {error_lines[-1]}" if error_lines else ""
+            raise RuntimeError(f"Converting {file_basename}.pdf to image using {self.name} failed, "
+                               f"returned with code={process.returncode}{reason}")
+
+        if multi_page:
+            for i, page_filename in enumerate(self.page_filenames(working_dir, file_basename)):
+                os.replace(path.join(working_dir, page_filename), path.join(working_dir, f"{file_basename}-{i}.png"))
+
+    @staticmethod
+    def page_filenames(working_dir, file_basename):
+        """
+        @return: the filenames of the pages of `file_basename` in order, the backends number the pages differently
+        """
+        page_filename_pattern = re.compile(re.escape(file_basename) + r"-(\d+)\.png")
+
+        pages = []
+        for filename in os.listdir(working_dir):
+            match = page_filename_pattern.fullmatch(filename)
+            if match:
+                pages.append((int(match.group(1)), filename))
+
+        return [filename for _page, filename in sorted(pages)]
+
+
+class PdftoppmRasterizer(Rasterizer):
+    """
+    poppler's `pdftoppm`, the pages numbers start from 1, and are padded with zeros
+    """
+
+    name = "pdftoppm"
+    executable = "pdftoppm"
+
+    def command(self, pdf_filename, file_basename, image_density, multi_page):
+        return ["pdftoppm", "-r", str(image_density), "-mono", "-png", *([] if multi_page else ["-singlefile"]),
+                pdf_filename, file_basename]
+
+
+class GhostscriptRasterizer(Rasterizer):
+    """
+    Ghostscript with the `pngmono` device, the pages numbers start from 1
+    """
+
+    name = "ghostscript"
+    executable = "gs"
+
+    def command(self, pdf_filename, file_basename, image_density, multi_page):
+        output_filename = file_basename + ("-%d.png" if multi_page else ".png")
+
+        return ["gs", "-q", "-dSAFER", "-dBATCH", "-dNOPAUSE", "-sDEVICE=pngmono", f"-r{image_density}",
+                f"-sOutputFile={output_filename}", pdf_filename]
+
+
+class ImageMagickRasterizer(Rasterizer):
+    """
+    ImageMagick's `convert`, which uses Ghostscript, renders in gray then reduces the depth to 1-bit
+    """
+
+    name = "convert"
+    executable = "convert"
+
+    def command(self, pdf_filename, file_basename, image_density, multi_page):
+        output_options = ["+adjoin", file_basename + "-%d.png"] if multi_page else [file_basename + ".png"]
+
+        return ["convert", "-density", str(image_density),
+                pdf_filename, "-quality", "10", "-colorspace", "Gray",
+                "-depth", "1", "-alpha", "remove", *output_options]
 
-    expr = fill_expression_template(template)
 
-    with open(tex_filename, "w") as f:
-        file_content = fill_latex_file_template(expr)
-        f.write(file_content)
+# in the order of preference, when the rasterizer is not specified
+RASTERIZERS = [PdftoppmRasterizer(), GhostscriptRasterizer(), ImageMagickRasterizer()]
 
-    pdf_latex_return_code = subprocess.Popen(["pdflatex", "-interaction=nonstopmode", tex_filename],
-                                             stderr=subprocess.DEVNULL,
-                                             stdout=subprocess.DEVNULL).wait()
+# the rasterizers reduce the images to 1-bit differently, so the default must not depend on what is installed,
+# otherwise the same command would produce different datasets (and models) on different machines
+DEFAULT_RASTERIZER = ImageMagickRasterizer.name
 
-    # Stage 2: converting pdfs into images
-    pdf_filename = file_basename + ".pdf"
-    png_filename = file_basename + ".png"
 
-    image_density = str(image_density)
-    if pdf_latex_return_code == 0:
-        subprocess.Popen(["convert", "-density", image_density,
-                          pdf_filename, "-quality", "10", "-colorspace", "Gray",
-                          "-depth", "1", "-alpha", "remove", png_filename],
-                         stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL).wait()
+def get_rasterizer(name=None):
+    """
+    @param name: one of the names of `RASTERIZERS`, or None to get `DEFAULT_RASTERIZER`, the others are faster, but
+                 their images are not the same
+    """
+    if name is None:
+        name = DEFAULT_RASTERIZER
 
-    # Stage 3: finish up
+    for rasterizer in RASTERIZERS:
+        if rasterizer.name == name:
+            return rasterizer
+
+    raise ValueError(f"unknown rasterizer `{name}`, available rasterizers are {[r.name for r in RASTERIZERS]}")
+
+
+def remove_latex_files(working_dir, file_basename):
     for ext in ["tex", "aux", "pdf", "log"]:
-        file = f"{file_basename}.{ext}"
-        if os.path.exists(file):
+        file = path.join(working_dir, f"{file_basename}.{ext}")
+        if path.exists(file):
             os.remove(file)
 
-    os.remove("formula.tex")
 
-    os.chdir(old_dir)
+def render_expression(expr, working_dir, file_basename, image_density=500, latex_format=None, rasterizer=None):
+    """
+    Renders `expr` into `{file_basename}.png` in `working_dir`, the other generated files are removed
+
+    @param latex_format: see `compile_latex_expression`
+    @param rasterizer: the `Rasterizer` to convert the PDF with, `get_rasterizer()` by default
+    """
+    if rasterizer is None:
+        rasterizer = get_rasterizer()
+
+    try:
+        pdf_latex_return_code = compile_latex_expression(expr, working_dir, file_basename, latex_format)
+
+        if pdf_latex_return_code != 0:
+            raise ValueError("could not compile the LaTeX string due to wrong formatting or syntax")
+
+        rasterizer.rasterize(working_dir, file_basename, image_density)
+    finally:
+        remove_latex_files(working_dir, file_basename)
+
+
+def pdf_pages_count(working_dir, file_basename):
+    """
+    @return: the number of pages of `{file_basename}.pdf` as written in the log of `pdflatex`, or None if not found
+    """
+    log_filename = path.join(working_dir, file_basename + ".log")
+
+    if not path.exists(log_filename):
+        return None
+
+    with open(log_filename, "r", errors="replace") as f:
+        # long lines of the log are wrapped
+        log = f.read().replace("\n", "")
+
+    match = re.search(r"Output written on .*?\((\d+) pages?", log)
+
+    return int(match.group(1)) if match else None
+
+
+def render_expressions_batch(exprs, working_dir, file_basenames, batch_basename, image_density=500, latex_format=None,
+                             rasterizer=None):
+    """
+    Renders all `exprs` with a single `pdflatex` and `convert` for the whole batch, into `{file_basename}.png` in
+    `working_dir` for every expression. If the batch cannot be compiled, it is split into halves which are
+    compiled again, until the failing expressions are found, so they do not fail the rest of the batch.
+
+    @param batch_basename: name of the files of the batch document, must not be used by other files in `working_dir`
+    @param latex_format: name of a format built by `build_latex_format(working_dir, batch=True)`, or None
+    @param rasterizer: the `Rasterizer` to convert the PDF with, `get_rasterizer()` by default
+    @return: the error of every expression, or None if it was rendered
+    """
+    assert len(exprs) == len(file_basenames), "every expression must have a file_basename"
+
+    if not exprs:
+        return []
+
+    if rasterizer is None:
+        rasterizer = get_rasterizer()
+
+    try:
+        document = generate_latex_batch_document(exprs, include_preamble=latex_format is None)
+        pdf_latex_return_code = compile_latex_document(document, working_dir, batch_basename, latex_format)
+
+        # an expression that does not produce exactly one page would shift the pages of all the next ones
+        if pdf_latex_return_code == 0 and pdf_pages_count(working_dir, batch_basename) == len(exprs):
+            try:
+                rasterizer.rasterize(working_dir, batch_basename, image_density, multi_page=True)
+            except RuntimeError as e:
+                for page_filename in Rasterizer.page_filenames(working_dir, batch_basename):
+                    os.remove(path.join(working_dir, page_filename))
+
+                return [e] * len(exprs)
+
+            for i, file_basename in enumerate(file_basenames):
+                os.replace(path.join(working_dir, f"{batch_basename}-{i}.png"),
+                           path.join(working_dir, file_basename + ".png"))
+
+            return [None] * len(exprs)
+    finally:
+        remove_latex_files(working_dir, batch_basename)
+
+    if len(exprs) == 1:
+        return [ValueError("could not compile the LaTeX string due to wrong formatting or syntax")]
+
+    half = len(exprs) // 2
+
+    return render_expressions_batch(exprs[:half], working_dir, file_basenames[:half], batch_basename + "_0",
+                                    image_density, latex_format, rasterizer) + \
+        render_expressions_batch(exprs[half:], working_dir, file_basenames[half:], batch_basename + "_1",
+                                 image_density, latex_format, rasterizer)
+
+
+LATEX_FORMAT_NAME = "formula_preamble"
+LATEX_BATCH_FORMAT_NAME = "formula_batch_preamble"
+
+
+def build_latex_format(working_dir, batch=False):
+    """
+    Precompiles the preamble of `formula_strap` (document class and packages) into a `pdflatex` format file in
+    `working_dir`, documents compiled with it start from the loaded preamble, which is most of the compilation time
+    of a small expression.
+
+    @param batch: build the format of `formula_batch_preamble` for `render_expressions_batch` instead
+    @return: the name of the format, or None if it could not be built, then the full documents must be compiled
+    """
+    format_name = LATEX_BATCH_FORMAT_NAME if batch else LATEX_FORMAT_NAME
+    preamble = formula_batch_preamble if batch else formula_preamble
+
+    with open(path.join(working_dir, format_name + ".tex"), "w") as f:
+        f.write(preamble + "\\dump\n")
+
+    error = None
+    try:
+        return_code = subprocess.Popen(["pdflatex", "-ini", "-interaction=nonstopmode", f"-jobname={format_name}",
+                                        "&pdflatex", format_name + ".tex"],
+                                       cwd=working_dir, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL).wait()
+
+        # make sure that documents can be compiled with it
+        if return_code == 0:
+            if batch:
+                document = generate_latex_batch_document(["E = m c^2", "x"], include_preamble=False)
+            else:
+                document = generate_latex_document("E = m c^2", include_preamble=False)
+
+            return_code = compile_latex_document(document, working_dir, "format_test", format_name)
+            pages_count = pdf_pages_count(working_dir, "format_test")
+            remove_latex_files(working_dir, "format_test")
+
+            if return_code == 0 and batch and pages_count != 2:
+                error = f"the test document has {pages_count} pages instead of 2"
+
+        if return_code != 0:
+            error = f"returned with code={return_code}"
+    except OSError as e:
+        error = str(e)
+
+    remove_latex_files(working_dir, format_name)
+
+    if error is not None:
+        print(f"[WARN] Could not build the LaTeX format, {error}, compiling full documents instead", file=sys.stderr)
+        return None
+
+    return format_name
+
+
+def template_has_variables(template):
+    """
+    @return: False if the template is always filled into the same expression
+    """
+    return any(field_name is not None for _text, field_name, _spec, _conversion in Formatter().parse(template))
+
+
+def generate_single_from_template(template, output_dir, file_basename, image_density=500, rasterizer=None):
+    assert output_dir, "output_dir must not be empty"
+    assert file_basename, "naming_format must not be empty"
+
+    if not path.isdir(output_dir):
+        # try to create directory
+        assert not path.exists(output_dir), \
+            f"Trying to create a directory with name {output_dir}, but there is a file that already exists with that " \
+            f"name "
+
+        os.mkdir(output_dir)
+
+    tex_filename = file_basename + ".tex"
+
+    if path.exists(path.join(output_dir, tex_filename)):
+        print(f"[WARN]: Trying to generate file {tex_filename}, which already exists, skipping...",
+              file=sys.stderr)
+
+    expr = fill_expression_template(template)
 
-    if pdf_latex_return_code != 0:
-        raise ValueError("could not compile the LaTeX string due to wrong formatting or syntax")
+    render_expression(expr, output_dir, file_basename, image_density, rasterizer=rasterizer)
 
     return expr
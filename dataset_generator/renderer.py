@@ -0,0 +1,106 @@
+import os
+import shutil
+from os import path
+from queue import Queue
+from tempfile import mkdtemp
+from threading import Lock
+from typing import Optional, Tuple
+
+from utils.cache import LRUCache
+from .generator import build_latex_format, fill_expression_template, render_expression, template_has_variables, \
+    get_rasterizer, Rasterizer
+
+
+class LatexRenderer:
+    """
+    Renders LaTeX templates into PNG images, at most `workers` renders (`pdflatex` + rasterizer) run at the same time,
+    each in its own scratch directory, so it can be used from many threads without changing the current directory of
+    the process.
+
+    The preamble of `formula_strap` is compiled once into a format file, which is loaded by every render instead of
+    loading the document class and packages again.
+
+    Renders of templates without variables are cached, as they always give the same image.
+    """
+
+    def __init__(self, workers: int, image_density: int = 500, cache_size: int = 32 * 1024 * 1024,
+                 rasterizer: Optional[Rasterizer] = None) -> None:
+        assert workers > 0, "workers must be positive"
+
+        self.workers: int = workers
+        self.image_density: int = image_density
+        self.rasterizer: Rasterizer = rasterizer if rasterizer is not None else get_rasterizer()
+        self.cache: LRUCache = LRUCache(max_bytes=cache_size)
+
+        self.__lock = Lock()
+        self.__pid: Optional[int] = None
+        self.__root_dir: Optional[str] = None
+        self.__latex_format: Optional[str] = None
+        # scratch directories of the workers that are not rendering now
+        self.__idle_dirs: Optional[Queue] = None
+
+    def __start(self) -> Queue:
+        with self.__lock:
+            # a forked process must not use the directories of its parent
+            if self.__pid != os.getpid():
+                self.__root_dir = mkdtemp(prefix="latex_render")
+                self.__latex_format = build_latex_format(self.__root_dir)
+
+                self.__idle_dirs = Queue()
+                for i in range(self.workers):
+                    worker_dir = path.join(self.__root_dir, f"worker_{i}")
+                    os.mkdir(worker_dir)
+
+                    if self.__latex_format is not None:
+                        shutil.copy(path.join(self.__root_dir, self.__latex_format + ".fmt"), worker_dir)
+
+                    self.__idle_dirs.put(worker_dir)
+
+                self.__pid = os.getpid()
+
+            return self.__idle_dirs
+
+    def render_expression(self, expr: str) -> bytes:
+        """
+        @return: the PNG data of the image of `expr`
+        """
+        idle_dirs = self.__start()
+        worker_dir = idle_dirs.get()
+
+        try:
+            render_expression(expr, worker_dir, "formula", self.image_density, self.__latex_format, self.rasterizer)
+
+            png_filename = path.join(worker_dir, "formula.png")
+            with open(png_filename, "rb") as f:
+                png_data = f.read()
+            os.remove(png_filename)
+
+            return png_data
+        finally:
+            idle_dirs.put(worker_dir)
+
+    def render_template(self, template: str) -> Tuple[str, bytes]:
+        """
+        @return: the expression the template was filled with, and the PNG data of its image
+        """
+        expr = fill_expression_template(template)
+
+        if template_has_variables(template):
+            return expr, self.render_expression(expr)
+
+        png_data = self.cache.get(expr)
+
+        if png_data is None:
+            png_data = self.render_expression(expr)
+            self.cache.put(expr, png_data, size=len(png_data))
+
+        return expr, png_data
+
+    def close(self) -> None:
+        """
+        Removes the scratch directories, the renderer can still be used after that, and would create new ones
+        """
+        with self.__lock:
+            if self.__pid == os.getpid():
+                shutil.rmtree(self.__root_dir, ignore_errors=True)
+                self.__pid = None
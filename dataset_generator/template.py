@@ -1,15 +1,27 @@
 # taken from https://tex.stackexchange.com/questions/34054/tex-to-image-over-command-line
+formula_preamble = r"""
+\documentclass[border=2pt,varwidth]{standalone}
+\usepackage{standalone}
+\usepackage{amsmath}
+"""
+
+formula_body = r"""\begin{document}
+\[ \formula \]
+\end{document}
+"""
+
 formula_strap = r"""
 \ifdefined\formula
 \else
     \def\formula{E = m c^2}
-\fi
-\documentclass[border=2pt,varwidth]{standalone}
+\fi""" + formula_preamble + formula_body
+
+# every `formulapage` is a separate page, cropped the same as the document of `formula_strap`
+formula_batch_preamble = r"""
+\documentclass[border=2pt,varwidth,multi=formulapage]{standalone}
 \usepackage{standalone}
 \usepackage{amsmath}
-\begin{document}
-\[ \formula \]
-\end{document}
+\newenvironment{formulapage}{}{}
 """
 
 latex_strap = "\\def\\formula{{{{{expression}}}}}\\input{{{{formula.tex}}}}"
@@ -23,3 +35,26 @@ latex_strap = "\\def\\formula{{{{{expression}}}}}\\input{{{{formula.tex}}}}"
 def generate_latex_template(expression):
     return latex_strap.format(expression=expression)
 
+
+def generate_latex_document(expression, include_preamble=True):
+    """
+    Same as `generate_latex_template` but the document does not need `formula.tex` to compile, so documents can be
+    compiled in the same directory at the same time.
+
+    @param include_preamble: if False, the document must be compiled with the format of `formula_preamble`
+    """
+    return "\\def\\formula{{" + expression + "}}" + (formula_strap if include_preamble else formula_body)
+
+
+def generate_latex_batch_document(expressions, include_preamble=True):
+    """
+    Document with a page for every expression, in the same order
+
+    @param include_preamble: if False, the document must be compiled with the format of `formula_batch_preamble`
+    """
+    pages = "".join(
+        f"\\begin{{formulapage}}\\[ {{{expression}}} \\]\\end{{formulapage}}\n"
+        for expression in expressions
+    )
+
+    return (formula_batch_preamble if include_preamble else "") + "\\begin{document}\n" + pages + "\\end{document}\n"
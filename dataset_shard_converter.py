@@ -0,0 +1,27 @@
+# packs the images of an existing dataset directory (generated by `dataset_generator.py` or
+# `classification_dataset_generator.py`) into its dataset shard
+from argparse import ArgumentParser
+
+from tqdm import tqdm
+
+from utils.dataset_shard import pack_dataset_directory
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Fyp dataset shard converter')
+    parser.add_argument('--dir', '-d', type=str, required=True, help='dataset dir containing the `metadata.csv` file')
+    parser.add_argument('--remove', action='store_true', help='remove the PNG files after packing them')
+
+    args = parser.parse_args()
+
+    progress = tqdm()
+    last_progress = 0
+
+    def updater(done):
+        global last_progress
+        progress.update(done - last_progress)
+        last_progress = done
+
+    shard_filename = pack_dataset_directory(args.dir, remove_images=args.remove, progress=updater)
+    progress.close()
+
+    print(f'packed into {shard_filename}')
@@ -10,6 +10,7 @@ from tqdm import tqdm
 from classifier.classifier import SVMClassifier
 from parser.tree import SymbolTree
 from parser.utils import optimize_latex_string
+from utils.dataset_shard import DatasetShard, dataset_shard_path
 
 parser = ArgumentParser(description='Fyp1 system prediction tester')
 parser.add_argument('--dataset', '-d', type=str, required=True, help='dataset dir containing the `metadata.csv` file')
@@ -19,7 +20,15 @@ args = parser.parse_args()
 
 dataset_folder = args.dataset
 
-dataset = pd.read_csv(path.join(dataset_folder, 'metadata.csv'))
+shard_filename = dataset_shard_path(dataset_folder)
+
+if shard_filename is not None:
+    # packed dataset, all the images are in one file
+    shard = DatasetShard(shard_filename)
+    dataset = pd.DataFrame({'file_basename': shard.names, 'expr': shard.labels})
+else:
+    shard = None
+    dataset = pd.read_csv(path.join(dataset_folder, 'metadata.csv'))
 
 svm_model = SVMClassifier()
 svm_model.import_from_pickle(args.model)
@@ -29,7 +38,10 @@ prediction_progress = tqdm(total=len(dataset))
 
 def predict_latex(img_filename):
     prediction_progress.update(1)
-    img = Image.open(path.join(dataset_folder, f'{img_filename}.png'))
+    if shard is not None:
+        img = shard.get_image_by_name(img_filename)
+    else:
+        img = Image.open(path.join(dataset_folder, f'{img_filename}.png'))
 
     tree = SymbolTree.from_image(img, svm_model)
     try:
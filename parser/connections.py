@@ -1,85 +1,102 @@
-from typing import List, Tuple
+from typing import List, Tuple, Dict
+
+import numpy as np
 
 from parser.graph import find_minimum_spanning_tree
-from parser.utils import get_most_probable_relation, distance_labeled_crops, compute_modified_distance
-from segmenter.utils import is_another_in_between
+from parser.utils import get_most_probable_relations, distance_labeled_crops, compute_modified_distance, RELATIONS
+from segmenter.visibility import BoxesVisibility
 from utils.types import LabeledCrops
 
 
-def get_all_symbols_relations_connections(labeled_crops: LabeledCrops) -> List[List[Tuple[int, float, str]]]:
-    labels, crops = list(zip(*labeled_crops))
-
-    relations = [[] for _ in range(len(labeled_crops))]
-    connections = [[] for _ in range(len(labeled_crops))]
-
-    for b1_i, b1 in enumerate(labeled_crops):
-        for b2_i, b2 in enumerate(labeled_crops):
-            crop1 = b1[1]
-            crop2 = b2[1]
-            if crop1 == crop2:
-                continue
-
-            if is_another_in_between(crop1, crop2, crops):
-                continue
-
-            relation = get_most_probable_relation(b1, b2)
-
-            if relation is None:
-                continue
+class RelationGraph:
+    """
+    Holds the relations between all symbols of an expression, the relation, distance and modified distance (weight)
+    of each pair of symbols are computed only once, and then used by the minimum spanning tree and `SymbolTree`.
+    """
+
+    def __init__(self, labeled_crops: LabeledCrops) -> None:
+        self.size: int = len(labeled_crops)
+        # `connections[i]` contain all the `(j, distance, relation)` connections from symbol `i`
+        self.connections: List[List[Tuple[int, float, str]]] = RelationGraph.__compute_connections(labeled_crops)
+        # `weights[i]` contain all the `(j, modified_distance)` connections from symbol `i`
+        self.weights: List[List[Tuple[int, float]]] = [
+            [
+                (j, compute_modified_distance(distance, relation))
+                for j, distance, relation in connecting
+            ]
+            for connecting in self.connections
+        ]
+        self.__connections_lookup: Dict[Tuple[int, int], Tuple[int, float, str]] = {
+            (i, j): (j, distance, relation)
+            for i, connecting in enumerate(self.connections)
+            for j, distance, relation in connecting
+        }
+        self.__minimum_spanning_tree = None
+
+    def get_relation(self, from_node: int, to_node: int) -> Tuple[int, float, str]:
+        try:
+            return self.__connections_lookup[(from_node, to_node)]
+        except KeyError:
+            raise ValueError(f"could not find relation from {from_node} to {to_node}")
+
+    def minimum_spanning_tree(self) -> List[Tuple[int, int]]:
+        if self.__minimum_spanning_tree is None:
+            self.__minimum_spanning_tree = sorted(find_minimum_spanning_tree(self.weights))
+
+        return list(self.__minimum_spanning_tree)
+
+    @staticmethod
+    def __compute_connections(labeled_crops: LabeledCrops) -> List[List[Tuple[int, float, str]]]:
+        labels, crops = list(zip(*labeled_crops))
+        n = len(labeled_crops)
+
+        # the relation of every pair, it does not depend on other symbols, so it is computed once for both passes, all
+        # pairs are computed together, even the hidden ones that are not used
+        relations_codes = get_most_probable_relations(labels, crops)
+        relations = [
+            [RELATIONS[code] if code >= 0 else None for code in row]
+            for row in relations_codes.tolist()
+        ]
 
-            relations[b1_i].append((b2_i, relation))
+        # computes which boxes are blocking the line between every two boxes only once, then use it for all checks
+        visibility = BoxesVisibility(crops)
+        visible_pairs = visibility.visible_pairs()
 
-    subs_and_powers = [[] for _ in range(len(labeled_crops))]
+        # subs and powers of a symbol should not block its connections with other symbols
+        subs_and_powers = np.zeros((n, n), dtype=bool)
 
-    for i, symbol_relations in enumerate(relations):
-        for j, relation in symbol_relations:
-            if relation == 'sub' or relation == 'power':
-                subs_and_powers[i].append(j)
+        for i in range(n):
+            for j in range(n):
+                if visible_pairs[i, j] and relations[i][j] in ['sub', 'power']:
+                    subs_and_powers[i, j] = True
 
-    for b1_i, b1 in enumerate(labeled_crops):
-        crops_filtered = []
+        visible_pairs = visibility.visible_pairs(ignored=subs_and_powers)
 
-        for crop_i, crop in enumerate(crops):
-            if crop_i not in subs_and_powers[b1_i]:
-                crops_filtered.append(crop)
+        connections = [[] for _ in range(n)]
 
-        for b2_i, b2 in enumerate(labeled_crops):
-            crop1 = b1[1]
-            crop2 = b2[1]
-            if crop1 == crop2:
-                continue
+        for b1_i, b1 in enumerate(labeled_crops):
+            for b2_i, b2 in enumerate(labeled_crops):
+                relation = relations[b1_i][b2_i]
 
-            if is_another_in_between(crop1, crop2, crops_filtered):
-                continue
+                if relation is None or not visible_pairs[b1_i, b2_i]:
+                    continue
 
-            relation = get_most_probable_relation(b1, b2)
+                d = distance_labeled_crops(b1, b2)
+                # as `distance_labeled_crops` returns `Optional`, but if `relation` is not `None`, then this must be
+                # also not `None`
+                assert d is not None
+                connections[b1_i].append((b2_i, d, relation))
 
-            if relation is None:
-                continue
+        return connections
 
-            d = distance_labeled_crops(b1, b2)
-            # as `distance_labeled_crops` returns `Optional`, but if `relation` is not `None`, then this must be also
-            # not `None`
-            assert d is not None
-            connections[b1_i].append((b2_i, d, relation))
 
-    return connections
+def get_all_symbols_relations_connections(labeled_crops: LabeledCrops) -> List[List[Tuple[int, float, str]]]:
+    return RelationGraph(labeled_crops).connections
 
 
 def get_all_symbols_normalized_connections(labeled_crops: LabeledCrops) -> List[List[Tuple[int, float]]]:
-    connections = get_all_symbols_relations_connections(labeled_crops)
-
-    connections = [
-        [
-            (j, compute_modified_distance(distance, relation))
-            for j, distance, relation in connecting
-        ]
-        for connecting in connections
-    ]
-
-    return connections
+    return RelationGraph(labeled_crops).weights
 
 
 def get_minimum_spanning_tree_symbol_connections(labeled_crops: LabeledCrops) -> List[Tuple[int, int]]:
-    connections = get_all_symbols_normalized_connections(labeled_crops)
-    return sorted(find_minimum_spanning_tree(connections))
+    return RelationGraph(labeled_crops).minimum_spanning_tree()
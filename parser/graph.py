@@ -1,110 +1,164 @@
-from typing import List, Tuple
+from math import log2
+from typing import List, Tuple, Optional
+
+import numpy as np
 
 
 def find_minimum_spanning_tree(connections: List[List[Tuple[int, float]]]) -> List[Tuple[int, int]]:
     """
     @param connections: graph list, each element in the list contain a list of edges, each edge has the destination node number
                         and the distance.
+    @return: the edges of the minimum spanning tree, each edge is returned in the same direction it was given in
+             `connections`. If the graph is not connected, the minimum spanning forest is returned instead.
+
+    Edges with the same weight are ordered by their position in `connections`, so the result is always the same
+    regardless of the algorithm used.
+    """
+    n = len(connections)
+    edges = [
+        (i, j, distance)
+        for i, connecting in enumerate(connections)
+        for j, distance in connecting
+    ]
+
+    if __is_dense(n, len(edges)):
+        return __find_minimum_spanning_tree_dense(n, edges)
+
+    return find_minimum_spanning_forest_kruskal(n, edges)
+
+
+def __is_dense(vertices_count: int, edges_count: int) -> bool:
+    # Prim's on the weights matrix is `O(V^2)`, and Kruskal's is `O(E log E)` because of sorting the edges
+    return edges_count * log2(max(edges_count, 2)) >= vertices_count * vertices_count
+
+
+def __find_minimum_spanning_tree_dense(n: int, edges: List[Tuple[int, int, float]]) -> List[Tuple[int, int]]:
+    weights = np.full((n, n), np.inf)
+    # the order of the edge in `edges`, used to break ties between edges with the same weight
+    ranks = np.full((n, n), len(edges), dtype=np.int64)
+    # the source node of the edge, as the matrix is symmetric and the result should keep the edges direction
+    sources = np.zeros((n, n), dtype=np.int64)
+
+    for rank, (u, v, w) in enumerate(edges):
+        # only keep the first smallest edge between two nodes, which is the same one Kruskal's would pick
+        if w < weights[u, v] or (w == weights[u, v] and rank < ranks[u, v]):
+            weights[u, v] = weights[v, u] = w
+            ranks[u, v] = ranks[v, u] = rank
+            sources[u, v] = sources[v, u] = u
+
+    result = []
+    for parent, child in find_minimum_spanning_forest_prim(weights, ranks):
+        source = sources[parent, child]
+        destination = child if source == parent else parent
+        result.append((int(source), int(destination)))
+
+    return result
+
+
+def find_minimum_spanning_forest_prim(weights: np.ndarray, ranks: Optional[np.ndarray] = None) -> \
+        List[Tuple[int, int]]:
     """
-    g = __Graph(len(connections))
-
-    visited = []
-
-    for i, connectings in enumerate(connections):
-        for j, distance in connectings:
-            if (i, j) in visited or (j, i) in visited:
-                continue
-            g.addEdge(i, j, distance)
-
-    return g.KruskalMST()
-
-
-class __Graph:
-    def __init__(self, vertices):
-        self.V = vertices  # No. of vertices
-        self.graph = []  # default dictionary
-        # to store graph
-
-    # function to add an edge to graph
-    def addEdge(self, u, v, w):
-        self.graph.append([u, v, w])
-
-    # A utility function to find set of an element i
-    # (uses path compression technique)
-    def find(self, parent, i):
-        if parent[i] == i:
-            return i
-        return self.find(parent, parent[i])
-
-    # A function that does union of two sets of x and y
-    # (uses union by rank)
-    def union(self, parent, rank, x, y):
-        xroot = self.find(parent, x)
-        yroot = self.find(parent, y)
-
-        # Attach smaller rank tree under root of
-        # high rank tree (Union by Rank)
-        if rank[xroot] < rank[yroot]:
-            parent[xroot] = yroot
-        elif rank[xroot] > rank[yroot]:
-            parent[yroot] = xroot
-
-        # If ranks are same, then make one as root
-        # and increment its rank by one
+    Dense Prim's algorithm, works in `O(V^2)` over the weights matrix.
+
+    @param weights: symmetric `n x n` matrix of the weights, `inf` is used for missing edges
+    @param ranks: optional symmetric `n x n` matrix used to break ties between edges of the same weight
+                  (the smaller is picked first)
+    @return: `(parent, child)` edges of the minimum spanning forest
+    """
+    n = len(weights)
+
+    if ranks is None:
+        ranks = np.zeros((n, n), dtype=np.int64)
+
+    in_tree = np.zeros(n, dtype=bool)
+    best_weights = np.full(n, np.inf)
+    best_ranks = np.zeros(n, dtype=np.int64)
+    best_parents = np.full(n, -1, dtype=np.int64)
+
+    result = []
+
+    for _ in range(n):
+        candidates_weights = np.where(in_tree, np.inf, best_weights)
+        min_weight = candidates_weights.min()
+
+        if np.isinf(min_weight):
+            # start a new tree (of the forest) from the first node not yet visited
+            node = int(np.argmin(in_tree))
         else:
-            parent[yroot] = xroot
-            rank[xroot] += 1
-
-    # The main function to construct MST using Kruskal's
-    # algorithm
-    def KruskalMST(self):
-
-        result = []  # This will store the resultant MST
-
-        # An index variable, used for sorted edges
-        i = 0
-
-        # An index variable, used for result[]
-        e = 0
-
-        # Step 1:  Sort all the edges in
-        # non-decreasing order of their
-        # weight.  If we are not allowed to change the
-        # given graph, we can create a copy of graph
-        self.graph = sorted(self.graph,
-                            key=lambda item: item[2])
-
-        parent = []
-        rank = []
-
-        # Create V subsets with single elements
-        for node in range(self.V):
-            parent.append(node)
-            rank.append(0)
-
-        # Number of edges to be taken is equal to V-1
-        while e < self.V - 1:
-            # Step 2: Pick the smallest edge and increment
-            # the index for next iteration
-            u, v, w = self.graph[i]
-            i = i + 1
-            x = self.find(parent, u)
-            y = self.find(parent, v)
-
-            # If including this edge does't
-            #  cause cycle, include it in result
-            #  and increment the indexof result
-            # for next edge
-            if x != y:
-                e = e + 1
-                result.append([u, v, w])
-                self.union(parent, rank, x, y)
-            # Else discard the edge
-
-        return_result = []
-        minimumCost = 0
-        for u, v, weight in result:
-            minimumCost += weight
-            return_result.append((u, v))
-
-        return return_result
+            candidates_ranks = np.where(candidates_weights == min_weight, best_ranks, np.iinfo(np.int64).max)
+            node = int(np.argmin(candidates_ranks))
+            result.append((int(best_parents[node]), node))
+
+        in_tree[node] = True
+
+        node_weights = weights[node]
+        node_ranks = ranks[node]
+        better = ~in_tree & ((node_weights < best_weights) |
+                             ((node_weights == best_weights) & (node_ranks < best_ranks) & ~np.isinf(node_weights)))
+
+        best_weights[better] = node_weights[better]
+        best_ranks[better] = node_ranks[better]
+        best_parents[better] = node
+
+    return result
+
+
+def find_minimum_spanning_forest_kruskal(n: int, edges: List[Tuple[int, int, float]]) -> List[Tuple[int, int]]:
+    """
+    Kruskal's algorithm, works in `O(E log E)`, better for sparse graphs.
+
+    @param n: number of nodes
+    @param edges: list of `(u, v, weight)`, edges with the same weight are picked in the order they appear in
+    @return: `(u, v)` edges of the minimum spanning forest
+    """
+    disjoint_sets = __DisjointSets(n)
+    result = []
+
+    # `sorted` is stable, so edges with the same weight are kept in order
+    for u, v, _w in sorted(edges, key=lambda edge: edge[2]):
+        # a tree of `n` nodes has `n - 1` edges, if we reach that, there is no need to check the rest
+        if len(result) == n - 1:
+            break
+
+        if disjoint_sets.union(u, v):
+            result.append((u, v))
+
+    return result
+
+
+class __DisjointSets:
+    def __init__(self, n: int) -> None:
+        self.parent = list(range(n))
+        self.rank = [0] * n
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+
+        # path compression
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+
+        return root
+
+    def union(self, x: int, y: int) -> bool:
+        """
+        @return: True if the two sets were merged, False if they are already in the same set
+        """
+        x_root = self.find(x)
+        y_root = self.find(y)
+
+        if x_root == y_root:
+            return False
+
+        # Attach smaller rank tree under root of high rank tree (Union by Rank)
+        if self.rank[x_root] < self.rank[y_root]:
+            self.parent[x_root] = y_root
+        elif self.rank[x_root] > self.rank[y_root]:
+            self.parent[y_root] = x_root
+        else:
+            self.parent[y_root] = x_root
+            self.rank[x_root] += 1
+
+        return True
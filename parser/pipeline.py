@@ -0,0 +1,210 @@
+from concurrent.futures import Executor
+from hashlib import sha256
+from typing import List, Tuple, Dict, Any, Callable, Optional
+
+from PIL import Image
+
+from classifier.batcher import ClassificationBatcher
+from classifier.classifier import SVMClassifier
+from classifier.labeler import get_labeled_crops_from_crop_masks, get_labeled_crops_from_predictions, \
+    draw_labeled_crops
+from segmenter.crop_mask import CropMask
+from segmenter.labeler import draw_crops_rects
+from segmenter.symbol_segmenter import segment_image_crop_masks
+from utils.cache import ResultCache
+from utils.image import img_to_binary
+from utils.types import LabeledCrops, Box
+from .connections import RelationGraph
+from .tree import SymbolTree
+
+
+class ExpressionPipeline:
+    """
+    Runs the whole system (binarization, segmentation, classification and parsing) on a single image, every stage
+    is computed only when it is needed and only once, so asking for many results of the same image (like the crops,
+    the tree and the LaTeX string) does not run the previous stages again.
+
+    If a stage fails, its exception is kept and raised again for all the stages that depend on it.
+
+    If a `cache` is given, the results of the stages are shared between all pipelines of images with the same
+    content, as long as the same model is used.
+
+    If a `batcher` (of the same model) is given, the crops are classified by it together with the crops of other
+    pipelines running at the same time.
+    """
+
+    def __init__(self, img: Image, svm_model: SVMClassifier, cache: Optional[ResultCache] = None,
+                 batcher: Optional[ClassificationBatcher] = None) -> None:
+        assert batcher is None or batcher.svm_model is svm_model, "the batcher must use the same model"
+
+        self.img: Image = img
+        self.svm_model: SVMClassifier = svm_model
+        self.cache: Optional[ResultCache] = cache
+        self.batcher: Optional[ClassificationBatcher] = batcher
+        # the result (or exception) of every stage that was computed
+        self.__stages: Dict[Any, Tuple[Any, Exception]] = dict()
+        self.__image_hash: Optional[str] = None
+
+        if self.cache is not None:
+            self.cache.validate(svm_model.fingerprint)
+
+    @property
+    def image_hash(self) -> str:
+        """
+        Hash of the decoded image content, so the same image gives the same hash even if it was encoded differently
+        """
+        if self.__image_hash is None:
+            img_hash = sha256(f"{self.img.mode}:{self.img.size}:".encode())
+            img_hash.update(self.img.tobytes())
+            self.__image_hash = img_hash.hexdigest()
+
+        return self.__image_hash
+
+    def __has_stage(self, key: Any) -> bool:
+        """
+        @return: True if the stage was computed by this pipeline, or found in the cache
+        """
+        if key in self.__stages:
+            return True
+
+        if self.cache is not None:
+            stage_result = self.cache.get((self.svm_model.fingerprint, self.image_hash, key))
+
+            if stage_result is not None:
+                self.__stages[key] = stage_result
+                return True
+
+        return False
+
+    def __stage(self, key: Any, compute: Callable[[], Any]) -> Any:
+        if not self.__has_stage(key):
+            try:
+                stage_result = (compute(), None)
+            except Exception as e:
+                stage_result = (None, e)
+
+            # errors are not shared, as their tracebacks keep all the frames (and their images) alive
+            if self.cache is not None and stage_result[1] is None:
+                self.cache.put((self.svm_model.fingerprint, self.image_hash, key), stage_result)
+
+            self.__stages[key] = stage_result
+
+        result, error = self.__stages[key]
+
+        if error is not None:
+            raise error
+
+        return result
+
+    @property
+    def binary_image(self) -> Image:
+        return self.__stage('binary_image', lambda: img_to_binary(self.img))
+
+    @property
+    def crops_masks(self) -> List[Tuple[Box, CropMask]]:
+        return self.__stage('crops_masks', lambda: segment_image_crop_masks(self.binary_image))
+
+    @property
+    def crops(self) -> List[Box]:
+        """
+        The crops in the order of segmentation, (the crops of `labeled_crops` are sorted)
+        """
+        return [crop for crop, _crop_mask in self.crops_masks]
+
+    @property
+    def labeled_crops(self) -> LabeledCrops:
+        classifier = self.batcher if self.batcher is not None else self.svm_model
+
+        return self.__stage('labeled_crops', lambda: get_labeled_crops_from_crop_masks(self.crops_masks, classifier))
+
+    @property
+    def relation_graph(self) -> RelationGraph:
+        return self.__stage('relation_graph', lambda: RelationGraph(self.labeled_crops))
+
+    @property
+    def tree(self) -> SymbolTree:
+        return self.__stage('tree', lambda: SymbolTree(self.labeled_crops, self.relation_graph))
+
+    def latex(self, optimize: bool = True) -> str:
+        return self.__stage(('latex', optimize), lambda: self.tree.get_latex_string(optimize=optimize))
+
+    def segments_image(self) -> Image:
+        return self.__stage('segments_image', lambda: draw_crops_rects(self.binary_image, self.crops))
+
+    def labeled_crops_image(self, no_crops: bool = False) -> Image:
+        def compute():
+            if no_crops:
+                img = self.binary_image
+            else:
+                _labels, crops = list(zip(*self.labeled_crops))
+                img = draw_crops_rects(self.binary_image, crops)
+
+            return draw_labeled_crops(img, self.labeled_crops)
+
+        return self.__stage(('labeled_crops_image', no_crops), compute)
+
+    def symbol_tree_image(self, no_crops: bool = False, no_labels: bool = False) -> Image:
+        def compute():
+            if no_labels:
+                if no_crops:
+                    img = self.binary_image
+                else:
+                    _labels, crops = list(zip(*self.labeled_crops))
+                    img = draw_crops_rects(self.binary_image, crops)
+            else:
+                img = self.labeled_crops_image(no_crops)
+
+            return self.tree.draw_min_connections(img)
+
+        return self.__stage(('symbol_tree_image', no_crops, no_labels), compute)
+
+    @staticmethod
+    def label_crops_batch(pipelines: List['ExpressionPipeline'], executor: Optional[Executor] = None) -> None:
+        """
+        Computes the labeled crops of many images together, the images are segmented in parallel using `executor`
+        (or one after the other if not specified), and then the crops of all the images are classified with a single
+        call to the model, which is a lot faster than classifying the crops of every image alone.
+
+        Errors are kept in the pipeline of each image, and raised when its results are requested.
+        """
+        if not pipelines:
+            return
+
+        svm_model = pipelines[0].svm_model
+        assert all(pipeline.svm_model is svm_model for pipeline in pipelines), "all pipelines must use the same model"
+
+        pending = [pipeline for pipeline in pipelines if not pipeline.__has_stage('labeled_crops')]
+
+        def segment(pipeline: 'ExpressionPipeline') -> Optional[List[Tuple[Box, CropMask]]]:
+            try:
+                return pipeline.crops_masks
+            except Exception:
+                # the error is kept in the pipeline
+                return None
+
+        if executor is not None:
+            all_crops_masks = list(executor.map(segment, pending))
+        else:
+            all_crops_masks = [segment(pipeline) for pipeline in pending]
+
+        crop_masks = [
+            crop_mask
+            for crops_masks in all_crops_masks if crops_masks
+            for _crop, crop_mask in crops_masks
+        ]
+        predicted_labels = svm_model.predict_crop_masks_labels(crop_masks) if crop_masks else []
+
+        start = 0
+        for pipeline, crops_masks in zip(pending, all_crops_masks):
+            if crops_masks is None:
+                continue
+
+            crops = [crop for crop, _crop_mask in crops_masks]
+            labels = list(predicted_labels[start:start + len(crops)])
+            start += len(crops)
+
+            try:
+                pipeline.__stage('labeled_crops', lambda: get_labeled_crops_from_predictions(crops, labels))
+            except Exception:
+                # the error is kept in the pipeline
+                pass
@@ -1,9 +1,18 @@
+import sqlite3
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from tempfile import TemporaryDirectory
 
 from PIL import Image
 
 from classifier.classifier import SVMClassifier
+from classifier.labeler import NoSymbolsException
+from utils.cache import LRUCache, SQLiteCache
+from .graph import find_minimum_spanning_tree
+from .pipeline import ExpressionPipeline
 from .tree import SymbolTree
+from .utils import get_most_probable_relation, get_most_probable_relations, RELATIONS
 
 
 class ParserTestCase(unittest.TestCase):
@@ -61,6 +70,173 @@ class ParserTestCase(unittest.TestCase):
                          r"6 -> {left_inverse: [5]},"
                          r"3 -> {left_inverse: [2]},")
 
+    def test_vectorized_relations(self):
+        """
+        This tests that the vectorized `get_most_probable_relations` gives the same relations as calling
+        `get_most_probable_relation` for every pair
+        """
+        labeled_crops = [('\\int', (18, 35, 79, 188)), ('-', (57, 178, 90, 181)), ('-', (88, 38, 121, 41)),
+                         ('3', (99, 159, 121, 193)), ('3', (129, 19, 151, 53)), ('\\frac', (22, 93, 57, 96)),
+                         ('2', (25, 19, 53, 65)), ('1', (28, 113, 51, 159)), ('x', (160, 60, 180, 80))]
+        labels, crops = list(zip(*labeled_crops))
+
+        relations = get_most_probable_relations(labels, crops)
+
+        for i, label_crop1 in enumerate(labeled_crops):
+            for j, label_crop2 in enumerate(labeled_crops):
+                if i == j:
+                    continue
+
+                relation = get_most_probable_relation(label_crop1, label_crop2)
+                expected_code = -1 if relation is None else RELATIONS.index(relation)
+                self.assertEqual(relations[i, j], expected_code)
+
+    def test_vectorized_relations_same_left(self):
+        """
+        This tests that two boxes with the same left edge in a `power`/`sub` position have no relation, and that
+        both `get_most_probable_relation` and `get_most_probable_relations` agree on that
+        """
+        labels = ['2', 'e']
+        crops = [(10, 40, 27, 87), (10, 72, 29, 86)]
+
+        relations = get_most_probable_relations(labels, crops)
+
+        self.assertEqual(relations[0, 1], -1)
+        self.assertEqual(relations[1, 0], RELATIONS.index('none'))
+
+        self.assertIsNone(get_most_probable_relation((labels[0], crops[0]), (labels[1], crops[1])))
+        self.assertEqual(get_most_probable_relation((labels[1], crops[1]), (labels[0], crops[0])), 'none')
+
+    def test_minimum_spanning_forest(self):
+        """
+        This tests that a disconnected graph produces a spanning forest, and that the edges keep their direction
+        """
+        connections = [[(1, 2.0), (2, 1.0)], [(2, 3.0)], [], [(4, 1e6)], []]
+
+        self.assertListEqual(sorted(find_minimum_spanning_tree(connections)), [(0, 1), (0, 2), (3, 4)])
+
+    def test_pipeline_stages(self):
+        """
+        This tests that the pipeline gives the same results as running the stages separately, and that every stage
+        is only computed once
+        """
+        img = Image.open('./testing_dataset/frac_with_multiple_connections.png')
+        pipeline = ExpressionPipeline(img, self.model)
+
+        tree = SymbolTree.from_image(img, self.model)
+
+        self.assertEqual(pipeline.latex(), tree.get_latex_string())
+        self.assertEqual(pipeline.latex(optimize=False), tree.get_latex_string(optimize=False))
+        self.assertEqual(self.tree_str(pipeline.tree), self.tree_str(tree))
+
+        self.assertIs(pipeline.labeled_crops, pipeline.labeled_crops)
+        self.assertIs(pipeline.relation_graph, pipeline.relation_graph)
+        self.assertIs(pipeline.tree, pipeline.tree)
+
+    def test_pipeline_cache(self):
+        """
+        This tests that pipelines of the same image share the cached results, and that the cache is cleared when
+        another model is used
+        """
+        img = Image.open('./testing_dataset/frac_with_multiple_connections.png')
+        cache = LRUCache(max_bytes=64 * 1024 * 1024)
+
+        latex = ExpressionPipeline(img, self.model, cache=cache).latex()
+        misses = cache.misses
+
+        pipeline = ExpressionPipeline(img.copy(), self.model, cache=cache)
+        self.assertEqual(pipeline.latex(), latex)
+        self.assertEqual(cache.misses, misses)
+        self.assertEqual(cache.hits, 1)
+
+        self.model.fingerprint = 'another model'
+        ExpressionPipeline(img, self.model, cache=cache)
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(cache.invalidations, 1)
+
+        # only the most recent entries are kept
+        small_cache = LRUCache(max_bytes=100)
+        small_cache.put('a', 1, size=50)
+        small_cache.put('b', 2, size=50)
+        small_cache.get('a')
+        small_cache.put('c', 3, size=50)
+        self.assertEqual(small_cache.get('b'), None)
+        self.assertEqual(small_cache.get('a'), 1)
+        self.assertEqual(small_cache.evictions, 1)
+
+    def test_pipeline_shared_cache(self):
+        """
+        This tests that the results stored in the SQLite cache can be used by another cache object (like another
+        process would do) without computing them again
+        """
+        img = Image.open('./testing_dataset/frac_with_multiple_connections.png')
+
+        with TemporaryDirectory() as cache_dir:
+            cache_file = path.join(cache_dir, 'cache.sqlite')
+
+            pipeline = ExpressionPipeline(img, self.model, cache=SQLiteCache(cache_file, max_bytes=64 * 1024 * 1024))
+            latex = pipeline.latex()
+            tree = self.tree_str(pipeline.tree)
+
+            other_cache = SQLiteCache(cache_file, max_bytes=64 * 1024 * 1024)
+            other_pipeline = ExpressionPipeline(img, self.model, cache=other_cache)
+            self.assertEqual(other_pipeline.latex(), latex)
+            self.assertEqual(self.tree_str(other_pipeline.tree), tree)
+            self.assertEqual(other_cache.misses, 0)
+
+            self.model.fingerprint = 'another model'
+            ExpressionPipeline(img, self.model, cache=other_cache)
+            self.assertEqual(other_cache.stats()['entries'], 0)
+
+    def test_shared_cache_access(self):
+        """
+        This tests that reading from the SQLite cache does not lock the database, and that the access times are still
+        used to evict the least recently used entries
+        """
+        with TemporaryDirectory() as cache_dir:
+            cache_file = path.join(cache_dir, 'cache.sqlite')
+            cache = SQLiteCache(cache_file, max_bytes=100)
+
+            self.assertTrue(cache.put('a', b'1' * 30))
+            self.assertTrue(cache.put('b', b'2' * 30))
+
+            # entries that were not accessed for a while
+            connection = sqlite3.connect(cache_file, isolation_level=None)
+            connection.execute("UPDATE entries SET last_access = last_access - 100 WHERE key = ?", (repr('a'),))
+            connection.execute("UPDATE entries SET last_access = last_access - 50 WHERE key = ?", (repr('b'),))
+
+            # another process is writing
+            connection.execute("BEGIN IMMEDIATE")
+            self.assertEqual(cache.get('a'), b'1' * 30)
+            connection.execute("COMMIT")
+            connection.close()
+
+            self.assertTrue(cache.put('c', b'3' * 30))
+            self.assertEqual(cache.get('b'), None)
+            self.assertEqual(cache.get('a'), b'1' * 30)
+            self.assertEqual(cache.evictions, 1)
+
+    def test_pipeline_label_crops_batch(self):
+        """
+        This tests that labeling the crops of many images together gives the same results as each image alone,
+        and that an image that fails does not affect the others
+        """
+        filenames = ['frac_with_multiple_connections.png', 'normal_fraction.png', 'dot_on_frac.png']
+        imgs = [Image.open(f'./testing_dataset/{filename}') for filename in filenames]
+        imgs.insert(1, Image.new('L', (50, 50), 255))
+
+        pipelines = [ExpressionPipeline(img, self.model) for img in imgs]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            ExpressionPipeline.label_crops_batch(pipelines, executor=executor)
+
+        with self.assertRaises(NoSymbolsException):
+            _ = pipelines[1].labeled_crops
+        # the segments of an image without symbols can still be drawn
+        self.assertEqual(pipelines[1].segments_image().size, imgs[1].size)
+
+        for img, pipeline in zip(imgs[:1] + imgs[2:], pipelines[:1] + pipelines[2:]):
+            self.assertListEqual(pipeline.labeled_crops, ExpressionPipeline(img, self.model).labeled_crops)
+
     @staticmethod
     def tree_str(tree):
         return str(tree).replace('\n', ',')
@@ -1,26 +1,29 @@
-from typing import List, Tuple
+from typing import List, Tuple, Optional
 
 from PIL import Image
 
 from classifier.classifier import SVMClassifier
 from classifier.labeler import get_labeled_crops
 from utils.types import LabeledCrops
-from .connections import get_all_symbols_relations_connections, get_minimum_spanning_tree_symbol_connections
+from .connections import RelationGraph
 from .labeler import draw_connections
 from .tree_node import SymbolTreeNode
 from .utils import RELATIONS
 
 
 class SymbolTree:
-    def __init__(self, labeled_crops: LabeledCrops, all_relations: List[List[Tuple[int, float, str]]],
-                 min_tree: List[Tuple[int, int]], optimize: bool = True) -> None:
+    def __init__(self, labeled_crops: LabeledCrops, relation_graph: RelationGraph,
+                 min_tree: Optional[List[Tuple[int, int]]] = None, optimize: bool = True) -> None:
         self.nodes = [
             SymbolTreeNode(label, crop, i)
             for i, (label, crop) in enumerate(labeled_crops)
         ]
 
+        if min_tree is None:
+            min_tree = relation_graph.minimum_spanning_tree()
+
         for from_node, to_node in min_tree:
-            _j, _distance, relation = SymbolTree.__find_relation(all_relations, from_node, to_node)
+            _j, _distance, relation = relation_graph.get_relation(from_node, to_node)
 
             self.nodes[from_node].connect_with_relation(self.nodes[to_node], relation)
 
@@ -38,10 +41,9 @@ class SymbolTree:
 
     @classmethod
     def from_labeled_crops(cls, labeled_crops: LabeledCrops, optimize: bool = True) -> 'SymbolTree':
-        relations = get_all_symbols_relations_connections(labeled_crops)
-        min_tree = get_minimum_spanning_tree_symbol_connections(labeled_crops)
+        relation_graph = RelationGraph(labeled_crops)
 
-        return cls(labeled_crops, relations, min_tree, optimize=optimize)
+        return cls(labeled_crops, relation_graph, optimize=optimize)
 
     def add_connection(self, from_node: int, to_node: int, relation: str) -> None:
         self.nodes[from_node].connect_with_relation(self.nodes[to_node], relation)
@@ -103,16 +105,6 @@ class SymbolTree:
 
         return latex_string
 
-    # helper function
-    @staticmethod
-    def __find_relation(all_relations: List[List[Tuple[int, float, str]]], from_node: int, to_node: int) -> \
-            Tuple[int, float, str]:
-        inner_list = all_relations[from_node]
-        try:
-            return next((j, d, r) for j, d, r in inner_list if j == to_node)
-        except StopIteration:
-            raise ValueError(f"could not find relation from {from_node} to {to_node}")
-
     @staticmethod
     def __get_leftmost_node(nodes: List['SymbolTreeNode']) -> 'SymbolTreeNode':
         assert len(nodes) > 0, "cannot find leftmost of an empty list of nodes"
@@ -1,5 +1,5 @@
 from re import sub as re_sub
-from typing import Optional
+from typing import Optional, List
 
 import numpy as np
 
@@ -78,7 +78,13 @@ def get_most_probable_relation(label_crop1: LabelCrop, label_crop2: LabelCrop) -
     if label1 == '\\frac' or label2 == '\\frac':
         angle = angle_between_points(center1, center2)
 
+    # `can_be_power_or_sub` needs `box1` to be to the left of `box2`, boxes with the same left edge
+    # in a `power/sub` position have no relation
+    same_left = left1 == left2
+
     if perc_perc < 0.85:
+        if (-8 >= angle >= -30 or 15 <= angle <= 60) and label1 != '\\frac' and same_left:
+            return None
         if -8 >= angle >= -30 and label1 != '\\frac' and can_be_power_or_sub(box1, box2):
             return 'sub'
         elif 15 <= angle <= 60 and label1 != '\\frac' and can_be_power_or_sub(box1, box2):
@@ -89,6 +95,8 @@ def get_most_probable_relation(label_crop1: LabelCrop, label_crop2: LabelCrop) -
         if 15 >= angle >= -30:
             return 'none'
 
+    if (-12 >= angle >= -30 or 25 <= angle <= 60) and label1 != '-' and same_left:
+        return None
     if -12 >= angle >= -30 and label1 != '-' and can_be_power_or_sub(box1, box2):
         return 'sub'
     elif 25 <= angle <= 60 and label1 != '-' and can_be_power_or_sub(box1, box2):
@@ -103,6 +111,127 @@ def get_most_probable_relation(label_crop1: LabelCrop, label_crop2: LabelCrop) -
     return 'none'
 
 
+def __can_be_power_or_sub_matrix(boxes: np.ndarray) -> np.ndarray:
+    """
+    Same as `can_be_power_or_sub` for all pairs of boxes, without the assertion of `left1 < left2`, the caller must
+    handle the pairs that do not satisfy it.
+    """
+    left, top, right, down = (boxes[:, i] for i in range(4))
+    w = right - left
+    h = down - top
+
+    left1, top1, right1, down1, h1 = (v[:, None] for v in (left, top, right, down, h))
+    left2, top2, down2 = (v[None, :] for v in (left, top, down))
+
+    too_far = right1 + np.minimum(w[:, None], w[None, :]) < left2
+    is_power = top1 > top2
+    power_too_far = top1 - h1 > down2
+    sub_too_far = down1 + h1 < top2
+
+    return ~too_far & ~(is_power & power_too_far) & ~(~is_power & sub_too_far)
+
+
+def get_most_probable_relations(labels: List[str], boxes: List[Box]) -> np.ndarray:
+    """
+    Vectorized version of `get_most_probable_relation` for all pairs of symbols in an expression.
+
+    @return: `n x n` matrix of relations codes, where `result[i, j]` is the index in `RELATIONS` of the relation
+             between symbol `i` and symbol `j`, or `-1` if there is no relation (`None`), pairs with the same box
+             (including the diagonal) have no relation, and so do pairs with the same left edge that could be
+             `power` or `sub`, where `get_most_probable_relation` fails its assertion.
+    """
+    n = len(labels)
+    result = np.full((n, n), -1, dtype=np.int8)
+
+    if n == 0:
+        return result
+
+    boxes_arr = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    left, top, right, down = (boxes_arr[:, i] for i in range(4))
+
+    # per symbol features, computed only once
+    centers_list = [box_center(box) for box in boxes]
+    baselines_list = [get_baseline_center(label, box) for label, box in zip(labels, boxes)]
+    centers = np.array(centers_list, dtype=np.float64)
+    baselines = np.array(baselines_list, dtype=np.float64)
+    percs = np.array([percentage_of_default_size(label, box) for label, box in zip(labels, boxes)], dtype=np.float64)
+    up_down = np.array([can_symbol_have_up_down(label) for label in labels])
+    is_frac = np.array([label == '\\frac' for label in labels])
+    is_minus = np.array([label == '-' for label in labels])
+
+    def angles_between(points_list, points):
+        x_change = points[None, :, 0] - points[:, None, 0]
+        y_change = points[None, :, 1] - points[:, None, 1]
+
+        # `angle_between_points` negates `y_change`, which results in `-0.0` for floats and `0` for integers, this
+        # changes the angle from `180` to `-180`, so we do the same to get exactly the same results
+        y_is_int = np.array([isinstance(p[1], (int, np.integer)) for p in points_list])
+        negative_y_change = -y_change
+        negative_y_change[(y_change == 0) & y_is_int[:, None] & y_is_int[None, :]] = 0.0
+
+        return np.degrees(np.arctan2(negative_y_change, x_change))
+
+    left1, right1 = left[:, None], right[:, None]
+    left2, right2 = left[None, :], right[None, :]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        perc_perc = percs[None, :] / percs[:, None]
+
+    any_frac = is_frac[:, None] | is_frac[None, :]
+    baseline_angle = angles_between(baselines_list, baselines)
+    angle = np.where(any_frac, angles_between(centers_list, centers), baseline_angle)
+    can_be_power_or_sub = __can_be_power_or_sub_matrix(boxes_arr)
+
+    # the codes of the relations
+    left_code, power_code, sub_code, up_code, down_code, none_code = (RELATIONS.index(r) for r in
+                                                                       ['left', 'power', 'sub', 'up', 'down', 'none'])
+
+    # pairs that still did not get a result, the rules are applied in order, and each rule only applies to the
+    # pairs that did not match any previous rule
+    undecided = ~(boxes_arr[:, None, :] == boxes_arr[None, :, :]).all(axis=2)
+
+    def decide(condition, code):
+        nonlocal undecided
+        matched = undecided & condition
+        result[matched] = code
+        undecided = undecided & ~matched
+
+    def decide_power_or_sub(condition, code):
+        # `can_be_power_or_sub` needs `box1` to be to the left of `box2`, boxes with the same left edge
+        # in a `power/sub` position have no relation
+        decide(condition & (left1 >= left2), -1)
+        decide(condition & can_be_power_or_sub, code)
+
+    # the left should be first
+    undecided &= ~(left1 > left2)
+
+    surrounds = (left1 <= left2) & (right1 >= right2) & up_down[:, None]
+    decide(surrounds & (baseline_angle > 0), up_code)
+    decide(surrounds, down_code)
+
+    # this is a case where the top/down is a bit outside the boundary of the \frac element
+    # which results in having `power/sub` connection which is not true
+    decide((left2 < right1) & (right1 < right2) & up_down[None, :], -1)
+
+    not_frac1 = ~is_frac[:, None]
+    smaller = perc_perc < 0.85
+    decide_power_or_sub(smaller & (-8 >= angle) & (angle >= -30) & not_frac1, sub_code)
+    decide_power_or_sub(smaller & (15 <= angle) & (angle <= 60) & not_frac1, power_code)
+
+    # cannot have power, sub or left of smaller symbol to a larger symbol
+    decide((np.abs(perc_perc - 1) > 0.15) & ~any_frac & (15 >= angle) & (angle >= -30), none_code)
+
+    not_minus1 = ~is_minus[:, None]
+    decide_power_or_sub((-12 >= angle) & (angle >= -30) & not_minus1, sub_code)
+    decide_power_or_sub((25 <= angle) & (angle <= 60) & not_minus1, power_code)
+    decide((-10 <= angle) & (angle <= 10), left_code)
+    decide((140 >= angle) & (angle >= 60) & up_down[:, None], up_code)
+    decide((-60 >= angle) & (angle >= -130) & up_down[:, None], down_code)
+    decide(np.ones((n, n), dtype=bool), none_code)
+
+    return result
+
+
 def distance_labeled_crops(label_crop1: LabelCrop, label_crop2: LabelCrop) -> Optional[float]:
     label1, box1 = label_crop1
     label2, box2 = label_crop2
@@ -0,0 +1,70 @@
+# compares the speed of the PDF rasterizers (`dataset_generator.generator.RASTERIZERS`) on a multi-page PDF
+# of generated expressions, like the ones of batch generation
+
+import time
+from argparse import ArgumentParser
+from os import path, remove
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from dataset_generator.generator import RASTERIZERS, compile_latex_document, fill_expression_template
+from dataset_generator.template import generate_latex_batch_document
+
+templates = [
+    "{num1} {operator1} {num2}{latin1}",
+    "\\frac{{{num1}{latin1}}}{{{num2}}}",
+    "e^{{{num1}}}+\\frac{{{latin1}^{digit1}+{latin2}^{digit2}}}{{{latin3}+{latin4}^{latin5}}}",
+    "\\int^{{{num1}\\pi}}_{{{num2}\\pi}}{{x^{{{num4}}}dx}}",
+]
+
+parser = ArgumentParser(description='Fyp rasterizers benchmark')
+parser.add_argument('--density', '-d', type=int, action='store', default=500,
+                    help='image density in DPI, same as `image_density` of the generators (default 500)')
+parser.add_argument('--pages', '-p', type=int, action='store', default=32,
+                    help='number of pages (expressions) of the PDF (default 32)')
+parser.add_argument('--repeat', '-n', type=int, action='store', default=3,
+                    help='number of times every rasterizer converts the PDF (default 3)')
+
+args = parser.parse_args()
+
+working_dir = mkdtemp(prefix="rasterizer_benchmark")
+
+exprs = [fill_expression_template(templates[i % len(templates)]) for i in range(args.pages)]
+return_code = compile_latex_document(generate_latex_batch_document(exprs), working_dir, "benchmark")
+
+if return_code != 0:
+    rmtree(working_dir)
+    raise RuntimeError(f"could not compile the benchmark document, pdflatex returned with code={return_code}")
+
+print(f"{'rasterizer':<12} {'seconds/pdf':>12} {'pages/second':>13} {'KB/page':>8}")
+
+for rasterizer in RASTERIZERS:
+    if not rasterizer.is_available():
+        print(f"{rasterizer.name:<12} not installed")
+        continue
+
+    times = []
+    pages_size = 0
+    try:
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            rasterizer.rasterize(working_dir, "benchmark", args.density, multi_page=True)
+            times.append(time.perf_counter() - start_time)
+
+            pages_filenames = rasterizer.page_filenames(working_dir, "benchmark")
+            assert len(pages_filenames) == args.pages, \
+                f"{rasterizer.name} produced {len(pages_filenames)} pages instead of {args.pages}"
+
+            pages_size = sum(path.getsize(path.join(working_dir, filename)) for filename in pages_filenames)
+            for filename in pages_filenames:
+                remove(path.join(working_dir, filename))
+    except RuntimeError as e:
+        print(f"{rasterizer.name:<12} failed: {e}")
+        continue
+
+    # the fastest run, which is the least affected by other programs
+    best_time = min(times)
+    print(f"{rasterizer.name:<12} {best_time:>12.3f} {args.pages / best_time:>13.1f} "
+          f"{pages_size / args.pages / 1024:>8.1f}")
+
+rmtree(working_dir)
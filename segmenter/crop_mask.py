@@ -0,0 +1,45 @@
+import numpy as np
+from PIL import Image
+
+from utils.types import Box
+from .utils import merge_boxes
+
+
+class CropMask:
+    """
+    The image of a single segment, only the part inside `box` is stored, everything outside of it is considered
+    white (`True`), which is the same format of binary ("1") images.
+    """
+
+    def __init__(self, box: Box, mask: np.ndarray) -> None:
+        l, t, r, d = box
+
+        assert mask.dtype == bool
+        assert mask.shape == (d - t, r - l), f"mask of shape {mask.shape} does not match the box {box}"
+
+        self.box: Box = box
+        self.mask: np.ndarray = mask
+
+    @classmethod
+    def from_full_image(cls, img_arr: np.ndarray, box: Box) -> 'CropMask':
+        l, t, r, d = box
+
+        return cls(box, img_arr[t:d, l:r].copy())
+
+    def merge(self, other: 'CropMask') -> 'CropMask':
+        """
+        Merges the two masks over their union box, black pixels from both masks are kept
+        """
+        box = merge_boxes(self.box, other.box)
+        l, t, r, d = box
+
+        mask = np.ones((d - t, r - l), dtype=bool)
+
+        for crop_mask in [self, other]:
+            c_l, c_t, c_r, c_d = crop_mask.box
+            mask[c_t - t:c_d - t, c_l - l:c_r - l] &= crop_mask.mask
+
+        return CropMask(box, mask)
+
+    def to_image(self) -> Image:
+        return Image.fromarray(self.mask)
@@ -5,7 +5,7 @@ from .symbol_segmenter import segment_image_crops
 
 
 def draw_crops_rects(img, crops=None):
-    if not crops:
+    if crops is None:
         crops = segment_image_crops(img_to_binary(img), use_opencv=True)
     labeled_img = img.copy()
     labeled_img = labeled_img.convert('RGB')
@@ -1,10 +1,12 @@
 import copy
 from itertools import permutations
-from typing import Tuple
+from typing import Tuple, Optional, List
 
 import cv2
 from PIL import Image, ImageOps
 
+from utils.types import Box
+from .crop_mask import CropMask
 from .simple_identifiers import *
 from .utils import *
 
@@ -14,70 +16,74 @@ class TooManyCropsException(Exception):
         super().__init__(f"The number of segments is too large ({l}), the maximum support is 100 segments")
 
 
-def __segment_char_flood_fill(img: np.ndarray, start: Tuple[int, int]):
+def __find_rows_runs(img_arr: np.ndarray):
     """
-    Runs given the image and where it should start,
-    it will go recursively from the starting position and remove every
-    black pixel until there is no more connected black pixels.
+    Finds all horizontal runs of black pixels in the image.
 
-    Returns:
-    - the image with the character containing `start` removed.
-    - the box boundaries of the character
+    Returns 3 arrays `rows`, `starts`, `ends` of the runs, sorted by row then start, `ends` is exclusive.
     """
+    h, w = img_arr.shape
+
+    foreground = np.zeros((h, w + 2), dtype=np.int8)
+    foreground[:, 1:-1] = ~img_arr
+
+    changes = np.diff(foreground, axis=1)
+    rows, starts = np.nonzero(changes == 1)
+    _, ends = np.nonzero(changes == -1)
 
-    assert img.dtype == bool
+    return rows, starts, ends
 
-    img = img.copy()
-    result_img_cropped = np.ones_like(img, dtype=bool)
-    h, w = img.shape
 
-    left = right = start[0]
-    top = down = start[1]
+def __find_connected_runs(rows: np.ndarray, starts: np.ndarray, ends: np.ndarray, w: int):
+    """
+    Finds all pairs of runs that are touching (8-connectivity) in two adjacent rows.
+    """
+    # by flattening the (row, column) into one key, runs of all rows can be searched at once, and since the runs
+    # of one row do not overlap, both their starts and ends are sorted
+    row_size = w + 2
+    start_keys = rows * row_size + starts
+    end_keys = rows * row_size + ends
+
+    # for every run, find the runs in the previous row that touches it, including diagonally
+    prev_row_offset = (rows - 1) * row_size
+    first = np.searchsorted(end_keys, prev_row_offset + starts, side='left')
+    last = np.searchsorted(start_keys, prev_row_offset + ends, side='right')
 
-    queue = {start}
-    visited = set()
+    counts = np.maximum(last - first, 0)
+    runs = np.repeat(np.arange(len(rows)), counts)
+    # index of each connected run in the previous row, `first` of the run + the position inside its group
+    group_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    prev_runs = np.repeat(first, counts) + group_offsets
 
-    while queue:
-        now = queue.pop()
+    return runs, prev_runs
 
-        # add to visited
-        visited.add(now)
 
-        # convert the pixel to white
-        # Access in arrays is in `y, x` or `row, col` that's why it is inverted here
-        img[now[1], now[0]] = True
-        # move the into the result img crop
-        result_img_cropped[now[1], now[0]] = False
+def __union_find_roots(count: int, connections_a: np.ndarray, connections_b: np.ndarray) -> np.ndarray:
+    parent = list(range(count))
 
-        if now[0] > right:
-            right = now[0]
-        if now[0] < left:
-            left = now[0]
-        if now[1] > down:
-            down = now[1]
-        if now[1] < top:
-            top = now[1]
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
 
-        # look trough all 8 surrounding pixels
-        for i in range(-1, 2):
-            for j in range(-1, 2):
-                if i == 0 and j == 0:
-                    continue
+        # path compression
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
 
-                x = now[0] + i
-                y = now[1] + j
+        return root
 
-                # in bounds
-                if 0 <= x < w and 0 <= y < h:
-                    # not visited
-                    if (x, y) not in visited:
-                        # black
-                        # Access in arrays is inverted
-                        if not img[y, x]:
-                            queue.add((x, y))
+    for a, b in zip(connections_a.tolist(), connections_b.tolist()):
+        a_root = find(a)
+        b_root = find(b)
 
-    # the plus 1 is for the extra space we didn't reach
-    return (left, top, right + 1, down + 1), img, result_img_cropped
+        if a_root != b_root:
+            # keep the smaller index as the root, so that components roots are stable
+            if a_root < b_root:
+                parent[b_root] = a_root
+            else:
+                parent[a_root] = b_root
+
+    return np.array([find(i) for i in range(count)], dtype=np.int64)
 
 
 def __find_possible_equal_merges(crops, _img):
@@ -172,13 +178,7 @@ def __find_possible_i_j_merges(crops, img):
     return list(filter(lambda x: can_be_i_j(x[0], x[1]), possible_combinations))
 
 
-def __merge_cropped_images(cropped_img1, cropped_img2):
-    assert cropped_img1.shape == cropped_img2.shape
-
-    return cropped_img1 & cropped_img2
-
-
-def __merge_segments(crops, cropped_images, possible_merges):
+def __merge_segments(crops, crop_masks, possible_merges):
     if len(possible_merges) != 0:
         crops = copy.deepcopy(crops)
 
@@ -192,33 +192,22 @@ def __merge_segments(crops, cropped_images, possible_merges):
 
         crops.append(merge_boxes(c1, c2))
 
-        cropped_images.append(__merge_cropped_images(cropped_images[c1_i], cropped_images[c2_i]))
+        crop_masks.append(crop_masks[c1_i].merge(crop_masks[c2_i]))
 
     for index in sorted(indices_to_remove, reverse=True):
         crops.pop(index)
-        cropped_images.pop(index)
+        crop_masks.pop(index)
 
-    return crops, cropped_images
+    return crops, crop_masks
 
 
-def __try_merge_segments(crops, cropped_images, img):
+def __try_merge_segments(crops, crop_masks, img):
     # order is important
-    crops, cropped_images = __merge_segments(crops, cropped_images, __find_possible_equal_merges(crops, img))
-    crops, cropped_images = __merge_segments(crops, cropped_images, __find_possible_colon_merges(crops, img))
-    crops, cropped_images = __merge_segments(crops, cropped_images, __find_possible_i_j_merges(crops, img))
-
-    return crops, cropped_images
+    crops, crop_masks = __merge_segments(crops, crop_masks, __find_possible_equal_merges(crops, img))
+    crops, crop_masks = __merge_segments(crops, crop_masks, __find_possible_colon_merges(crops, img))
+    crops, crop_masks = __merge_segments(crops, crop_masks, __find_possible_i_j_merges(crops, img))
 
-
-def __final_crop_images(crops, cropped_images):
-    assert len(crops) == len(cropped_images)
-
-    result = []
-
-    for crop, cropped_image in zip(crops, cropped_images):
-        result.append(Image.fromarray(cropped_image).crop(crop))
-
-    return result
+    return crops, crop_masks
 
 
 def __convert_to_ltrd(bounding_box):
@@ -234,60 +223,151 @@ def __get_crops_images_opencv(img: Image):
     components, _ = cv2.findContours(gray_inverted_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     crops = [__convert_to_ltrd(cv2.boundingRect(c)) for c in components]
 
-    cropped_images = [None] * len(crops)
-    for i in range(len(components)):
-        mask = np.zeros_like(gray_inverted_img)
-        cv2.drawContours(mask, components, i, 255, -1)  # Draw filled contour in mask
-        out = np.ones_like(img_arr, dtype=bool)
-        out[mask == 255] = img_arr[mask == 255]
+    crop_masks = [None] * len(crops)
+    for i, (l, t, r, d) in enumerate(crops):
+        # the mask only covers the bounding box of the contour, so the contour is moved to be relative to it
+        mask = np.zeros((d - t, r - l), dtype=np.uint8)
+        cv2.drawContours(mask, components, i, 255, -1, offset=(-l, -t))  # Draw filled contour in mask
+        out = np.ones_like(mask, dtype=bool)
+        out[mask == 255] = img_arr[t:d, l:r][mask == 255]
+
+        crop_masks[i] = CropMask((l, t, r, d), out)
 
-        cropped_images[i] = out
+    return crops, crop_masks
 
-    return crops, cropped_images
+
+def __get_crops_images_connected_components(img: Image):
+    """
+    Labels all symbols of the image in a single pass using `connectedComponentsWithStats`, this avoids drawing
+    a full image mask for every contour like `__get_crops_images_opencv` does.
+    """
+    img_arr = np.asarray(img)
+
+    # the black pixels (False) are the foreground
+    foreground = (~img_arr).astype(np.uint8)
+    components_count, labels, stats, _centroids = cv2.connectedComponentsWithStats(foreground, connectivity=8)
+
+    crops = []
+    crop_masks = []
+    # label `0` is the background, the labels are iterated in reverse to get the same order as `findContours`,
+    # which matters when sorting symbols that have the same left and right
+    for i in reversed(range(1, components_count)):
+        l, t, w, h, _pixel_count = stats[i]
+        crop = (int(l), int(t), int(l + w), int(t + h))
+
+        crops.append(crop)
+        crop_masks.append(CropMask(crop, labels[t:t + h, l:l + w] != i))
+
+    return crops, crop_masks
 
 
 def __get_crops_images_flood_fill(img: Image):
-    img_arr = np.array(img)
+    """
+    Pure NumPy segmentation (no OpenCV), which labels the runs of black pixels of every row and connects them
+    with union-find (8-connectivity), resulting in the same segments of flood filling each symbol.
+    """
+    img_arr = np.asarray(img, dtype=bool)
     h, w = img_arr.shape
 
+    rows, starts, ends = __find_rows_runs(img_arr)
+
+    if len(rows) == 0:
+        return [], []
+
+    runs, prev_runs = __find_connected_runs(rows, starts, ends, w)
+    roots = __union_find_roots(len(rows), runs, prev_runs)
+
+    # map the roots into components numbers starting from 1
+    roots_ids, runs_components = np.unique(roots, return_inverse=True)
+    runs_components = runs_components.reshape(-1) + 1
+    components_count = len(roots_ids)
+
+    lefts = np.full(components_count + 1, w, dtype=np.int64)
+    tops = np.full(components_count + 1, h, dtype=np.int64)
+    rights = np.zeros(components_count + 1, dtype=np.int64)
+    downs = np.zeros(components_count + 1, dtype=np.int64)
+    np.minimum.at(lefts, runs_components, starts)
+    np.minimum.at(tops, runs_components, rows)
+    np.maximum.at(rights, runs_components, ends)
+    np.maximum.at(downs, runs_components, rows + 1)
+
+    # the order of the components is the order of a column by column scan, which is ordered by the left-most
+    # column, then by the top-most row in that column
+    left_rows = np.full(components_count + 1, h, dtype=np.int64)
+    on_left_column = starts == lefts[runs_components]
+    np.minimum.at(left_rows, runs_components[on_left_column], rows[on_left_column])
+    components_order = np.lexsort((left_rows[1:], lefts[1:])) + 1
+
+    # paint the runs into a labels image, as the runs do not overlap, adding the component number at the start of
+    # the run and subtracting it at the end, then summing over the row fills the run with its component number
+    labels = np.zeros((h, w + 1), dtype=np.int64)
+    np.add.at(labels, (rows, starts), runs_components)
+    np.add.at(labels, (rows, ends), -runs_components)
+    labels = np.cumsum(labels, axis=1)[:, :w]
+
     crops = []
-    cropped_images = []
-    for x in range(w):
-        for y in range(h):
-            # Access in arrays is inverted because it is in form `row, col` == `y, x`
-            if not img_arr[y, x]:
-                (crop_box, img_arr, result_for_this_crop) = __segment_char_flood_fill(img_arr, (x, y))
-                cropped_images.append(result_for_this_crop)
-                crops.append(crop_box)
+    crop_masks = []
+    for i in components_order:
+        l, t, r, d = int(lefts[i]), int(tops[i]), int(rights[i]), int(downs[i])
+        crop = (l, t, r, d)
+
+        crops.append(crop)
+        crop_masks.append(CropMask(crop, labels[t:d, l:r] != i))
+
+    return crops, crop_masks
+
 
-    return crops, cropped_images
+SEGMENTATION_BACKENDS = ['opencv', 'flood_fill', 'connected_components']
 
 
-def segment_image(img: Image, use_opencv: bool = True):
-    if use_opencv:
-        crops, cropped_images = __get_crops_images_opencv(img)
-    else:
-        crops, cropped_images = __get_crops_images_flood_fill(img)
+def __get_crops_images(img: Image, backend: str):
+    if backend == 'opencv':
+        return __get_crops_images_opencv(img)
+    elif backend == 'flood_fill':
+        return __get_crops_images_flood_fill(img)
+    elif backend == 'connected_components':
+        return __get_crops_images_connected_components(img)
+
+    raise ValueError(f"unknown segmentation backend '{backend}', must be one of {SEGMENTATION_BACKENDS}")
+
+
+def segment_image_crop_masks(img: Image, use_opencv: bool = True,
+                             backend: Optional[str] = None) -> List[Tuple[Box, CropMask]]:
+    """
+    Segments the binary image into symbols, each symbol image is stored in a `CropMask` that only covers its box.
+
+    @param use_opencv: kept for compatibility, selects between the `opencv` and `flood_fill` backends
+    @param backend: one of `SEGMENTATION_BACKENDS`, if specified it overrides `use_opencv`
+    """
+    if backend is None:
+        backend = 'opencv' if use_opencv else 'flood_fill'
+
+    crops, crop_masks = __get_crops_images(img, backend)
 
     if (crops_len := len(crops)) > 100:
         raise TooManyCropsException(crops_len)
 
     # tries to find symbols that are mergable, like `=`, `:`, `i`, `j`... and merge them
-    crops, cropped_images = __try_merge_segments(crops, cropped_images, img)
-    cropped_images = __final_crop_images(crops, cropped_images)
+    crops, crop_masks = __try_merge_segments(crops, crop_masks, img)
 
-    def sort_key(crop_image: Tuple) -> int:
-        l, _t, r, _d = crop_image[0]
+    def sort_key(crop_mask: Tuple) -> int:
+        l, _t, r, _d = crop_mask[0]
 
         return l * 1000 - r
 
-    crops_images = list(zip(crops, cropped_images))
+    crops_masks = list(zip(crops, crop_masks))
 
     # return sorted segments from left to right
-    return sorted(crops_images, key=sort_key)
+    return sorted(crops_masks, key=sort_key)
+
+
+def segment_image(img: Image, use_opencv: bool = True, backend: Optional[str] = None):
+    crops_masks = segment_image_crop_masks(img, use_opencv=use_opencv, backend=backend)
+
+    return [(crop, crop_mask.to_image()) for crop, crop_mask in crops_masks]
 
 
-def segment_image_crops(img: Image, use_opencv: bool = True):
-    crops_images = segment_image(img, use_opencv=use_opencv)
-    crops, _cropped_images = list(zip(*crops_images))
+def segment_image_crops(img: Image, use_opencv: bool = True, backend: Optional[str] = None):
+    crops_masks = segment_image_crop_masks(img, use_opencv=use_opencv, backend=backend)
+    crops, _crop_masks = list(zip(*crops_masks))
     return list(crops)
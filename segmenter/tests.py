@@ -1,8 +1,12 @@
 import unittest
 
+import numpy as np
 from PIL import Image
 
-from .symbol_segmenter import segment_image_crops
+from .crop_mask import CropMask
+from .symbol_segmenter import segment_image, segment_image_crops
+from .utils import is_another_in_between
+from .visibility import BoxesVisibility
 
 
 class SegmenterTestCase(unittest.TestCase):
@@ -36,6 +40,51 @@ class SegmenterTestCase(unittest.TestCase):
                               (86, 58, 93, 65), (102, 19, 130, 65), (137, 19, 166, 67), (144, 113, 167, 159),
                               (171, 18, 202, 65), (179, 152, 186, 159), (195, 113, 223, 161)])
 
+    def test_backends_same_segments(self):
+        """
+        This tests that the `connected_components` and `flood_fill` backends produce the same segments as the
+        default `opencv` one
+        """
+        for filename in ['multi_part_symbols.png', 'dot_on_frac.png', 'frac_should_connect_to_leftmost.png']:
+            img = Image.open(f'./testing_dataset/{filename}')
+
+            opencv_segments = sorted(segment_image(img, backend='opencv'), key=lambda x: x[0])
+
+            for backend in ['connected_components', 'flood_fill']:
+                backend_segments = sorted(segment_image(img, backend=backend), key=lambda x: x[0])
+
+                self.assertEqual(len(opencv_segments), len(backend_segments))
+                for (crop1, img1), (crop2, img2) in zip(opencv_segments, backend_segments):
+                    self.assertEqual(crop1, crop2)
+                    self.assertEqual(img1.tobytes(), img2.tobytes())
+
+    def test_crop_mask_merge(self):
+        """
+        This tests merging two crop masks, the result should cover the union box and keep the pixels of both
+        """
+        top_mask = CropMask((2, 1, 5, 3), np.array([[False, True, False], [True, False, True]]))
+        down_mask = CropMask((3, 5, 7, 6), np.array([[False, False, True, False]]))
+
+        merged = top_mask.merge(down_mask)
+
+        self.assertEqual(merged.box, (2, 1, 7, 6))
+        self.assertTrue(np.array_equal(merged.mask, np.array([[False, True, False, True, True],
+                                                              [True, False, True, True, True],
+                                                              [True, True, True, True, True],
+                                                              [True, True, True, True, True],
+                                                              [True, False, False, True, False]])))
+
+    def test_boxes_visibility(self):
+        """
+        This tests that `BoxesVisibility` gives the same result as `is_another_in_between` for all pairs
+        """
+        crops = segment_image_crops(Image.open('./testing_dataset/dot_on_frac.png'))
+        visibility = BoxesVisibility(crops)
+
+        for i, crop1 in enumerate(crops):
+            for j, crop2 in enumerate(crops):
+                self.assertEqual(visibility.is_another_in_between(i, j), is_another_in_between(crop1, crop2, crops))
+
 
 if __name__ == '__main__':
     unittest.main()
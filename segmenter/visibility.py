@@ -0,0 +1,132 @@
+from typing import List, Optional
+
+import numpy as np
+
+from utils.types import Box
+
+
+def _segments_intersect(p0_x, p0_y, p1_x, p1_y, p2_x, p2_y, p3_x, p3_y) -> np.ndarray:
+    """
+    Vectorized version of `utils.geometry.get_line_intersection`, all arguments must be broadcastable together,
+    the same operations are used, so the result is always the same as the scalar version.
+    """
+    s1_x = p1_x - p0_x
+    s1_y = p1_y - p0_y
+    s2_x = p3_x - p2_x
+    s2_y = p3_y - p2_y
+
+    bottom = -s2_x * s1_y + s1_x * s2_y
+
+    # parallel lines have `bottom == 0`, and will result in `nan` or `inf` which are removed later
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = (-s1_y * (p0_x - p2_x) + s1_x * (p0_y - p2_y)) / bottom
+        t = (s2_x * (p0_y - p2_y) - s2_y * (p0_x - p2_x)) / bottom
+
+    return (bottom != 0) & (0 <= s) & (s <= 1) & (0 <= t) & (t <= 1)
+
+
+def _border_lines(boxes: np.ndarray):
+    """
+    Same as `segmenter.utils.get_border_lines`, but for all boxes at once, the result is the 4 points
+    coordinates `(p0_x, p0_y, p1_x, p1_y)` of shape `(len(boxes), 4)`
+    """
+    left, top, right, down = boxes.T
+
+    p0_x = np.stack([left, left, right, right], axis=1)
+    p0_y = np.stack([down, top, top, down], axis=1)
+    p1_x = np.stack([left, right, right, left], axis=1)
+    p1_y = np.stack([top, top, down, down], axis=1)
+
+    return p0_x, p0_y, p1_x, p1_y
+
+
+class BoxesVisibility:
+    """
+    Precomputes for all pairs of boxes which other boxes are blocking the line between their centers, this gives
+    the same result as calling `segmenter.utils.is_another_in_between` for every pair, but all at once.
+    """
+
+    def __init__(self, boxes: List[Box]) -> None:
+        self.boxes: List[Box] = list(boxes)
+        # `occlusion[i, j, k]` is True when the box `k` blocks the line between the centers of boxes `i` and `j`
+        self.occlusion: np.ndarray = BoxesVisibility.__compute_occlusion(np.asarray(self.boxes, dtype=np.float64))
+
+    def is_another_in_between(self, i: int, j: int) -> bool:
+        return bool(self.occlusion[i, j].any())
+
+    def visible_pairs(self, ignored: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        @param ignored: optional `n x n` bool matrix, where `ignored[i, k]` means that box `k` should not be
+                        considered when checking the lines starting from box `i`
+        @return: `n x n` bool matrix, True if there is no box in between the two boxes
+        """
+        occlusion = self.occlusion
+
+        if ignored is not None:
+            occlusion = occlusion & ~ignored[:, None, :]
+
+        return ~occlusion.any(axis=2)
+
+    @staticmethod
+    def __compute_occlusion(boxes: np.ndarray) -> np.ndarray:
+        n = len(boxes)
+
+        if n == 0:
+            return np.zeros((0, 0, 0), dtype=bool)
+
+        left, top, right, down = boxes.T
+        centers_x = left + (np.abs(right - left) / 2)
+        centers_y = top + (np.abs(down - top) / 2)
+
+        # `inside[a, k]` is the same as `is_center_inside(boxes[a], boxes[k])`
+        inside = BoxesVisibility.__compute_center_inside(boxes, centers_x, centers_y)
+
+        # `same[a, k]` is True if the two boxes are the same, they are ignored as in `is_another_in_between`
+        same = (boxes[:, None, :] == boxes[None, :, :]).all(axis=2)
+        ignored = same | inside
+
+        p0_x, p0_y, p1_x, p1_y = _border_lines(boxes)
+
+        # the shape of all computations is `(i, j, k)`, line between centers of `i` and `j` and border line of `k`
+        p2_x = centers_x[:, None, None]
+        p2_y = centers_y[:, None, None]
+        p3_x = centers_x[None, :, None]
+        p3_y = centers_y[None, :, None]
+
+        intersects = np.zeros((n, n, n), dtype=bool)
+        for edge in range(4):
+            intersects |= _segments_intersect(p0_x[None, None, :, edge], p0_y[None, None, :, edge],
+                                              p1_x[None, None, :, edge], p1_y[None, None, :, edge],
+                                              p2_x, p2_y, p3_x, p3_y)
+
+        return intersects & ~ignored[:, None, :] & ~ignored[None, :, :]
+
+    @staticmethod
+    def __compute_center_inside(boxes: np.ndarray, centers_x: np.ndarray, centers_y: np.ndarray) -> np.ndarray:
+        # the shape of all computations is `(a, k)`, checking if the center of `a` is inside `k`
+        l1, t1, r1, d1 = (v[:, None] for v in boxes.T)
+        l2, t2, r2, d2 = (v[None, :] for v in boxes.T)
+
+        overlap_area = np.maximum(0, np.minimum(r1, r2) - np.maximum(l1, l2)) * \
+            np.maximum(0, np.minimum(d1, d2) - np.maximum(t1, t2))
+
+        l = np.minimum(l1, l2)
+        t = np.minimum(t1, t2)
+        r = np.maximum(r1, r2)
+        d = np.maximum(d1, d2)
+
+        c_x = centers_x[:, None]
+        c_y = centers_y[:, None]
+
+        p0_x, p0_y, p1_x, p1_y = (v[None, :, :] for v in _border_lines(boxes))
+
+        # lines from the center to all directions in the same order as the border lines
+        left_right_line = (l - 1, c_y, r + 1, c_y)
+        top_bottom_line = (c_x, t - 1, c_x, d + 1)
+
+        inside = overlap_area != 0
+        for edge, center_line in enumerate([left_right_line, top_bottom_line] * 2):
+            inside &= _segments_intersect(p0_x[..., edge], p0_y[..., edge], p1_x[..., edge], p1_y[..., edge],
+                                          *center_line)
+
+        return inside
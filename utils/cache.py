@@ -0,0 +1,384 @@
+import os
+import pickle
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from threading import Lock, local
+from typing import Any, Hashable, Optional, Dict
+
+import numpy as np
+from PIL import Image
+
+
+def estimate_size(obj: Any) -> int:
+    """
+    Estimates the memory used by `obj` in bytes, including all the objects it references, arrays and images are
+    counted by the size of their data.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+
+    while stack:
+        current = stack.pop()
+
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+
+        if isinstance(current, np.ndarray):
+            size += current.nbytes
+        elif isinstance(current, Image.Image):
+            size += current.width * current.height * len(current.getbands())
+        elif isinstance(current, (str, bytes, int, float, bool)) or current is None:
+            size += sys.getsizeof(current)
+        elif isinstance(current, dict):
+            size += sys.getsizeof(current)
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            size += sys.getsizeof(current)
+            stack.extend(current)
+        elif isinstance(current, BaseException):
+            size += sys.getsizeof(current)
+            stack.extend(current.args)
+        elif hasattr(current, '__dict__'):
+            size += sys.getsizeof(current)
+            stack.append(vars(current))
+        else:
+            size += sys.getsizeof(current)
+
+    return size
+
+
+class ResultCache:
+    """
+    Interface of the caches that can be used to store the results of the recognition pipeline.
+
+    The cache can be bound to a model `fingerprint` using `validate`, if a different fingerprint is given, all the
+    entries are removed, as they were computed with another model.
+    """
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        @return: the cached value, or None if the key is not found
+        """
+        raise NotImplementedError()
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> bool:
+        """
+        @param size: the size of the value in bytes, estimated if not specified
+        @return: False if the value was not stored
+        """
+        raise NotImplementedError()
+
+    def validate(self, fingerprint: str) -> None:
+        """
+        Removes all entries if they were computed for a different `fingerprint`
+        """
+        raise NotImplementedError()
+
+    def clear(self) -> None:
+        raise NotImplementedError()
+
+    def stats(self) -> dict:
+        raise NotImplementedError()
+
+
+class LRUCache(ResultCache):
+    """
+    Thread safe least recently used cache in memory, limited by the total (estimated) size of its values in bytes.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        assert max_bytes >= 0, "max_bytes cannot be negative"
+
+        self.max_bytes: int = max_bytes
+        self.fingerprint: Optional[str] = None
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+
+        self.__entries: OrderedDict = OrderedDict()
+        self.__size: int = 0
+        self.__lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> bool:
+        """
+        @param size: the size of the value in bytes, estimated using `estimate_size` if not specified
+        @return: False if the value is larger than the whole cache and was not stored
+        """
+        if size is None:
+            size = estimate_size(value)
+
+        if size > self.max_bytes:
+            return False
+
+        with self.__lock:
+            old_entry = self.__entries.pop(key, None)
+            if old_entry is not None:
+                self.__size -= old_entry[1]
+
+            self.__entries[key] = (value, size)
+            self.__size += size
+
+            while self.__size > self.max_bytes:
+                _key, (_value, evicted_size) = self.__entries.popitem(last=False)
+                self.__size -= evicted_size
+                self.evictions += 1
+
+        return True
+
+    def validate(self, fingerprint: str) -> None:
+        with self.__lock:
+            if self.fingerprint == fingerprint:
+                return
+
+            if self.fingerprint is not None:
+                self.invalidations += 1
+
+            self.fingerprint = fingerprint
+            self.__entries.clear()
+            self.__size = 0
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                'entries': len(self.__entries),
+                'bytes': self.__size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+class SQLiteCache(ResultCache):
+    """
+    Least recently used cache stored in an SQLite database file, so it can be shared by all the server processes on
+    the same machine. Values are pickled, and limited by the total size of the pickled data in bytes.
+
+    Every write is done in a single transaction, so other processes never see a partially written entry.
+    The hits, misses and evictions counters are only for this process, while `entries` and `bytes` are shared.
+
+    Reading an entry does not write to the database, so readers do not wait for each other, the access times are
+    kept in memory and written together with the next `put`, or after `ACCESS_UPDATE_SECONDS`.
+    """
+
+    # how long to wait for another process that is writing to the database
+    BUSY_TIMEOUT_SECONDS = 10
+    # the access time of an entry is only updated if it is older than this, which is precise enough for eviction
+    ACCESS_UPDATE_SECONDS = 10
+
+    def __init__(self, filename: str, max_bytes: int) -> None:
+        assert max_bytes >= 0, "max_bytes cannot be negative"
+
+        self.filename: str = filename
+        self.max_bytes: int = max_bytes
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+
+        self.__connections = local()
+        self.__counters_lock = Lock()
+
+        # accesses that are not written to the database yet, key -> access time
+        self.__pending_accesses: Dict[str, float] = dict()
+        self.__pending_accesses_since: Optional[float] = None
+        self.__pending_accesses_lock = Lock()
+
+        with self.__write_transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS entries "
+                               "(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                               "last_access REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+            connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+
+    def __connection(self) -> sqlite3.Connection:
+        # connections cannot be shared between threads, or used by a forked process
+        connection = getattr(self.__connections, 'connection', None)
+
+        if connection is None or self.__connections.pid != os.getpid():
+            connection = sqlite3.connect(self.filename, timeout=SQLiteCache.BUSY_TIMEOUT_SECONDS,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.__connections.connection = connection
+            self.__connections.pid = os.getpid()
+
+        return connection
+
+    def __write_transaction(self) -> '_SQLiteWriteTransaction':
+        return _SQLiteWriteTransaction(self.__connection())
+
+    def __count(self, counter: str, amount: int = 1) -> None:
+        with self.__counters_lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        key = repr(key)
+        row = self.__connection().execute("SELECT value, last_access FROM entries WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            self.__count('misses')
+            return None
+
+        try:
+            value = pickle.loads(row[0])
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            # written by an incompatible version of the code
+            self.__count('misses')
+            return None
+
+        now = time.time()
+        if now - row[1] >= SQLiteCache.ACCESS_UPDATE_SECONDS:
+            self.__record_access(key, now)
+
+        self.__count('hits')
+
+        return value
+
+    def __record_access(self, key: str, access_time: float) -> None:
+        with self.__pending_accesses_lock:
+            self.__pending_accesses[key] = access_time
+
+            if self.__pending_accesses_since is None:
+                self.__pending_accesses_since = access_time
+
+            flush = access_time - self.__pending_accesses_since >= SQLiteCache.ACCESS_UPDATE_SECONDS
+
+        if flush:
+            with self.__write_transaction() as connection:
+                self.__flush_accesses(connection)
+
+    def __flush_accesses(self, connection: sqlite3.Connection) -> None:
+        """
+        Writes the pending access times, must be called inside a write transaction
+        """
+        with self.__pending_accesses_lock:
+            accesses = [(access_time, key) for key, access_time in self.__pending_accesses.items()]
+            self.__pending_accesses.clear()
+            self.__pending_accesses_since = None
+
+        # another process could have accessed the entry later
+        connection.executemany("UPDATE entries SET last_access = MAX(last_access, ?) WHERE key = ?", accesses)
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> bool:
+        """
+        @param size: ignored, the size of the pickled value is used
+        """
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError, RecursionError):
+            return False
+
+        if len(data) > self.max_bytes:
+            return False
+
+        with self.__write_transaction() as connection:
+            # so the eviction uses the latest access times
+            self.__flush_accesses(connection)
+
+            connection.execute("INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                               (repr(key), data, len(data), time.time()))
+
+            total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+            if total_size > self.max_bytes:
+                evicted_keys = []
+                for evicted_key, evicted_size in connection.execute(
+                        "SELECT key, size FROM entries ORDER BY last_access"):
+                    if total_size <= self.max_bytes:
+                        break
+                    evicted_keys.append((evicted_key,))
+                    total_size -= evicted_size
+
+                connection.executemany("DELETE FROM entries WHERE key = ?", evicted_keys)
+                self.__count('evictions', len(evicted_keys))
+
+        return True
+
+    def validate(self, fingerprint: str) -> None:
+        # most of the time the fingerprint did not change, so check without locking the database first
+        if self.__stored_fingerprint(self.__connection()) == fingerprint:
+            return
+
+        with self.__write_transaction() as connection:
+            stored_fingerprint = self.__stored_fingerprint(connection)
+
+            if stored_fingerprint == fingerprint:
+                return
+
+            if stored_fingerprint is not None:
+                self.__count('invalidations')
+
+            connection.execute("DELETE FROM entries")
+            connection.execute("INSERT OR REPLACE INTO metadata (name, value) VALUES ('fingerprint', ?)",
+                               (fingerprint,))
+
+    @staticmethod
+    def __stored_fingerprint(connection: sqlite3.Connection) -> Optional[str]:
+        row = connection.execute("SELECT value FROM metadata WHERE name = 'fingerprint'").fetchone()
+
+        return None if row is None else row[0]
+
+    def clear(self) -> None:
+        with self.__write_transaction() as connection:
+            connection.execute("DELETE FROM entries")
+
+    def stats(self) -> dict:
+        entries, size = self.__connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+
+        with self.__counters_lock:
+            return {
+                'entries': entries,
+                'bytes': size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+class _SQLiteWriteTransaction:
+    """
+    Context manager for a write transaction, the database is locked for writing from the start, so two processes
+    cannot read the same state and then overwrite each other
+    """
+
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        self.connection: sqlite3.Connection = connection
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.connection.execute("COMMIT")
+        else:
+            self.connection.execute("ROLLBACK")
@@ -0,0 +1,181 @@
+import csv
+import json
+import os
+import struct
+from typing import List, Optional, Dict
+
+import numpy as np
+from PIL import Image
+
+# the name of the shard file inside a dataset directory, used instead of the PNG files if it exists
+DATASET_SHARD_FILENAME = 'dataset.shard'
+
+SHARD_MAGIC = b'FYPSHRD1'
+# magic, images count, index offset, strings offset, strings size
+SHARD_HEADER = struct.Struct('<8sQQQQ')
+# every image is `height` rows of `ceil(width / 8)` bytes, starting at `offset`
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('width', '<u4'), ('height', '<u4')])
+
+
+class DatasetShardWriter:
+    """
+    Writes a dataset of binary images with their names and labels into a single shard file.
+
+    The file is: a header, the images bit-packed one after the other (8 pixels per byte, the same layout of `Image`
+    mode '1'), an index of the offset and size of every image, then the names and labels as `json`.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename: str = filename
+        self.names: List[str] = []
+        self.labels: List[str] = []
+        self.__index: List[tuple] = []
+
+        # written to a temporary file first, so a shard that is being written is never read
+        self.__file = open(filename + '.tmp', 'wb')
+        self.__file.write(b'\0' * SHARD_HEADER.size)
+
+    def add(self, name: str, label: str, img: Image) -> None:
+        """
+        Adds a binary image, images of other modes are converted by making every pixel darker than 128 black
+        """
+        if img.mode != '1':
+            img = img.convert('L').point(lambda value: 255 if value >= 128 else 0, mode='1')
+
+        self.__index.append((self.__file.tell(), img.width, img.height))
+        self.names.append(str(name))
+        self.labels.append(str(label))
+
+        self.__file.write(img.tobytes())
+
+    def close(self) -> None:
+        if self.__file.closed:
+            return
+
+        index_offset = self.__file.tell()
+        self.__file.write(np.array(self.__index, dtype=INDEX_DTYPE).tobytes())
+
+        strings = json.dumps({'names': self.names, 'labels': self.labels}).encode()
+        strings_offset = self.__file.tell()
+        self.__file.write(strings)
+
+        self.__file.seek(0)
+        self.__file.write(SHARD_HEADER.pack(SHARD_MAGIC, len(self.__index), index_offset, strings_offset, len(strings)))
+        self.__file.close()
+
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def __enter__(self) -> 'DatasetShardWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.__file.close()
+            os.remove(self.filename + '.tmp')
+
+
+class DatasetShard:
+    """
+    Reads a shard written by `DatasetShardWriter`, the file is memory mapped, so only the images that are used are
+    read from the disk, and the packed images are not copied until they are decoded.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename: str = filename
+        self.__data: np.memmap = np.memmap(filename, dtype=np.uint8, mode='r')
+
+        magic, count, index_offset, strings_offset, strings_size = \
+            SHARD_HEADER.unpack(self.__data[:SHARD_HEADER.size].tobytes())
+
+        if magic != SHARD_MAGIC:
+            raise ValueError(f"{filename} is not a dataset shard")
+
+        self.index: np.ndarray = self.__data[index_offset:index_offset + count * INDEX_DTYPE.itemsize] \
+            .view(INDEX_DTYPE)
+
+        strings = json.loads(self.__data[strings_offset:strings_offset + strings_size].tobytes().decode())
+        self.names: List[str] = strings['names']
+        self.labels: List[str] = strings['labels']
+
+        self.__names_indices: Optional[Dict[str, int]] = None
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def packed_image(self, i: int) -> np.ndarray:
+        """
+        @return: the bit-packed rows of the image without copying them, shaped `(height, ceil(width / 8))`
+        """
+        offset, width, height = self.index[i]
+        row_size = (int(width) + 7) // 8
+
+        return self.__data[offset:offset + height * row_size].reshape(height, row_size)
+
+    def get_image(self, i: int) -> Image:
+        """
+        @return: the image in mode '1'
+        """
+        _offset, width, height = self.index[i]
+
+        return Image.frombytes('1', (int(width), int(height)), self.packed_image(i))
+
+    def index_of(self, name: str) -> int:
+        if self.__names_indices is None:
+            self.__names_indices = {name: i for i, name in enumerate(self.names)}
+
+        return self.__names_indices[name]
+
+    def get_image_by_name(self, name: str) -> Image:
+        return self.get_image(self.index_of(name))
+
+
+def dataset_shard_path(dataset_dir: str) -> Optional[str]:
+    """
+    @return: the path of the shard of the dataset directory, or None if the dataset is not packed
+    """
+    shard_filename = os.path.join(dataset_dir, DATASET_SHARD_FILENAME)
+
+    return shard_filename if os.path.isfile(shard_filename) else None
+
+
+def pack_dataset_directory(dataset_dir: str, remove_images: bool = False, progress=None) -> str:
+    """
+    Packs the PNG files of a dataset directory into its shard, both formats of `metadata.csv` are supported:
+    the expressions datasets (with a `file_basename,expr` header) and the classification datasets (`expr,filename`
+    rows without a header).
+
+    @param remove_images: remove the PNG files after the shard is written
+    @param progress: called with the number of packed images after every image
+    @return: the filename of the shard
+    """
+    with open(os.path.join(dataset_dir, 'metadata.csv'), newline='') as metadata_file:
+        rows = [row for row in csv.reader(metadata_file) if row]
+
+    if rows and rows[0] == ['file_basename', 'expr']:
+        names_labels = [(name, label) for name, label in rows[1:]]
+    else:
+        names_labels = [(name, label) for label, name in rows]
+
+    shard_filename = os.path.join(dataset_dir, DATASET_SHARD_FILENAME)
+
+    with DatasetShardWriter(shard_filename) as writer:
+        for i, (name, label) in enumerate(names_labels):
+            image_filename = os.path.join(dataset_dir, f'{name}.png')
+
+            # some expressions could have failed to generate
+            if not os.path.exists(image_filename):
+                continue
+
+            with Image.open(image_filename) as img:
+                writer.add(name, label, img)
+
+            if progress is not None:
+                progress(i + 1)
+
+    if remove_images:
+        for name in writer.names:
+            os.remove(os.path.join(dataset_dir, f'{name}.png'))
+
+    return shard_filename
@@ -1,30 +1,45 @@
-import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable, Callable, Iterator, Tuple, Optional, Any, TypeVar
 
+T = TypeVar('T')
 
-class ParallelExecutor:
-    def __init__(self, limit: int):
-        assert limit > 0, "Limit cannot be less than zero"
-        self.limit: int = limit
-        self.__executing: list = []
-        self.__finished: list = []
 
-    def execute(self, *args, **kwrgs):
-        if len(self.__executing) >= self.limit:
-            proc = self.__executing.pop(0)
-            proc.wait()
-            self.__finished.append(proc)
+def execute_pipelined(items: Iterable[T], process: Callable[[T], Any], concurrency: int) -> \
+        Iterator[Tuple[T, Any, Optional[Exception]]]:
+    """
+    Runs `process` on every item using `concurrency` threads (which are mostly waiting for subprocesses), every item
+    goes through all of its steps on its own, and the next item starts as soon as any of the running items finishes,
+    so a slow item does not stop the others.
 
-        self.__executing.append(subprocess.Popen(*args, **kwrgs))
+    `items` is consumed lazily, only a few items more than `concurrency` are waiting at any time.
 
-    def finish(self):
-        for proc in self.__executing:
-            proc.wait()
-            self.__finished.append(proc)
+    @return: iterator of `(item, result, error)` in the order the items finish, `error` is the exception raised by
+             `process` or None
+    """
+    assert concurrency > 0, "concurrency must be positive"
 
-        return list(self.__finished)
+    items = iter(items)
 
-    def clear(self):
-        self.finish()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        running = dict()
 
-        self.__finished.clear()
-        self.__executing.clear()
+        def submit_next() -> bool:
+            for item in items:
+                running[executor.submit(process, item)] = item
+                return True
+            return False
+
+        # keep some items waiting, so a thread does not wait for the next item to be created
+        for _ in range(concurrency * 2):
+            if not submit_next():
+                break
+
+        while running:
+            done, _pending = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                item = running.pop(future)
+                submit_next()
+
+                error = future.exception()
+                yield item, (future.result() if error is None else None), error
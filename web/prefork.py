@@ -0,0 +1,180 @@
+import gc
+import os
+import random
+import signal
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
+from typing import Dict
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from . import server
+from .utils import memory_usage
+
+
+class _RequestHandler(WSGIRequestHandler):
+    # one request per connection, so that a kept alive connection does not hold one of the worker threads
+    protocol_version = "HTTP/1.0"
+
+
+class _PooledWSGIServer(BaseWSGIServer):
+    """
+    WSGI server that handles the requests using a fixed number of threads, instead of a new thread for every request
+    """
+
+    multithread = True
+
+    def __init__(self, host: str, port: int, app, threads: int, fd: int) -> None:
+        super().__init__(host, port, app, handler=_RequestHandler, fd=fd)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+
+    def process_request(self, request, client_address) -> None:
+        self.executor.submit(self.__process_request_thread, request, client_address)
+
+    def __process_request_thread(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class _Worker:
+    """
+    Serves requests from the listening socket shared by all workers, until it receives `SIGTERM` or handles
+    `max_requests` requests, then it finishes the requests in progress and exits.
+    """
+
+    def __init__(self, listen_socket: socket.socket, threads: int, max_requests: int) -> None:
+        host, port = listen_socket.getsockname()[:2]
+
+        self.max_requests: int = max_requests
+        self.requests_count: int = 0
+        self.__lock = Lock()
+        self.__draining = False
+        self.http_server = _PooledWSGIServer(host, port, self.__app, threads=threads, fd=listen_socket.fileno())
+
+    def __app(self, environ, start_response):
+        with self.__lock:
+            self.requests_count += 1
+            recycle = self.max_requests and self.requests_count >= self.max_requests
+
+        if recycle:
+            self.drain()
+
+        return server.app(environ, start_response)
+
+    def drain(self) -> None:
+        with self.__lock:
+            if self.__draining:
+                return
+            self.__draining = True
+
+        server.accepting_requests = False
+        # `shutdown` waits for `serve_forever` to stop, so it cannot be called from its thread (or a signal handler)
+        Thread(target=self.http_server.shutdown, daemon=True).start()
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, lambda _signum, _frame: self.drain())
+        # the master handles `Ctrl+C` and stops the workers with `SIGTERM`
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        print(f"[LOG] worker {os.getpid()} started, memory: {memory_usage()}", flush=True)
+
+        self.http_server.serve_forever()
+        # wait for the requests that are being processed to finish
+        self.http_server.executor.shutdown(wait=True)
+        self.http_server.server_close()
+
+        print(f"[LOG] worker {os.getpid()} stopped after {self.requests_count} requests, memory: {memory_usage()}",
+              flush=True)
+
+
+def run_prefork_server(port: int, workers: int, threads: int, max_requests: int = 0) -> None:
+    """
+    Production server, the model is loaded and the pipeline is warmed up once in the master process, then `workers`
+    processes are forked, all of them share the model memory (copy-on-write) and accept requests from the same
+    socket, each with `threads` threads.
+
+    @param max_requests: if not 0, a worker is replaced by a new one after handling about this number of requests,
+                         the number is different for each worker, so they are not all replaced at the same time
+    """
+    if not hasattr(os, 'fork'):
+        raise OSError("the prefork server is only supported on systems with `fork`")
+
+    assert workers > 0, "workers must be positive"
+    assert threads > 0, "threads must be positive"
+
+    listen_socket = socket.create_server(("0.0.0.0", port), backlog=128)
+    listen_socket.set_inheritable(True)
+    # all workers are woken up when there is a new connection, but only one of them gets it, so the others must not
+    # block in `accept`, otherwise they would not notice when they are asked to stop
+    listen_socket.setblocking(False)
+
+    warm_up_start_time = time.monotonic()
+    server.warm_up()
+    warm_up_time = time.monotonic() - warm_up_start_time
+
+    # objects that exist now are never freed, so the garbage collector does not need to touch (and copy) their
+    # memory pages in the workers
+    gc.freeze()
+
+    print(f"[LOG] master {os.getpid()} ready, model loaded in {server.model_load_time:.2f}s, "
+          f"warmed up in {warm_up_time:.2f}s, memory: {memory_usage()}", flush=True)
+
+    workers_pids: Dict[int, int] = dict()
+    stopping = False
+
+    def spawn_worker() -> None:
+        # spread the recycling of workers, so they don't restart together
+        worker_max_requests = max_requests + random.randint(0, max_requests // 10) if max_requests else 0
+
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                _Worker(listen_socket, threads, worker_max_requests).run()
+            except BaseException:
+                sys.excepthook(*sys.exc_info())
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        workers_pids[pid] = worker_max_requests
+
+    def stop(_signum, _frame) -> None:
+        nonlocal stopping
+        stopping = True
+
+        for worker_pid in workers_pids:
+            try:
+                os.kill(worker_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn_worker()
+
+    while workers_pids:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        workers_pids.pop(pid, None)
+
+        if not stopping:
+            if os.waitstatus_to_exitcode(status) != 0:
+                print(f"[LOG] worker {pid} exited with status {status}, starting a new worker", flush=True)
+                # avoid starting workers in a tight loop if they keep failing
+                time.sleep(1)
+            spawn_worker()
+
+    listen_socket.close()
@@ -1,26 +1,44 @@
-from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from os import path, remove as os_remove_file
-from tempfile import mkdtemp, mktemp
+from os import path, cpu_count, getpid
+from time import monotonic
+from typing import Optional
 
-from PIL import Image
+from PIL import Image, ImageDraw
 from flask import Flask, jsonify, abort, render_template, request
 
+from classifier.batcher import ClassificationBatcher
 from classifier.classifier import SVMClassifier
-from classifier.labeler import get_labeled_crops, draw_labeled_crops
-from dataset_generator.generator import generate_single_from_template
+from classifier.labeler import NoSymbolsException
+from dataset_generator.renderer import LatexRenderer
+from parser.pipeline import ExpressionPipeline
 from parser.tree import SymbolTree
-from segmenter.labeler import draw_crops_rects
-from segmenter.symbol_segmenter import segment_image_crops, TooManyCropsException
-from utils.image import img_to_binary
-from .utils import json_arguments, response_image
+from segmenter.symbol_segmenter import TooManyCropsException
+from utils.cache import ResultCache, LRUCache, SQLiteCache
+from .utils import image_arguments, open_image, response_image, base64_image, memory_usage
 
 app = Flask(__name__)
 
 _svm_file_path = path.join(path.dirname(__file__), "..", "model", "svm.pkl")
-svm_model = SVMClassifier(_svm_file_path)
+_model_load_start_time = monotonic()
+svm_model = SVMClassifier(_svm_file_path, use_linear_predictor=True)
+model_load_time = monotonic() - _model_load_start_time
 
-generation_temp_folder = mkdtemp(prefix="latex_generation")
+# classifies the crops of concurrent requests together
+classification_batcher = ClassificationBatcher(svm_model)
+
+# results of all stages of recently submitted images, shared by all requests
+result_cache: ResultCache = LRUCache(max_bytes=128 * 1024 * 1024)
+
+# renders the LaTeX of `compile_latex` requests, without blocking the other requests for long
+latex_renderer = LatexRenderer(workers=cpu_count())
+
+# used to segment the images of batch requests in parallel
+batch_executor = ThreadPoolExecutor(max_workers=cpu_count())
+MAX_BATCH_IMAGES = 1000
+
+# False when the server is about to stop, so it should not get new requests
+accepting_requests = True
 
 
 # return 400 errors in json format
@@ -34,144 +52,209 @@ def too_many_crops_exception_handler(e):
     return jsonify(error=str(e)), 400
 
 
-@app.route('/api/v1/image_segments', methods=["POST"])
-@json_arguments([('image', str)])
-def api_image_segments(json_data):
-    image_raw = b64decode(json_data['image'])
-    image_bytes_io = BytesIO(image_raw)
+@app.errorhandler(NoSymbolsException)
+def no_symbols_exception_handler(e):
+    return jsonify(error=str(e)), 400
 
-    img = img_to_binary(Image.open(image_bytes_io))
 
-    crops = segment_image_crops(img)
+def _pipeline(img: Image) -> ExpressionPipeline:
+    return ExpressionPipeline(img, svm_model, cache=result_cache, batcher=classification_batcher)
 
-    return {
-        "crops": crops
-    }
 
+def _symbol_tree_data(tree: SymbolTree) -> list:
+    tree_nodes_data = []
 
-@app.route('/api/v1/draw_image_segments', methods=["POST"])
-@json_arguments([('image', str)])
-def api_draw_image_segments(json_data):
-    image_raw = b64decode(json_data['image'])
-    image_bytes_io = BytesIO(image_raw)
+    for node in tree.nodes:
+        single_node_data = dict()
+        tree_nodes_data.append(single_node_data)
 
-    img = img_to_binary(Image.open(image_bytes_io))
+        single_node_data['position'] = node.position
+        single_node_data['label'] = node.label
+        node_relations_data = dict()
+        single_node_data['relations'] = node_relations_data
 
-    output_img = draw_crops_rects(img)
+        for relation_name, children in node.relations.items():
+            # if a main relation and has members
+            if 'inverse' not in relation_name and len(children) > 0:
+                children_relations_positions = []
+                node_relations_data[relation_name] = children_relations_positions
 
-    return response_image(output_img)
+                for child_node in children:
+                    children_relations_positions.append(child_node.position)
 
+    return tree_nodes_data
 
-@app.route('/api/v1/labeled_crops', methods=["POST"])
-@json_arguments([('image', str)])
-def api_labeled_crops(json_data):
-    image_raw = b64decode(json_data['image'])
-    image_bytes_io = BytesIO(image_raw)
 
-    img = img_to_binary(Image.open(image_bytes_io))
+@app.route('/api/v1/image_segments', methods=["POST"])
+@image_arguments()
+def api_image_segments(arguments):
+    pipeline = _pipeline(arguments['image'])
+
+    return {
+        "crops": pipeline.crops
+    }
+
+
+@app.route('/api/v1/draw_image_segments', methods=["POST"])
+@image_arguments()
+def api_draw_image_segments(arguments):
+    pipeline = _pipeline(arguments['image'])
 
-    labeled_crops = get_labeled_crops(img, svm_model)
+    return response_image(pipeline.segments_image())
+
+
+@app.route('/api/v1/labeled_crops', methods=["POST"])
+@image_arguments()
+def api_labeled_crops(arguments):
+    pipeline = _pipeline(arguments['image'])
 
     return {
-        "labeled_crops": labeled_crops
+        "labeled_crops": pipeline.labeled_crops
     }
 
 
 @app.route('/api/v1/draw_labeled_crops', methods=["POST"])
-@json_arguments([('image', str)], [('no_crops', bool, False)])
-def api_draw_labeled_crops(json_data):
-    image_raw = b64decode(json_data['image'])
-    image_bytes_io = BytesIO(image_raw)
+@image_arguments([('no_crops', bool, False)])
+def api_draw_labeled_crops(arguments):
+    pipeline = _pipeline(arguments['image'])
 
-    img = img_to_binary(Image.open(image_bytes_io))
+    return response_image(pipeline.labeled_crops_image(no_crops=arguments['no_crops']))
 
-    labeled_crops = get_labeled_crops(img, svm_model)
-    labels, crops = list(zip(*labeled_crops))
 
-    # should we draw the crops rects or not
-    if json_data['no_crops']:
-        second_stage_img = img
-    else:
-        second_stage_img = draw_crops_rects(img, crops)
+@app.route('/api/v1/symbol_tree', methods=["POST"])
+@image_arguments()
+def api_symbol_tree(arguments):
+    pipeline = _pipeline(arguments['image'])
 
-    output_img = draw_labeled_crops(second_stage_img, labeled_crops)
+    return {"tree": _symbol_tree_data(pipeline.tree)}
+
+
+@app.route('/api/v1/draw_symbol_tree', methods=["POST"])
+@image_arguments([('no_crops', bool, False), ('no_labels', bool, False)])
+def api_draw_symbol_tree(arguments):
+    pipeline = _pipeline(arguments['image'])
+
+    output_img = pipeline.symbol_tree_image(no_crops=arguments['no_crops'], no_labels=arguments['no_labels'])
 
     return response_image(output_img)
 
 
-@app.route('/api/v1/symbol_tree', methods=["POST"])
-@json_arguments([('image', str)])
-def api_symbol_tree(json_data):
-    image_raw = b64decode(json_data['image'])
-    image_bytes_io = BytesIO(image_raw)
+@app.route('/api/v1/predict_latex', methods=["POST"])
+@image_arguments([('optimize', bool, True)])
+def api_predict_latex(arguments):
+    pipeline = _pipeline(arguments['image'])
+
+    return {"latex": pipeline.latex(optimize=arguments['optimize'])}
 
-    img = img_to_binary(Image.open(image_bytes_io))
 
-    tree = SymbolTree.from_image(img, svm_model)
-    tree_nodes_data = []
+@app.route('/api/v1/predict_latex_batch', methods=["POST"])
+@image_arguments([('optimize', bool, True)], multiple=True)
+def api_predict_latex_batch(arguments):
+    """
+    Predicts the LaTeX of many images, the results are in the same order of `images`, each result is either
+    `{"latex": ...}` or `{"error": ...}` if that image failed.
+    """
+    images = arguments['images']
 
-    for node in tree.nodes:
-        single_node_data = dict()
-        tree_nodes_data.append(single_node_data)
+    if len(images) > MAX_BATCH_IMAGES:
+        abort(400, f"cannot predict more than {MAX_BATCH_IMAGES} images in one request")
 
-        single_node_data['position'] = node.position
-        single_node_data['label'] = node.label
-        node_relations_data = dict()
-        single_node_data['relations'] = node_relations_data
+    results = [None] * len(images)
+    pipelines = []
+    pipelines_indices = []
 
-        for relation_name, children in node.relations.items():
-            # if a main relation and has members
-            if 'inverse' not in relation_name and len(children) > 0:
-                children_relations_positions = []
-                node_relations_data[relation_name] = children_relations_positions
+    for i, image in enumerate(images):
+        try:
+            img = open_image(image)
+            # make sure the image can be decoded, before it is used with the other images
+            img.load()
+            pipeline = _pipeline(img)
+        except Exception as e:
+            results[i] = {"error": f"{type(e).__name__}: {e}"}
+            continue
 
-                for child_node in children:
-                    children_relations_positions.append(child_node.position)
+        pipelines.append(pipeline)
+        pipelines_indices.append(i)
 
-    return {"tree": tree_nodes_data}
+    ExpressionPipeline.label_crops_batch(pipelines, executor=batch_executor)
 
+    for i, pipeline in zip(pipelines_indices, pipelines):
+        try:
+            results[i] = {"latex": pipeline.latex(optimize=arguments['optimize'])}
+        except Exception as e:
+            results[i] = {"error": f"{type(e).__name__}: {e}"}
 
-@app.route('/api/v1/draw_symbol_tree', methods=["POST"])
-@json_arguments([('image', str)], [('no_crops', bool, False), ('no_labels', bool, False)])
-def api_draw_symbol_tree(json_data):
-    image_raw = b64decode(json_data['image'])
-    image_bytes_io = BytesIO(image_raw)
+    return {"results": results}
 
-    img = img_to_binary(Image.open(image_bytes_io))
 
-    labeled_crops = get_labeled_crops(img, svm_model)
-    labels, crops = list(zip(*labeled_crops))
+# all the results that `analyze` can return
+ANALYZE_ARTIFACTS = ['crops', 'labeled_crops', 'tree', 'latex', 'segments_image', 'labeled_crops_image',
+                     'symbol_tree_image']
 
-    tree = SymbolTree.from_labeled_crops(labeled_crops)
 
-    if json_data['no_crops']:
-        second_stage_img = img
-    else:
-        second_stage_img = draw_crops_rects(img, crops)
+def _analyze_artifact(pipeline: ExpressionPipeline, artifact: str, arguments):
+    if artifact == 'crops':
+        return pipeline.crops
+    elif artifact == 'labeled_crops':
+        return pipeline.labeled_crops
+    elif artifact == 'tree':
+        return _symbol_tree_data(pipeline.tree)
+    elif artifact == 'latex':
+        return pipeline.latex(optimize=arguments['optimize'])
+    elif artifact == 'segments_image':
+        return base64_image(pipeline.segments_image())
+    elif artifact == 'labeled_crops_image':
+        return base64_image(pipeline.labeled_crops_image(no_crops=arguments['no_crops']))
+    elif artifact == 'symbol_tree_image':
+        return base64_image(pipeline.symbol_tree_image(no_crops=arguments['no_crops'],
+                                                       no_labels=arguments['no_labels']))
 
-    if json_data['no_labels']:
-        third_stage_img = second_stage_img
-    else:
-        third_stage_img = draw_labeled_crops(second_stage_img, labeled_crops)
+    raise ValueError(f"unknown artifact `{artifact}`")
 
-    output_img = tree.draw_min_connections(third_stage_img)
 
-    return response_image(output_img)
+@app.route('/api/v1/analyze', methods=["POST"])
+@image_arguments([('artifacts', list, ANALYZE_ARTIFACTS), ('optimize', bool, True), ('no_crops', bool, False),
+                  ('no_labels', bool, False)])
+def api_analyze(arguments):
+    """
+    Runs the system once on the image and returns all the requested `artifacts`, images are returned as base64 PNG.
+    If an artifact fails, the others are still returned, and its error is added to `errors`.
+    """
+    for artifact in arguments['artifacts']:
+        if artifact not in ANALYZE_ARTIFACTS:
+            abort(400, f"unknown artifact `{artifact}`, available artifacts are {ANALYZE_ARTIFACTS}")
 
+    pipeline = _pipeline(arguments['image'])
 
-@app.route('/api/v1/predict_latex', methods=["POST"])
-@json_arguments([('image', str)], [('optimize', bool, True)])
-def api_predict_latex(json_data):
-    image_raw = b64decode(json_data['image'])
-    image_bytes_io = BytesIO(image_raw)
+    result = dict()
+    errors = dict()
+
+    for artifact in arguments['artifacts']:
+        try:
+            result[artifact] = _analyze_artifact(pipeline, artifact, arguments)
+        except Exception as e:
+            errors[artifact] = f"{type(e).__name__}: {e}"
 
-    img = img_to_binary(Image.open(image_bytes_io))
+    result['errors'] = errors
 
-    tree = SymbolTree.from_image(img, svm_model)
+    return result
 
-    latex_string = tree.get_latex_string(optimize=json_data['optimize'])
 
-    return {"latex": latex_string}
+@app.route('/api/v1/cache_stats', methods=["GET"])
+def api_cache_stats():
+    return result_cache.stats()
+
+
+@app.route('/api/v1/batcher_stats', methods=["GET"])
+def api_batcher_stats():
+    return classification_batcher.stats()
+
+
+@app.route('/api/v1/ready', methods=["GET"])
+def api_ready():
+    ready = accepting_requests and svm_model.model is not None
+
+    return jsonify(ready=ready, pid=getpid(), memory=memory_usage()), 200 if ready else 503
 
 
 @app.route('/api/v1/compile_latex', methods=["GET"])
@@ -181,10 +264,8 @@ def api_compile_latex():
     if template is None:
         abort(400, "Please specify `template` argument")
 
-    img_filename = mktemp(prefix="latex_img", dir=generation_temp_folder)
-
     try:
-        generate_single_from_template(template, generation_temp_folder, path.basename(img_filename))
+        _expr, png_data = latex_renderer.render_template(template)
     # here `ValueError` is meant to only catch the formatting error that may happen due to wrong template from the user
     except ValueError as e:
         abort(400, f"Error in formatting: ValueError: {e}, try use double curly brackets, extra: {e}")
@@ -193,12 +274,7 @@ def api_compile_latex():
     except IndexError as e:
         abort(400, f"Error in formatting: IndexError: {e}, try use double curly brackets, extra: {e}")
 
-    img = Image.open(img_filename + ".png")
-
-    # remove the file after generation as they are not needed now
-    os_remove_file(img_filename + ".png")
-
-    return response_image(img)
+    return response_image(Image.open(BytesIO(png_data)))
 
 
 @app.route('/api/v1/latex_template_variables', methods=["GET"])
@@ -242,5 +318,52 @@ def page_settings():
     return render_template('settings.html')
 
 
-def run_server(port: int):
+def warm_up():
+    """
+    Runs the whole system once on a small image, so that everything that is initialized on first use is ready
+    before handling requests (and before forking workers, so they share it)
+    """
+    img = Image.new('L', (80, 40), 255)
+    img_d = ImageDraw.Draw(img)
+    img_d.rectangle((10, 5, 14, 35), fill=0)
+    img_d.rectangle((30, 18, 50, 21), fill=0)
+    img_d.rectangle((60, 5, 64, 35), fill=0)
+
+    ExpressionPipeline(img, svm_model).latex()
+
+
+def set_result_cache(cache_size: int, cache_file: Optional[str] = None):
+    """
+    @param cache_size: the maximum size of the results cache in MB
+    @param cache_file: if specified, the cache is stored in this SQLite database file, so it can be shared by all
+                       the server processes on the machine, otherwise it is in the memory of this process
+    """
+    global result_cache
+
+    if cache_file:
+        result_cache = SQLiteCache(cache_file, max_bytes=cache_size * 1024 * 1024)
+    else:
+        result_cache = LRUCache(max_bytes=cache_size * 1024 * 1024)
+
+
+def set_classification_batching(max_wait_ms: float, max_batch_size: int):
+    classification_batcher.max_wait_ms = max_wait_ms
+    classification_batcher.max_batch_size = max_batch_size
+
+
+def set_latex_rendering(workers: int):
+    """
+    @param workers: the maximum number of LaTeX renders that run at the same time
+    """
+    global latex_renderer
+
+    latex_renderer = LatexRenderer(workers=workers)
+
+
+def run_server(port: int, cache_size: int = 128, cache_file: Optional[str] = None, batch_wait_ms: float = 2,
+               max_batch_size: int = 256, render_workers: int = cpu_count()):
+    set_result_cache(cache_size, cache_file)
+    set_classification_batching(batch_wait_ms, max_batch_size)
+    set_latex_rendering(render_workers)
+
     app.run(debug=True, host="0.0.0.0", port=port)
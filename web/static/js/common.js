@@ -32,6 +32,33 @@ function img_to_base64(img) {
     return dataURL.replace(/^data:image\/(png|jpg);base64,/, "");
 }
 
+// run the whole system on the image in one request, `images` maps the name of an image artifact to the `img` element
+// that should display it, and `on_latex` is called with the predicted LaTeX string
+function analyze_image(img_base64, images, on_latex) {
+    $.ajax({
+        url: 'api/v1/analyze',
+        method: 'POST',
+        contentType: 'application/json',
+        data: JSON.stringify({image: img_base64, artifacts: [...Object.keys(images), 'latex'], optimize: true}),
+    }).done(function (data) {
+        for (const [artifact, img_obj] of Object.entries(images)) {
+            if (artifact in data) {
+                img_obj.attr('src', 'data:image/png;base64,' + data[artifact]);
+            } else {
+                report_error(`${artifact} failed:`, data['errors'][artifact]);
+            }
+        }
+
+        if ('latex' in data) {
+            on_latex(data['latex']);
+        } else {
+            report_error(`latex prediction:`, data['errors']['latex']);
+        }
+    }).fail(function (ajax_obj, textStatus, errorThrown) {
+        report_error(`analyze request failed:`, ajax_obj.responseText);
+    })
+}
+
 function refresh_toast_disappear_setting() {
     toast_disappear_setting = localStorage.getItem(TOAST_DISAPPEAR_KEY) === 'true';
 }
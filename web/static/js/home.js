@@ -35,21 +35,12 @@ function add_input_image_change_handler() {
     });
 }
 
-function predict_latex_and_update_output_preview(img_base64) {
-    $.ajax({
-        url: 'api/v1/predict_latex',
-        method: 'POST',
-        contentType: 'application/json',
-        data: JSON.stringify({image: img_base64, optimize: true}),
-    }).done(function (data) {
-        code_mirror_output_latex.getDoc().setValue(data['latex']);
-        // build url to go to `latex_compiler` for the user to compare the two images
-        let compile_url = '/latex_compiler';
-        compile_url += `?template=${encodeURIComponent(data['latex'])}`;
-        $("#compile_output_latex_button").attr('href', compile_url);
-    }).fail(function (ajax_obj, textStatus, errorThrown) {
-        report_error(`latex prediction:`, ajax_obj.responseText);
-    })
+function update_output_latex(latex) {
+    code_mirror_output_latex.getDoc().setValue(latex);
+    // build url to go to `latex_compiler` for the user to compare the two images
+    let compile_url = '/latex_compiler';
+    compile_url += `?template=${encodeURIComponent(latex)}`;
+    $("#compile_output_latex_button").attr('href', compile_url);
 }
 
 function run_prediction_for_image() {
@@ -89,49 +80,12 @@ function run_prediction_for_image() {
         });
     }
 
-    // in each step, we would call the API in the first index and assign the result to the image in the second index
-    // note that this happen simultaneously meaning we send all requests at once and update the images on callbacks
-    let steps = [
-        ['draw_image_segments', segmentation_img],
-        ['draw_labeled_crops', classification_img],
-        ['draw_symbol_tree', parsing_img],
-    ];
-
-    for (let step of steps) {
-        const api_call = step[0];
-        const img_obj = step[1];
-
-        $.ajax({
-            url: 'api/v1/' + api_call,
-            method: 'POST',
-            contentType: 'application/json',
-            data: JSON.stringify({image: img_base64}),
-            xhr: () => { // Seems like the only way to get access to the xhr object and change its type to blob
-                let xhr = new XMLHttpRequest();
-                xhr.responseType = 'blob'
-                xhr.onreadystatechange = function () {
-                    if (xhr.readyState === 2) {
-                        if (xhr.status === 200) {
-                            xhr.responseType = "blob";
-                        } else {
-                            xhr.responseType = "text";
-                        }
-                    }
-                };
-                return xhr;
-            },
-        }).done(function (data) {
-            let reader = new FileReader();
-            reader.onload = function (event) {
-                img_obj.attr('src', event.target.result);
-            };
-            reader.readAsDataURL(data);
-        }).fail(function (ajax_obj, textStatus, errorThrown) {
-            report_error(`${api_call} request failed:`, ajax_obj.responseText);
-        })
-    }
-
-    predict_latex_and_update_output_preview(img_base64);
+    // all the images and the LaTeX are computed from a single run of the system on the server
+    analyze_image(img_base64, {
+        segments_image: segmentation_img,
+        labeled_crops_image: classification_img,
+        symbol_tree_image: parsing_img,
+    }, update_output_latex);
 }
 
 function add_image_submit_handler() {
@@ -1,49 +1,205 @@
+from base64 import b64encode, b64decode
+import sys
 from functools import wraps
+from os import path
 from io import BytesIO
-from typing import List, Tuple, Optional, Any
+from typing import List, Tuple, Optional, Any, Union, IO
 
 from PIL import Image
 from flask import request, abort, send_file
+from werkzeug.datastructures import MultiDict
 
 
 def json_arguments(required_args: List[Tuple[str, type]], optional_args: Optional[List[Tuple[str, type, Any]]] = None):
     def decorator(func):
         @wraps(func)
         def wrapper():
-            json_data = request.get_json()
+            json_data = request.get_json(silent=True)
 
-            if json_data is None:
-                abort(400, "Must specify `json` data body")
+            __check_json_arguments(json_data, required_args, optional_args)
 
-            for (name, ty) in required_args:
-                # for required args, make sure the arg is present and is of the required type
-                if name not in json_data:
-                    abort(400, f"argument `{name}` is not found")
-                if not isinstance(json_data[name], ty):
-                    abort(400, f"argument `{name}` must be of type `{ty.__name__}`")
+            return func(json_data)
 
-            if optional_args is not None:
-                # for optional args, if it exist, the type must be the same as specified
-                # if it does not exist, then use the default value, and make sure the default
-                # value is of the correct type
-                for (name, ty, default) in optional_args:
-                    if name in json_data:
-                        if not isinstance(json_data[name], ty):
-                            abort(400, f"argument `{name}` must be of type `{ty.__name__}`")
-                    else:
-                        assert isinstance(default, ty), \
-                            f"Cannot use default value {default} of as it is not of type {ty}"
-                        json_data[name] = default
+        return wrapper
 
-            return func(json_data)
+    return decorator
+
+
+def image_arguments(optional_args: Optional[List[Tuple[str, type, Any]]] = None, multiple: bool = False):
+    """
+    Same as `json_arguments` with a required `image` argument (or `images` if `multiple`), the image can be sent as:
+    - `application/json`: `{"image": <base64 image>, ...}` with the other arguments in the `json` data
+    - `multipart/form-data`: the image file in the `image` field (or many files in `images`), and the other arguments
+      as form fields
+    - the image file itself as the body, with `Content-Type: image/*`, and the other arguments in the query string
+
+    The last two are read directly from the request, without the cost of base64 and `json` decoding.
+
+    The function gets the decoded `Image` in `image`, if the image cannot be decoded the request fails with 400.
+    If `multiple`, it gets the list of images sources in `images` without decoding them, so every image can fail
+    alone, each can be opened with `open_image`.
+    """
+    name = 'images' if multiple else 'image'
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper():
+            mimetype = request.mimetype
+
+            if mimetype == 'multipart/form-data':
+                files = request.files.getlist(name)
+                if not files:
+                    abort(400, f"file `{name}` is not found")
+
+                arguments = __text_arguments(request.form, optional_args)
+                sources = [file.stream for file in files]
+            elif mimetype.startswith('image/'):
+                arguments = __text_arguments(request.args, optional_args)
+                # no need to keep a copy of the body in the request
+                sources = [BytesIO(request.get_data(cache=False))]
+            else:
+                arguments = request.get_json(silent=True)
+                __check_json_arguments(arguments, [(name, list if multiple else str)], optional_args)
+
+                if multiple:
+                    sources = arguments[name]
+                    for source in sources:
+                        if not isinstance(source, str):
+                            abort(400, f"argument `{name}` must be a list of `str`")
+                else:
+                    sources = [arguments[name]]
+
+            if multiple:
+                arguments[name] = sources
+            else:
+                if len(sources) != 1:
+                    abort(400, f"expected one `{name}`, found {len(sources)}")
+
+                try:
+                    img = open_image(sources[0])
+                    # decode it now, so that invalid images are reported as bad requests
+                    img.load()
+                except (ValueError, OSError) as e:
+                    abort(400, f"cannot decode `{name}`: {type(e).__name__}: {e}")
+
+                arguments[name] = img
+
+            return func(arguments)
 
         return wrapper
 
     return decorator
 
 
+def open_image(source: Union[str, IO[bytes]]) -> Image:
+    """
+    @param source: base64 encoded image, or a binary file of the image
+    """
+    if isinstance(source, str):
+        source = BytesIO(b64decode(source))
+
+    return Image.open(source)
+
+
+def __check_json_arguments(json_data, required_args: List[Tuple[str, type]],
+                           optional_args: Optional[List[Tuple[str, type, Any]]]) -> None:
+    if json_data is None:
+        abort(400, "Must specify `json` data body")
+
+    for (name, ty) in required_args:
+        # for required args, make sure the arg is present and is of the required type
+        if name not in json_data:
+            abort(400, f"argument `{name}` is not found")
+        if not isinstance(json_data[name], ty):
+            abort(400, f"argument `{name}` must be of type `{ty.__name__}`")
+
+    if optional_args is not None:
+        # for optional args, if it exist, the type must be the same as specified
+        # if it does not exist, then use the default value, and make sure the default
+        # value is of the correct type
+        for (name, ty, default) in optional_args:
+            if name in json_data:
+                if not isinstance(json_data[name], ty):
+                    abort(400, f"argument `{name}` must be of type `{ty.__name__}`")
+            else:
+                assert isinstance(default, ty), \
+                    f"Cannot use default value {default} of as it is not of type {ty}"
+                json_data[name] = default
+
+
+def __text_arguments(values: MultiDict, optional_args: Optional[List[Tuple[str, type, Any]]]) -> dict:
+    """
+    Parses the optional arguments from form fields or query string values, which are all text
+    """
+    arguments = dict()
+
+    for (name, ty, default) in optional_args or []:
+        if name not in values:
+            arguments[name] = default
+            continue
+
+        texts = values.getlist(name)
+
+        if ty is list:
+            # either repeated (`a=1&a=2`) or comma separated (`a=1,2`)
+            arguments[name] = [item for text in texts for item in text.split(',') if item]
+        elif ty is bool:
+            text = texts[-1].strip().lower()
+            if text in ('true', '1', 'yes', 'on'):
+                arguments[name] = True
+            elif text in ('false', '0', 'no', 'off'):
+                arguments[name] = False
+            else:
+                abort(400, f"argument `{name}` must be of type `bool`")
+        else:
+            try:
+                arguments[name] = ty(texts[-1])
+            except ValueError:
+                abort(400, f"argument `{name}` must be of type `{ty.__name__}`")
+
+    return arguments
+
+
 def response_image(img: Image):
     img_io = BytesIO()
     img.save(img_io, 'PNG')
     img_io.seek(0)
     return send_file(img_io, mimetype='image/png')
+
+
+def base64_image(img: Image) -> str:
+    img_io = BytesIO()
+    img.save(img_io, 'PNG')
+    return b64encode(img_io.getvalue()).decode('ascii')
+
+
+def memory_usage() -> dict:
+    """
+    Memory used by the current process in MB, on Linux `shared` is the memory shared with other processes
+    (like the model shared between the workers and the master), and `private` is only used by this process
+    """
+    smaps_rollup_filename = '/proc/self/smaps_rollup'
+
+    if path.exists(smaps_rollup_filename):
+        values_kb = dict()
+        with open(smaps_rollup_filename) as smaps_rollup_file:
+            for line in smaps_rollup_file:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    values_kb[parts[0].rstrip(':')] = int(parts[1])
+
+        return {
+            'rss': round(values_kb.get('Rss', 0) / 1024, 1),
+            'pss': round(values_kb.get('Pss', 0) / 1024, 1),
+            'shared': round((values_kb.get('Shared_Clean', 0) + values_kb.get('Shared_Dirty', 0)) / 1024, 1),
+            'private': round((values_kb.get('Private_Clean', 0) + values_kb.get('Private_Dirty', 0)) / 1024, 1),
+        }
+
+    try:
+        import resource
+    except ImportError:
+        return dict()
+
+    # `ru_maxrss` is in KB on Linux, and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'max_rss': round(max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)}
@@ -1,12 +1,51 @@
 # this file is just a wrapper for the `web` module
 from argparse import ArgumentParser
+from os import cpu_count
 
-from web.server import run_server
+from web.prefork import run_prefork_server
+from web.server import run_server, set_result_cache, set_classification_batching, set_latex_rendering
 
 if __name__ == "__main__":
     parser = ArgumentParser(description='Fyp system webserver')
     parser.add_argument('--port', '-p', type=int, action='store', default=5000, help='port number (default = 5000)')
 
+    parser.add_argument('--cache-size', type=int, action='store', default=128,
+                        help='maximum size of the recognition results cache in MB, 0 to disable (default = 128)')
+
+    parser.add_argument('--cache-file', type=str, action='store', default=None,
+                        help='store the recognition results cache in this SQLite file, to share it between all the '
+                             'server processes on this machine (default = in memory cache)')
+
+    parser.add_argument('--batch-wait-ms', type=float, action='store', default=2,
+                        help='maximum time a request waits for other requests to classify their symbols together '
+                             '(default = 2)')
+
+    parser.add_argument('--max-batch-size', type=int, action='store', default=256,
+                        help='maximum number of symbols classified together (default = 256)')
+
+    parser.add_argument('--render-workers', type=int, action='store', default=cpu_count(),
+                        help='maximum number of LaTeX renders of `compile_latex` running at the same time '
+                             '(default = number of CPUs)')
+
+    parser.add_argument('--workers', type=int, action='store', default=0,
+                        help='run the production server with this number of worker processes, the model is loaded '
+                             'once and shared by all workers (default = 0, run the development server)')
+
+    parser.add_argument('--threads', type=int, action='store', default=4,
+                        help='number of threads of each worker process (default = 4)')
+
+    parser.add_argument('--max-requests', type=int, action='store', default=0,
+                        help='replace a worker with a new one after about this number of requests '
+                             '(default = 0, never replace)')
+
     args = parser.parse_args()
 
-    run_server(args.port)
+    if args.workers > 0:
+        set_result_cache(args.cache_size, args.cache_file)
+        set_classification_batching(args.batch_wait_ms, args.max_batch_size)
+        set_latex_rendering(args.render_workers)
+
+        run_prefork_server(args.port, args.workers, args.threads, args.max_requests)
+    else:
+        run_server(args.port, args.cache_size, args.cache_file, args.batch_wait_ms, args.max_batch_size,
+                   args.render_workers)